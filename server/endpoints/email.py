@@ -24,15 +24,15 @@ THIS ONLY DEALS WITH PUBLIC EMAILS FOR NOW - AAA IS BEING WORKED ON
 import plugins.server
 import plugins.session
 import plugins.messages
-import plugins.database
+import plugins.attachments
+import plugins.httpcache
 import aiohttp.web
 import plugins.aaa
-import base64
 import typing
 
 
 async def process(
-    _server: plugins.server.BaseServer, session: plugins.session.SessionObject, indata: dict,
+    server: plugins.server.BaseServer, session: plugins.session.SessionObject, indata: dict,
 ) -> typing.Union[dict, aiohttp.web.Response]:
 
     # Has a list id been provided?
@@ -40,9 +40,11 @@ async def process(
 
     # lookup by message id must always include a list id for disambiguation
     if listid:
-        email = await plugins.messages.get_email(session, messageid=indata.get("id"), listid=listid)
+        email, version = await plugins.messages.get_email_versioned(
+            session, messageid=indata.get("id"), listid=listid
+        )
     else: # Else assume permalink and look up the email based on that
-        email = await plugins.messages.get_email(session, permalink=indata.get("id"))
+        email, version = await plugins.messages.get_email_versioned(session, permalink=indata.get("id"))
 
     if email is None:
         return aiohttp.web.Response(headers={}, status=404, text="Email not found")
@@ -51,9 +53,17 @@ async def process(
     if email:
         # Are we fetching an attachment?
         if not indata.get("attachment"):
+            max_age = server.config.http_cache.email_max_age
+            etag = None
+            if version:
+                # The email only changes when the document is updated, so there is no need to go any further
+                etag = plugins.httpcache.make_etag("email", plugins.httpcache.viewer(session), version)
+                not_modified = plugins.httpcache.not_modified(session, etag, max_age)
+                if not_modified:
+                    return not_modified
             if not email.get("gravatar"):
                 email["gravatar"] = plugins.messages.gravatar(email)
-            return email
+            return await plugins.httpcache.json_response(server, session, email, max_age, etag)
         else:
             fid = indata.get("file")
             for entry in email.get("attachments", []):
@@ -65,16 +75,16 @@ async def process(
                     }
                     if "image/" not in ct and "text/" not in ct:
                         headers["Content-Disposition"] = f"attachment; filename=\"{entry.get('filename')}\""
-                    try:
-                        assert session.database, "Database not connected!"
-                        attachment = await session.database.get(
-                            index=session.database.dbs.db_attachment, id=indata.get("file")
-                        )
-                        if attachment:
-                            blob = base64.decodebytes(attachment["_source"].get("source").encode("utf-8"))
-                            return aiohttp.web.Response(headers=headers, status=200, body=blob)
-                    except plugins.database.DBError:
-                        pass  # attachment not found
+                    # Attachments are stored by the hash of their contents, so they never change
+                    etag = plugins.httpcache.make_etag("attachment", fid, ct, entry.get("filename"))
+                    max_age = plugins.httpcache.IMMUTABLE_MAX_AGE
+                    not_modified = plugins.httpcache.not_modified(session, etag, max_age, immutable=True)
+                    if not_modified:
+                        return not_modified
+                    headers.update(plugins.httpcache.cache_headers(session, etag, max_age, immutable=True))
+                    blob = await plugins.attachments.get_attachment(session, fid)
+                    if blob is not None:
+                        return aiohttp.web.Response(headers=headers, status=200, body=blob)
             return aiohttp.web.Response(headers={}, status=404, text="Attachment not found")
 
     return aiohttp.web.Response(headers={}, status=404, text="Email not found")
@@ -17,19 +17,28 @@
 
 """Caching proxy for Gravatars"""
 
+import plugins.cache
+import plugins.metrics
 import plugins.server
 import plugins.session
 import aiohttp
 import aiohttp.web
+import asyncio
 import base64
 import string
 import typing
 
-CACHE_LIMIT = 25000  # Store a maximum of 25,000 gravatars in memory at any given time (25k x 5kb ≃125mb)
+CACHE_MAX_BYTES = 128 * 1024 * 1024  # Keep at most 128MiB of gravatars in memory at any given time (~25k x 5kb)
+NEGATIVE_CACHE_TTL = 3600  # Remember hashes we have no gravatar for, for an hour
+NEGATIVE_CACHE_LIMIT = 100000  # ...but only this many of them
+FETCH_TIMEOUT = 10  # Max seconds to spend fetching a gravatar upstream
 GRAVATAR_URL = "https://secure.gravatar.com/avatar/%s.png?s=96&r=g&d=mm"
 
-gravatars: list[str] = []
-gravatar_cache: dict[str, typing.Any] = {}
+gravatar_cache = plugins.cache.LRUCache(CACHE_MAX_BYTES)
+gravatar_unknown = plugins.cache.NegativeCache(NEGATIVE_CACHE_TTL, NEGATIVE_CACHE_LIMIT)
+gravatar_fetches = plugins.cache.SingleFlight()
+gravatar_disk: typing.Optional[plugins.cache.DiskCache] = None  # Persistent second tier, if configured
+client_session: typing.Optional[aiohttp.ClientSession] = None
 gravatar_default = base64.b64decode("""\
 /9j/4AAQSkZJRgABAQEAYABgAAD//gA7Q1JFQVRPUjogZ2QtanBlZyB2MS4wICh1c2luZyBJSkcgSlB
 FRyB2NjIpLCBxdWFsaXR5ID0gOTAK/9sAQwADAgIDAgIDAwMDBAMDBAUIBQUEBAUKBwcGCAwKDAwLCg
@@ -59,17 +68,32 @@ dd0Ubec49l5/ngfjXPGvQ/g3bB9U1G4xzHEqA/7xz/7LQB6xRSUUALRSf56UUALRSUf56UALRSUUAeD
 ePNKGkeKb2JF2xSN5yD2bn+eR+Fc/Xofxktgmp6fcY5khZCf905/9mrzygD//2Q==
 """)
 
-async def fetch_gravatar(gid: str) -> None:
-    headers = {"User-Agent": "Pony Mail Agent/0.1"}
+def get_client_session() -> aiohttp.ClientSession:
+    """Returns the client session shared by all upstream fetches, so connections are reused"""
+    global client_session  # pylint: disable=global-statement
+    if client_session is None or client_session.closed:
+        client_session = aiohttp.ClientSession(
+            headers={"User-Agent": "Pony Mail Agent/0.1"},
+            timeout=aiohttp.ClientTimeout(total=FETCH_TIMEOUT),
+        )
+    return client_session
+
+
+async def close_client_session() -> None:
+    """Closes the shared client session; run when the server shuts down"""
+    global client_session  # pylint: disable=global-statement
+    if client_session is not None:
+        await client_session.close()
+        client_session = None
+
+
+async def fetch_gravatar(gid: str) -> typing.Optional[bytes]:
+    """Fetches an image from upstream, or returns None if that failed"""
     fetch_url = GRAVATAR_URL % gid
-    # Fetch image and store internally
-    try:
-        async with aiohttp.client.request("GET", fetch_url, headers=headers) as rv:
-            img_data = await rv.read()
-            gravatars.append(gid)
-            gravatar_cache[gid] = img_data
-    except aiohttp.ClientError:  # Client error, bail.
-        pass
+    async with get_client_session().get(fetch_url) as rv:
+        if rv.status == 200:
+            return await rv.read()
+    return None
 
 
 async def gravatar_exists_in_db(session: plugins.session.SessionObject, gid: str) -> bool:
@@ -84,34 +108,59 @@ async def gravatar_exists_in_db(session: plugins.session.SessionObject, gid: str
     return False
 
 
-async def process(_server: plugins.server.BaseServer, session: plugins.session.SessionObject, indata: dict) -> aiohttp.web.Response:
+async def load_gravatar(
+    server: plugins.server.BaseServer, session: plugins.session.SessionObject, gid: str
+) -> typing.Optional[bytes]:
+    """Looks up a gravatar that is not in the cache. Only one of these runs per hash at any given time."""
+    # Anything on disk was checked against the archives when it was fetched
+    if gravatar_disk is not None:
+        img_data = await server.runners.run(gravatar_disk.get, gid)
+        if img_data is not None:
+            gravatar_cache.put(gid, img_data)
+            return img_data
+    # Only proxy gravatars for people who actually appear in the archives
+    if not await gravatar_exists_in_db(session, gid):
+        gravatar_unknown.add(gid)
+        return None
+    try:
+        img_data = await fetch_gravatar(gid)
+    except (aiohttp.ClientError, asyncio.TimeoutError):  # Client error, bail, but try again next time.
+        return None
+    if img_data is None:
+        gravatar_unknown.add(gid)
+        return None
+    gravatar_cache.put(gid, img_data)
+    if gravatar_disk is not None:
+        await server.runners.run(gravatar_disk.put, gid, img_data)
+    return img_data
+
+
+async def process(server: plugins.server.BaseServer, session: plugins.session.SessionObject, indata: dict) -> aiohttp.web.Response:
     gid = indata.get("md5", "null")
     # Ensure md5 hash is valid
     is_valid_md5 = len(gid) == 32 and all(letter in string.hexdigits for letter in gid)
 
-    # Valid and in cache??
-    in_cache = gid in gravatars
-    should_fetch = False
-
-    # If valid but not cached, check if gravatar exists in the pony mail db
-    if is_valid_md5 and not in_cache:
-        should_fetch = await gravatar_exists_in_db(session, gid)
-    # If valid and not in cache, fetch from gravatar.com
-    if not in_cache and should_fetch:
-        await fetch_gravatar(gid)
-        # If we've hit the cache limit, pop the oldest element.
-        if len(gravatars) > CACHE_LIMIT:
-            to_pop = gravatars.pop(0)
-            del gravatar_cache[to_pop]
-    # if in cache, serve it.
+    img = None
+    if is_valid_md5:
+        gid = gid.lower()
+        img = gravatar_cache.get(gid)
+        # If valid but not cached, and not known to be missing, look it up
+        if img is None and gid not in gravatar_unknown:
+            img = await gravatar_fetches.run(gid, lambda: load_gravatar(server, session, gid))
+
     headers = {
       "Cache-Control": "max-age=86400",  # Expire gravatar in one day
     }
-    if is_valid_md5 and gid in gravatars:
-        img = gravatar_cache[gid]
-        return aiohttp.web.Response(headers=headers, content_type="image/png", body=img)
-    return aiohttp.web.Response(headers=headers, content_type="image/png", body=gravatar_default)
+    return aiohttp.web.Response(headers=headers, content_type="image/png", body=img or gravatar_default)
 
 
-def register(_server: plugins.server.BaseServer):
+def register(server: plugins.server.BaseServer):
+    global gravatar_disk  # pylint: disable=global-statement
+    config = server.config.gravatar
+    if config.cache_dir:
+        gravatar_disk = plugins.cache.DiskCache(config.cache_dir, config.cache_ttl, config.cache_max_bytes)
+        print(f"Loaded {len(gravatar_disk)} gravatars from {config.cache_dir}")
+    plugins.metrics.registry.caches["gravatar_memory"] = lambda: gravatar_cache
+    plugins.metrics.registry.caches["gravatar_disk"] = lambda: gravatar_disk
+    server.cleanups.append(close_client_session)
     return plugins.server.Endpoint(process)
@@ -17,6 +17,7 @@
 
 """Endpoint for returning emails in mbox format as a single archive"""
 import asyncio
+import contextlib
 import plugins.server
 import plugins.session
 import plugins.messages
@@ -98,23 +99,26 @@ async def process(
     response.enable_chunked_encoding()
     await response.prepare(request)
 
-    async for emails in plugins.messages.query_batch(
+    batches = plugins.messages.query_batch(
         session,
         query_defuzzed,
         metadata_only=True,
-        epoch_order="asc"
-    ):
-        for email in emails:
-            source = await plugins.messages.get_source(session, permalink=email.get("dbid"))
-            mboxrd_source = convert_source(source)
-            # Ensure each non-empty source ends with a blank line
-            if not mboxrd_source.endswith("\n\n"):
-                mboxrd_source += "\n"
-            try:
-                async with server.streamlock:
-                    await asyncio.wait_for(response.write(mboxrd_source.encode("utf-8")), timeout=5)
-            except (TimeoutError, RuntimeError, CancelledError):
-                break  # Writing stream failed, break it off.
+        epoch_order="asc",
+        parallel=True,
+    )
+    async with contextlib.aclosing(batches):
+        async for emails in batches:
+            for email in emails:
+                source = await plugins.messages.get_source(session, permalink=email.get("dbid"))
+                mboxrd_source = convert_source(source)
+                # Ensure each non-empty source ends with a blank line
+                if not mboxrd_source.endswith("\n\n"):
+                    mboxrd_source += "\n"
+                try:
+                    async with server.streamlock:
+                        await asyncio.wait_for(response.write(mboxrd_source.encode("utf-8")), timeout=5)
+                except (TimeoutError, RuntimeError, CancelledError):
+                    return response  # Writing stream failed, break it off (and stop scanning).
     return response
 
 
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Endpoint that exports the server's metrics in the Prometheus text format, for admins and scrapers"""
+
+import hmac
+import typing
+
+import aiohttp.web
+
+import plugins.database
+import plugins.metrics
+import plugins.server
+import plugins.session
+
+
+def render_requests(out: plugins.metrics.Exposition, server: plugins.server.BaseServer) -> None:
+    registry = plugins.metrics.registry
+    requests = sorted(registry.requests.items())
+    out.family("ponymail_http_requests_total", "counter", "API requests answered, by endpoint and status")
+    for (endpoint, status), histogram in requests:
+        out.sample("ponymail_http_requests_total", {"endpoint": endpoint, "status": str(status)}, histogram.count)
+    out.family("ponymail_http_request_duration_seconds", "histogram", "Time taken to answer API requests")
+    for (endpoint, status), histogram in requests:
+        out.histogram("ponymail_http_request_duration_seconds", {"endpoint": endpoint, "status": str(status)}, histogram)
+
+    limiters = sorted(server.limiters.items())
+    out.family("ponymail_limiter_active", "gauge", "Requests running, for endpoints with a concurrency limit")
+    for endpoint, limiter in limiters:
+        out.sample("ponymail_limiter_active", {"endpoint": endpoint}, limiter.active)
+    out.family("ponymail_limiter_waiting", "gauge", "Requests queued, for endpoints with a concurrency limit")
+    for endpoint, limiter in limiters:
+        out.sample("ponymail_limiter_waiting", {"endpoint": endpoint}, limiter.waiting)
+
+
+def render_database(out: plugins.metrics.Exposition, server: plugins.server.BaseServer) -> None:
+    registry = plugins.metrics.registry
+    transport = typing.cast(plugins.database.LimitedTransport, server.database.client.transport)
+    out.family("ponymail_db_pool_size", "gauge", "Database requests allowed to run at once")
+    out.sample("ponymail_db_pool_size", {}, transport.max_concurrency)
+    out.family("ponymail_db_pool_active", "gauge", "Database requests running")
+    out.sample("ponymail_db_pool_active", {}, transport.active)
+    out.family("ponymail_db_pool_wait_seconds", "histogram", "Time database requests waited for a free slot")
+    out.histogram("ponymail_db_pool_wait_seconds", {}, registry.pool_wait)
+
+    methods = sorted(registry.database.items())
+    out.family("ponymail_db_request_duration_seconds", "histogram", "Wall time of database requests, by method")
+    for method, stats in methods:
+        out.histogram("ponymail_db_request_duration_seconds", {"method": method}, stats.wall)
+    out.family("ponymail_db_took_seconds_total", "counter", "Time Elasticsearch reported spending on requests, by method")
+    for method, stats in methods:
+        out.sample("ponymail_db_took_seconds_total", {"method": method}, stats.took)
+    out.family("ponymail_db_errors_total", "counter", "Database requests that failed, by method")
+    for method, stats in methods:
+        out.sample("ponymail_db_errors_total", {"method": method}, stats.errors)
+
+
+def render_offloading(out: plugins.metrics.Exposition, server: plugins.server.BaseServer) -> None:
+    registry = plugins.metrics.registry
+    out.family("ponymail_offloader_queue_depth", "gauge", "Tasks waiting for an offloader thread")
+    out.sample("ponymail_offloader_queue_depth", {}, server.runners.queue_depth())
+
+    caches = [(name, cache()) for name, cache in sorted(registry.caches.items())]
+    caches = [(name, cache) for name, cache in caches if cache is not None]
+    out.family("ponymail_cache_hits_total", "counter", "Cache lookups that found an entry")
+    for name, cache in caches:
+        out.sample("ponymail_cache_hits_total", {"cache": name}, cache.hits)
+    out.family("ponymail_cache_misses_total", "counter", "Cache lookups that found nothing")
+    for name, cache in caches:
+        out.sample("ponymail_cache_misses_total", {"cache": name}, cache.misses)
+    out.family("ponymail_cache_hit_ratio", "gauge", "Share of cache lookups that found an entry since startup")
+    for name, cache in caches:
+        lookups = cache.hits + cache.misses
+        out.sample("ponymail_cache_hit_ratio", {"cache": name}, cache.hits / lookups if lookups else 0.0)
+
+
+def render(server: plugins.server.BaseServer) -> str:
+    out = plugins.metrics.Exposition()
+    render_requests(out, server)
+    render_database(out, server)
+    render_offloading(out, server)
+    return out.text()
+
+
+async def process(
+    server: plugins.server.BaseServer,
+    request: aiohttp.web.BaseRequest,
+    session: plugins.session.SessionObject,
+    _indata: dict,
+) -> aiohttp.web.Response:
+    token = server.config.metrics.token
+    authorization = request.headers.get("Authorization", "")
+    authorized = bool(token) and hmac.compare_digest(authorization.encode(), f"Bearer {token}".encode())
+    if not authorized and not (session.credentials and session.credentials.admin):
+        return aiohttp.web.Response(headers={}, status=403, text="You need administrative access to use this feature.")
+    return aiohttp.web.Response(
+        headers={"Content-Type": plugins.metrics.CONTENT_TYPE}, status=200, text=render(server)
+    )
+
+
+def register(_server: plugins.server.BaseServer):
+    # A StreamingEndpoint, as scrapers authenticate with a header rather than a session
+    return plugins.server.StreamingEndpoint(process)
@@ -21,6 +21,7 @@ import plugins.server
 import plugins.session
 import plugins.messages
 import plugins.auditlog
+import plugins.attachments
 import re
 import typing
 import aiohttp.web
@@ -126,19 +127,7 @@ async def process(
         delcount = 0
         for doc in docs:
             assert isinstance(doc, str), "Attachment ID must be a string"
-            attachment = None
-            try:
-                assert session.database, "Database not connected!"
-                attachment = await session.database.get(
-                    index=session.database.dbs.db_attachment, id=doc
-                )
-            except plugins.database.DBError:
-                pass  # attachment not found
-
-            if attachment and isinstance(attachment, dict):
-                await session.database.delete(
-                    index=session.database.dbs.db_attachment, id=attachment["_id"], refresh='wait_for',
-                )
+            if await plugins.attachments.remove_attachment(session, doc):
                 lid = "<system>"
                 await plugins.auditlog.add_entry(session, action="delatt", target=doc, lid=lid, log=f"Removed attachment {doc} from the archives")
                 delcount += 1
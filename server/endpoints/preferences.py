@@ -16,11 +16,11 @@
 # limitations under the License.
 
 import plugins.server
-import plugins.aaa
+import plugins.catalogue
 import plugins.session
 import aiohttp.web
+import json
 import typing
-import fnmatch
 
 """
 Generic preferences endpoint for Pony Mail codename Foal
@@ -28,6 +28,8 @@ Generic preferences endpoint for Pony Mail codename Foal
 This is incomplete, but will work for anonymous tests.
 """
 
+LISTS_PLACEHOLDER = "<lists>"
+
 
 async def process(
     server: plugins.server.BaseServer, session: plugins.session.SessionObject, indata: dict
@@ -52,24 +54,6 @@ async def process(
         prefs['oauth'] = { provider:{ k:v for k,v in entry.items() if not k.startswith('.')} 
                   for provider,entry in server.config.oauth.providers.items()}
         return prefs
-    lists: dict = {}
-    for ml, entry in server.data.lists.items():
-        if "@" in ml:
-            lname, ldomain = ml.split("@", 1)
-            can_access = True
-            if entry.get("private", True):
-                can_access = plugins.aaa.can_access_list(session, ml)
-            if server.config.ui.focus_domain != "*":
-                if '*' in server.config.ui.focus_domain:
-                    if not fnmatch.fnmatch(ldomain, server.config.ui.focus_domain):
-                        continue
-                elif ldomain != (server.config.ui.focus_domain or session.host):
-                    continue
-            if can_access:
-                if ldomain not in lists:
-                    lists[ldomain] = {}
-                lists[ldomain][lname] = entry["count"]
-    prefs["lists"] = lists
     if session and session.credentials:
         prefs["login"] = {
             "credentials": {
@@ -88,9 +72,8 @@ async def process(
         # Remove session from ElasticSearch
         await plugins.session.remove_session(session)
 
-        # If stored in memory, remove from there.
-        if session.cookie in server.data.sessions:
-            del server.data.sessions[session.cookie]
+        # If stored in memory, remove from there, and from any other workers
+        plugins.session.forget_session(server, session.cookie)
         session.credentials = None
         return aiohttp.web.Response(
             headers={
@@ -101,7 +84,18 @@ async def process(
             text='{"okay": true}',
         )
 
-    return prefs
+    # The list tree is serialised once per refresh by the background task. It goes in as a
+    # placeholder, which is then swapped for it; being the last key, its value is the last string.
+    catalogue = server.data.catalogue
+    if catalogue is None:  # Not refreshed yet
+        catalogue = plugins.catalogue.ListCatalogue(server.data.lists, server.config.ui.focus_domain)
+    prefs["lists"] = LISTS_PLACEHOLDER
+    before, _, after = json.dumps(prefs, indent=2).rpartition(json.dumps(LISTS_PLACEHOLDER))
+    return aiohttp.web.Response(
+        headers={"content-type": "application/json"},
+        status=200,
+        text=before + catalogue.render(session) + after,
+    )
 
 
 def register(_server: plugins.server.BaseServer):
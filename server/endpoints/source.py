@@ -20,12 +20,13 @@
 import plugins.server
 import plugins.session
 import plugins.messages
+import plugins.httpcache
 import aiohttp.web
 import plugins.aaa
 
 
 async def process(
-    _server: plugins.server.BaseServer, session: plugins.session.SessionObject, indata: dict,
+    server: plugins.server.BaseServer, session: plugins.session.SessionObject, indata: dict,
 ) -> aiohttp.web.Response:
 
     # Has a list id been provided?
@@ -33,15 +34,26 @@ async def process(
 
     # lookup by message id must always include a list id for disambiguation
     if listid:
-        email = await plugins.messages.get_email(session, messageid=indata.get("id"), listid=listid)
+        email, version = await plugins.messages.get_email_versioned(
+            session, messageid=indata.get("id"), listid=listid
+        )
     else: # Else assume permalink and look up the email based on that
-        email = await plugins.messages.get_email(session, permalink=indata.get("id"))
+        email, version = await plugins.messages.get_email_versioned(session, permalink=indata.get("id"))
 
     if email:
+        headers = {"Content-Type": "text/plain"}
+        if version:
+            # Sources are only ever edited along with their email, so the email's version will do
+            max_age = server.config.http_cache.email_max_age
+            etag = plugins.httpcache.make_etag("source", plugins.httpcache.viewer(session), version)
+            not_modified = plugins.httpcache.not_modified(session, etag, max_age)
+            if not_modified:
+                return not_modified
+            headers.update(plugins.httpcache.cache_headers(session, etag, max_age))
         source = await plugins.messages.get_source(session, permalink=email["dbid"])
         if source:
             return aiohttp.web.Response(
-                headers={"Content-Type": "text/plain"}, status=200, text=source["_source"]["source"],
+                headers=headers, status=200, text=source["_source"]["source"],
             )
     return aiohttp.web.Response(headers={}, status=404, text="Email not found")
 
@@ -25,12 +25,41 @@ import plugins.server
 import plugins.session
 import plugins.messages
 import plugins.defuzzer
+import plugins.httpcache
 import plugins.offloader
+import plugins.tracing
+import base64
 import email.utils
+import json
 import typing
 import aiohttp.web
 import time
 
+MAX_PAGE_SIZE = 1000  # Largest number of email summaries returned per page in paginated mode
+# Fields needed for the thread structure and participants when the emails themselves are paginated
+THREAD_FIELDS = ["epoch", "from", "gravatar", "in-reply-to", "list_raw", "message-id", "mid", "subject"]
+
+
+def encode_cursor(search_after: typing.Optional[list]) -> typing.Optional[str]:
+    """Turns the sort values of the last email on a page into an opaque cursor for the next page"""
+    if search_after is None:
+        return None
+    return base64.urlsafe_b64encode(json.dumps(search_after).encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> list:
+    """Turns a cursor back into sort values (epoch, mid), raising ValueError if it is not one of ours"""
+    search_after = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    if (
+        not isinstance(search_after, list)
+        or len(search_after) != 2
+        or not isinstance(search_after[0], int)
+        or not isinstance(search_after[1], str)
+    ):
+        raise ValueError("Invalid cursor")
+    return search_after
+
+
 async def process(
     server: plugins.server.BaseServer, session: plugins.session.SessionObject, indata: dict,
 ) -> typing.Union[dict, aiohttp.web.Response]:
@@ -42,8 +71,9 @@ async def process(
         return aiohttp.web.Response(headers={"content-type": "application/json",}, text='{}')
 
     try:
-        query_defuzzed = plugins.defuzzer.defuzz(indata)
-        query_defuzzed_nodate = plugins.defuzzer.defuzz(indata, nodate=True)
+        with plugins.tracing.span("defuzz"):
+            query_defuzzed = plugins.defuzzer.defuzz(indata)
+            query_defuzzed_nodate = plugins.defuzzer.defuzz(indata, nodate=True)
     except ValueError as ve:  # If defuzzer encounters syntax errors, it will throw a ValueError
         return aiohttp.web.Response(headers={"content-type": "text/plain",}, status=400, text=str(ve))
     except AssertionError as ae:  # If defuzzer encounters internal errors, it will throw an AssertionError
@@ -51,7 +81,8 @@ async def process(
     
     # get a filter for use with get_activity_span (no date)
     # It can also be used with dated queries
-    query_filter = await plugins.messages.get_accessible_filter(session, query_defuzzed_nodate)
+    with plugins.tracing.span("accessible_filter"):
+        query_filter = await plugins.messages.get_accessible_filter(session, query_defuzzed_nodate)
     if query_filter:
         query_defuzzed['filter'] = query_filter
         query_defuzzed_nodate['filter'] = query_filter
@@ -65,12 +96,30 @@ async def process(
             epoch = int(time.time())
         query_since = query_defuzzed.copy()
         query_since['must'].append({"range" : { "epoch": { "gt": epoch}}})
-        results = await plugins.messages.query(
-            session, query_since, query_limit=1, source_fields=[] # don't need any fields
-        )
+        with plugins.tracing.span("since"):
+            results = await plugins.messages.query(
+                session, query_since, query_limit=1, source_fields=[] # don't need any fields
+            )
         if len(results) == 0:
             return {"changed" : False}
 
+    # The response depends on every email of the list(s), not just those in the date range, as it includes
+    # the activity span, and on which emails the date range takes in, which can change with the time of day.
+    # If none of that changed since the client's copy, there is nothing else to do. The tag is worked out
+    # the same way whether or not the client sent one, so that the first revalidation can match.
+    etag = None
+    max_age = server.config.http_cache.max_age
+    with plugins.tracing.span("watermark"):
+        watermark = await plugins.messages.get_watermark(session, query_defuzzed_nodate, query_defuzzed)
+    if watermark:
+        etag = plugins.httpcache.make_etag(
+            "stats", plugins.httpcache.viewer(session), json.dumps(indata, sort_keys=True),
+            server.config.ui.wordcloud, watermark,
+        )
+        not_modified = plugins.httpcache.not_modified(session, etag, max_age)
+        if not_modified:
+            return not_modified
+
     # statsOnly: Whether to only send statistical info (for n-grams etc), and not the
     # thread struct and message bodies
     # Param: quick
@@ -83,21 +132,51 @@ async def process(
     if statsOnly:
         source_fields = ['epoch']
 
-    results = await plugins.messages.query(
-        session, query_defuzzed, query_limit=server.config.database.max_hits, source_fields=source_fields
-    )
+    # pagesize: return the email summaries a page at a time, oldest first.
+    # The first page also carries the thread structure and aggregates, and a cursor for the next page;
+    # pages requested with a cursor only carry email summaries and the cursor for the page after.
+    page = None
+    next_cursor = None
+    if indata.get("pagesize") and not statsOnly:
+        try:
+            page_size = max(1, min(int(indata["pagesize"]), MAX_PAGE_SIZE))
+            search_after = decode_cursor(indata["cursor"]) if indata.get("cursor") else None
+        except (ValueError, TypeError) as e:
+            return aiohttp.web.Response(headers={"content-type": "text/plain",}, status=400, text=str(e))
+        with plugins.tracing.span("page"):
+            page, next_after = await plugins.messages.query_page(session, query_defuzzed, page_size, search_after)
+            for msg in page:
+                plugins.messages.trim_email(msg, external=True)
+        next_cursor = encode_cursor(next_after)
+        if search_after:
+            return await plugins.httpcache.json_response(server, session, {
+                "emails": page,
+                "cursor": next_cursor,
+                "searchParams": indata,
+                "unixtime": int(time.time()),
+            }, max_age, etag)
+        # Only the fields needed for the thread structure, the emails themselves are in the page
+        source_fields = THREAD_FIELDS
+
+    with plugins.tracing.span("query"):
+        results = await plugins.messages.query(
+            session, query_defuzzed, query_limit=server.config.database.max_hits, source_fields=source_fields
+        )
 
     wordcloud = None
     if server.config.ui.wordcloud and not emailsOnly and not statsOnly:
-        wordcloud = await plugins.messages.wordcloud(session, query_defuzzed)
-    oldest, youngest, active_months = await plugins.messages.get_activity_span(session, query_defuzzed_nodate)
+        with plugins.tracing.span("wordcloud"):
+            wordcloud = await plugins.messages.wordcloud(session, query_defuzzed)
+    with plugins.tracing.span("activity_span"):
+        oldest, youngest, active_months = await plugins.messages.get_activity_span(session, query_defuzzed_nodate)
 
     authors = {}
     tstruct = {}
     top10_authors = None
     if not statsOnly and not emailsOnly:
         threads = plugins.messages.ThreadConstructor(results)
-        tstruct, authors = await server.runners.run(threads.construct)
+        with plugins.tracing.span("threads"):
+            tstruct, authors = await server.runners.run(threads.construct)
 
         # author entries are now [count, gravatar]
         # as we cannot reconstruct the correct gravatar from an anonymised address
@@ -109,14 +188,16 @@ async def process(
                 {"email": address, "name": name, "count": data[0], "gravatar": data[1]}
             )
 
-    # Trim email data so as to reduce download sizes
-    for msg in results:
-        if statsOnly:
-            for header in list(msg.keys()):
-                if not header == 'epoch':
-                    del msg[header]
-        else:
-            plugins.messages.trim_email(msg, external=True)
+    # Trim email data so as to reduce download sizes (paged emails were trimmed already)
+    if page is None:
+        with plugins.tracing.span("trim"):
+            for msg in results:
+                if statsOnly:
+                    for header in list(msg.keys()):
+                        if not header == 'epoch':
+                            del msg[header]
+                else:
+                    plugins.messages.trim_email(msg, external=True)
 
     output = {
         "firstYear": oldest.year,
@@ -127,7 +208,7 @@ async def process(
         "hits": len(results),
         "numparts": len(authors),
         "no_threads": len(tstruct),
-        "emails": list(sorted(results, key=lambda x: x["epoch"])),
+        "emails": page if page is not None else list(sorted(results, key=lambda x: x["epoch"])),
         "participants": top10_authors or {},
         "searchlist": f"<{xlist}.{xdomain}>",
         "domain": xdomain,
@@ -140,7 +221,9 @@ async def process(
         output['thread_struct'] = tstruct
     if wordcloud:
         output['cloud'] = wordcloud
-    return output
+    if page is not None:
+        output['cursor'] = next_cursor
+    return await plugins.httpcache.json_response(server, session, output, max_age, etag)
 
 
 def register(_server: plugins.server.BaseServer):
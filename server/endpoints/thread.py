@@ -20,12 +20,14 @@
 import plugins.server
 import plugins.session
 import plugins.messages
+import plugins.httpcache
+import aiohttp.web
 import typing
 
 
 async def process(
-    _server: plugins.server.BaseServer, session: plugins.session.SessionObject, indata: dict,
-) -> typing.Optional[dict]:
+    server: plugins.server.BaseServer, session: plugins.session.SessionObject, indata: dict,
+) -> typing.Union[None, dict, aiohttp.web.Response]:
     mailid = indata.get("id", "")
     listid = indata.get("listid", "")
 
@@ -51,10 +53,10 @@ async def process(
     for email in emails:
         assert isinstance(email, dict) # ensure mypy is happy with next line; TODO improve?
         plugins.messages.trim_email(email, external=True)
-    return {
-        "thread": email,
-        "emails": emails,
-    }
+    # A thread changes whenever a reply comes in, so its tag comes from the response itself
+    return await plugins.httpcache.json_response(
+        server, session, {"thread": email, "emails": emails}, server.config.http_cache.max_age
+    )
 
 
 def register(_server: plugins.server.BaseServer):
@@ -0,0 +1,49 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Endpoint that shows where the time of traced requests went, for admins"""
+
+import typing
+
+import aiohttp.web
+
+import plugins.server
+import plugins.session
+
+
+async def process(
+    server: plugins.server.BaseServer, session: plugins.session.SessionObject, indata: dict
+) -> typing.Union[dict, aiohttp.web.Response]:
+    if not session.credentials or not session.credentials.admin:
+        return aiohttp.web.Response(headers={}, status=403, text="You need administrative access to use this feature.")
+    request_id = indata.get("id")
+    if request_id:
+        trace = server.tracer.get(request_id)
+        if trace is None:
+            return aiohttp.web.Response(headers={}, status=404, text="No such trace, it may have expired.")
+        return trace.as_dict()
+    # Without an ID, list the recent traces, newest first
+    recent = []
+    for trace in reversed(server.tracer.traces.values()):
+        summary = trace.as_dict()
+        del summary["spans"]
+        recent.append(summary)
+    return {"traces": recent}
+
+
+def register(_server: plugins.server.BaseServer):
+    return plugins.server.Endpoint(process)
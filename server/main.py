@@ -22,7 +22,9 @@ import asyncio
 import importlib
 import json
 import os
+import signal
 import sys
+import time
 import traceback
 import typing
 
@@ -34,9 +36,13 @@ import plugins.background
 import plugins.configuration
 import plugins.database
 import plugins.formdata
+import plugins.limiter
+import plugins.metrics
 import plugins.offloader
 import plugins.server
 import plugins.session
+import plugins.supervisor
+import plugins.tracing
 
 from server_version import PONYMAIL_SERVER_VERSION
 PONYMAIL_FOAL_VERSION = "0.1.0"
@@ -65,7 +71,7 @@ class Server(plugins.server.BaseServer):
                         f"Could not find entry point 'register()' in {endpoint_file}, skipping!"
                     )
 
-    def __init__(self, args: argparse.Namespace):
+    def __init__(self, args: argparse.Namespace, link: typing.Optional[plugins.supervisor.WorkerLink] = None):
         print(
             "==== Apache Pony Mail (Foal v/%s ~%s) starting... ====" % (PONYMAIL_FOAL_VERSION, PONYMAIL_SERVER_VERSION)
         )
@@ -74,7 +80,6 @@ class Server(plugins.server.BaseServer):
         self.config = plugins.configuration.Configuration(yml)
         self.data = plugins.configuration.InterData()
         self.handlers = dict()
-        self.dbpool = asyncio.Queue()
         self.runners = plugins.offloader.ExecutorPool()
         self.server = None
         self.streamlock = asyncio.Lock()
@@ -83,13 +88,20 @@ class Server(plugins.server.BaseServer):
         self.server_version = PONYMAIL_SERVER_VERSION
         self.stoppable = False # allow remote stop for tests
         self.background_event = asyncio.Event() # for background task to wait on
+        self.link = link # to the supervisor, if we are one of several workers
+        self.cleanups = [] # registered by endpoints, see cleanup()
 
-        # Make a pool of database connections for async queries
-        pool_size = self.config.database.pool_size
-        if pool_size < 1:
-            raise ValueError(f"pool_size {pool_size} must be > 0")
-        for _ in range(0, pool_size): # stop value is exclusive
-            self.dbpool.put_nowait(plugins.database.Database(self.config.database))
+        # One database client for all async queries; it limits how many run at once (pool_size)
+        self.database = plugins.database.Database(self.config.database)
+
+        # Per-endpoint concurrency limits, see the limits section of ponymail.yaml
+        self.limiters = {
+            endpoint: plugins.limiter.EndpointLimiter(concurrency, queue, self.config.limits.queue_timeout)
+            for endpoint, (concurrency, queue) in self.config.limits.endpoints.items()
+        }
+
+        # Samples requests for tracing, and keeps the latest traces, see the tracing section of ponymail.yaml
+        self.tracer = plugins.tracing.Tracer(self.config.tracing)
 
         # Load each URL endpoint
         if args.testendpoints:
@@ -120,6 +132,7 @@ class Server(plugins.server.BaseServer):
         self, request: aiohttp.web.BaseRequest
     ) -> typing.Union[aiohttp.web.Response, aiohttp.web.StreamResponse]:
         """Generic handler for all incoming HTTP requests"""
+        start = time.perf_counter()
 
         # Define response headers first...
         headers = {
@@ -164,82 +177,151 @@ class Server(plugins.server.BaseServer):
 
         # Find a handler, or 404
         if handler in self.handlers:
-            session = await plugins.session.get_session(self, request)
+            # Give the request a deadline, which every database query made on its behalf must meet.
+            # Streaming endpoints are exempt, as they may legitimately take a long time.
+            # Each request is handled in its own task, so this is not seen by other requests.
+            if self.config.server.request_timeout and not isinstance(
+                self.handlers[handler], plugins.server.StreamingEndpoint
+            ):
+                plugins.database.request_deadline.set(
+                    asyncio.get_running_loop().time() + self.config.server.request_timeout
+                )
+            trace = self.tracer.start(handler, request.path_qs)
+            session = None
+            if not trace and request.headers.get("X-Pony-Trace") == "1":
+                # Only admins may ask for a trace, so their session is needed before the endpoint runs
+                session = await plugins.session.get_session(self, request)
+                if session.credentials and session.credentials.admin:
+                    trace = self.tracer.start(handler, request.path_qs, forced=True)
+            if trace:
+                headers["X-Request-Id"] = trace.request_id
+            # Turn the request away quickly if the endpoint is already as busy as we allow
+            limiter = self.limiters.get(handler)
+            if limiter:
+                with plugins.tracing.span("queue"):
+                    acquired = await limiter.acquire()
+                if not acquired:
+                    headers["Retry-After"] = str(self.config.limits.retry_after)
+                    plugins.metrics.registry.observe_request(handler, 503, time.perf_counter() - start)
+                    if trace:
+                        self.tracer.finish(trace, 503)
+                    return aiohttp.web.Response(
+                        headers=headers, status=503, text="Server is busy, please try again later.\n"
+                    )
+            status = 499  # Unless we get to answer, the client went away
             try:
-                # Wait for endpoint response. This is typically JSON in case of success,
-                # but could be an exception (that needs a traceback) OR
-                # it could be a custom response, which we just pass along to the client.
-                xhandler = self.handlers[handler]
+                response = await self.run_handler(handler, request, indata, headers, session)
+                if trace and not response.prepared:
+                    # Send the response ourselves, so the time it takes is part of the trace
+                    with plugins.tracing.span("write"):
+                        await response.prepare(request)
+                        await response.write_eof()
+                status = response.status
+                return response
+            except Exception:
+                status = 500
+                raise
+            finally:
+                if limiter:
+                    limiter.release()
+                plugins.metrics.registry.observe_request(handler, status, time.perf_counter() - start)
+                if trace:
+                    self.tracer.finish(trace, status)
+        else:
+            return aiohttp.web.Response(
+                headers=headers, status=404, text="API Endpoint not found!"
+            )
+
+    async def run_handler(
+        self,
+        handler: str,
+        request: aiohttp.web.BaseRequest,
+        indata: dict,
+        headers: dict,
+        session: typing.Optional[plugins.session.SessionObject] = None,
+    ) -> typing.Union[aiohttp.web.Response, aiohttp.web.StreamResponse]:
+        """Runs an endpoint and turns its output into a response, loading the session unless it is given"""
+        if session is None:
+            with plugins.tracing.span("session"):
+                session = await plugins.session.get_session(self, request)
+        try:
+            # Wait for endpoint response. This is typically JSON in case of success,
+            # but could be an exception (that needs a traceback) OR
+            # it could be a custom response, which we just pass along to the client.
+            xhandler = self.handlers[handler]
+            with plugins.tracing.span("endpoint"):
                 if isinstance(xhandler, plugins.server.StreamingEndpoint):
                     output = await xhandler.exec(self, request, session, indata)
                 elif isinstance(xhandler, plugins.server.Endpoint):
                     output = await xhandler.exec(self, session, indata)
-                if session.database:
-                    self.dbpool.put_nowait(session.database)
-                    self.dbpool.task_done()
-                    session.database = None
-                if isinstance(output, aiohttp.web.Response) or isinstance(output, aiohttp.web.StreamResponse):
-                    return output
-                if output:
+            if isinstance(output, aiohttp.web.Response) or isinstance(output, aiohttp.web.StreamResponse):
+                return output
+            if output:
+                with plugins.tracing.span("json"):
                     jsout = await self.runners.run(json.dumps, output, indent=2)
-                    headers["content-type"] = "application/json"
-                    headers["Content-Length"] = str(len(jsout))
-                    return aiohttp.web.Response(headers=headers, status=200, text=jsout)
-                return aiohttp.web.Response(
-                    headers=headers, status=404, text="Content not found"
-                )
-            # If a handler hit an exception, we need to print that exception somewhere,
-            # either to the web client or stderr:
-            except Exception: # TODO: narrow exception
-                if session.database:
-                    self.dbpool.put_nowait(session.database)
-                    self.dbpool.task_done()
-                    session.database = None
-                exc_type, exc_value, exc_traceback = sys.exc_info()
-                err = "\n".join(
-                    traceback.format_exception(exc_type, exc_value, exc_traceback)
-                )
-                # By default, we print the traceback to the user, for easy debugging.
-                if self.config.ui.traceback:
-                    return aiohttp.web.Response(
-                        headers=headers, status=500, text="API error occurred: \n" + err
-                    )
-                # If client traceback is disabled, we print it to stderr instead, but leave an
-                # error ID for the client to report back to the admin. Every line of the traceback
-                # will have this error ID at the beginning of the line, for easy grepping.
-                # We only need a short ID here, let's pick 18 chars.
-                eid = str(uuid.uuid4())[:18]
-                sys.stderr.write("API Endpoint %s got into trouble (%s): \n" % (request.path, eid))
-                for line in err.split("\n"):
-                    sys.stderr.write("%s: %s\n" % (eid, line))
+                headers["content-type"] = "application/json"
+                headers["Content-Length"] = str(len(jsout))
+                return aiohttp.web.Response(headers=headers, status=200, text=jsout)
+            return aiohttp.web.Response(
+                headers=headers, status=404, text="Content not found"
+            )
+        except plugins.database.Timeout:
+            return aiohttp.web.Response(
+                headers=headers, status=504, text="The request took too long to complete, please try again later.\n"
+            )
+        # If a handler hit an exception, we need to print that exception somewhere,
+        # either to the web client or stderr:
+        except Exception: # TODO: narrow exception
+            exc_type, exc_value, exc_traceback = sys.exc_info()
+            err = "\n".join(
+                traceback.format_exception(exc_type, exc_value, exc_traceback)
+            )
+            # By default, we print the traceback to the user, for easy debugging.
+            if self.config.ui.traceback:
                 return aiohttp.web.Response(
-                    headers=headers, status=500, text="API error occurred. The application journal will have "
-                                                      "information. Error ID: %s" % eid
+                    headers=headers, status=500, text="API error occurred: \n" + err
                 )
-        else:
+            # If client traceback is disabled, we print it to stderr instead, but leave an
+            # error ID for the client to report back to the admin. Every line of the traceback
+            # will have this error ID at the beginning of the line, for easy grepping.
+            # We only need a short ID here, let's pick 18 chars.
+            eid = str(uuid.uuid4())[:18]
+            sys.stderr.write("API Endpoint %s got into trouble (%s): \n" % (request.path, eid))
+            for line in err.split("\n"):
+                sys.stderr.write("%s: %s\n" % (eid, line))
             return aiohttp.web.Response(
-                headers=headers, status=404, text="API Endpoint not found!"
+                headers=headers, status=500, text="API error occurred. The application journal will have "
+                                                  "information. Error ID: %s" % eid
             )
 
     async def server_loop(self):
-        self.server = aiohttp.web.Server(self.handle_request)
+        # Cancel handlers whose client has gone away, so their database queries do not hold on to capacity
+        self.server = aiohttp.web.Server(self.handle_request, handler_cancellation=True)
         runner = aiohttp.web.ServerRunner(self.server)
         await runner.setup()
+        # Workers all bind the same port, and the kernel spreads connections between them
         site = aiohttp.web.TCPSite(
-            runner, self.config.server.ip, self.config.server.port
+            runner, self.config.server.ip, self.config.server.port, reuse_port=bool(self.link)
         )
         await site.start()
         print(
             "==== Serving up Pony goodness at %s:%s ===="
             % (self.config.server.ip, self.config.server.port)
         )
-        await plugins.background.run_tasks(self)
+        if self.link:
+            # The supervisor does the background refresh for all workers, and sends us the results
+            self.link.listen(self)
+            asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.background_event.set)
+            await self.background_event.wait()
+        else:
+            await plugins.background.run_tasks(self)
         await self.cleanup()
         await site.stop() # try to clean up
 
     async def cleanup(self):
-        while not self.dbpool.empty():
-            await self.dbpool.get_nowait().client.close()
+        for cleanup in self.cleanups:
+            await cleanup()
+        await self.database.client.close()
 
     def run(self):
         # get_event_loop is deprecated in 3.10, but the replacment new_event_loop
@@ -257,6 +339,11 @@ class Server(plugins.server.BaseServer):
         loop.close()
 
 
+def run_worker(args: argparse.Namespace, link: plugins.supervisor.WorkerLink):
+    """Entry point of the worker processes started by the supervisor"""
+    Server(args, link).run()
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -291,5 +378,16 @@ if __name__ == "__main__":
         action='store_true',
         help="Enable test endpoints",
     )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        help="Number of server processes to run (default: server.workers in the configuration, or 1)",
+    )
     cliargs = parser.parse_args()
-    Server(cliargs).run()
+    workers = cliargs.workers
+    if workers is None:
+        workers = plugins.configuration.Configuration(yaml.safe_load(open(cliargs.config))).server.workers
+    if workers > 1:
+        plugins.supervisor.Supervisor(cliargs.config, workers, run_worker, cliargs).run()
+    else:
+        Server(cliargs).run()
@@ -38,3 +38,13 @@ def can_access_list(session: plugins.session.SessionObject, _listid: Optional[st
     if session.credentials and session.credentials.authoritative:
         return True
     return False
+
+def list_access_level(session: plugins.session.SessionObject) -> Optional[str]:
+    """
+    Determine which precomputed list catalogue view the current user gets: "public" for public lists only,
+    "all" for every list. This must agree with can_access_list; if access is decided per list instead,
+    return None and the catalogue will call can_access_list for each private list.
+    """
+    if session.credentials and session.credentials.authoritative:
+        return "all"
+    return "public"
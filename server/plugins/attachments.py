@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+This is the attachment storage library for Pony Mail codename Foal
+Attachments are keyed by their SHA-256 digest and live either base64-encoded
+in the -attachment index, or as raw files in a sharded directory.
+The directory layout must be the same as tools/plugins/blobstore.py; test/test_blobstore.py checks it is
+"""
+
+import base64
+import os
+import re
+import typing
+
+import plugins.database
+import plugins.session
+
+DATABASE_NOT_CONNECTED = "Database not connected!"
+DIGEST_RE = re.compile(r"^[a-f0-9]{64}$")  # SHA-256 hex digest; anything else must not touch the file system
+
+
+def blob_path(root: str, digest: str) -> typing.Optional[str]:
+    """Returns the on-disk path of an attachment, or None if the digest is not valid"""
+    if not DIGEST_RE.match(digest):
+        return None
+    return os.path.join(root, digest[0:2], digest[2:4], digest)
+
+
+def _read_blob(filepath: str) -> typing.Optional[bytes]:
+    try:
+        with open(filepath, "rb") as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
+
+
+def _unlink_blob(filepath: str) -> bool:
+    try:
+        os.unlink(filepath)
+        return True
+    except FileNotFoundError:
+        return False
+
+
+async def get_attachment(session: plugins.session.SessionObject, digest: str) -> typing.Optional[bytes]:
+    """Fetches the contents of an attachment, or None if not found"""
+    config = session.server.config.attachments
+    if config.backend == "disk":
+        filepath = blob_path(config.path, digest)
+        if not filepath:
+            return None
+        return await session.server.runners.run(_read_blob, filepath)
+    assert session.database, DATABASE_NOT_CONNECTED
+    try:
+        attachment = await session.database.get(index=session.database.dbs.db_attachment, id=digest)
+    except plugins.database.Timeout:  # Out of time, which is not the same as not found
+        raise
+    except plugins.database.DBError:
+        return None  # attachment not found
+    if attachment:
+        return base64.decodebytes(attachment["_source"].get("source").encode("utf-8"))
+    return None
+
+
+async def remove_attachment(session: plugins.session.SessionObject, digest: str) -> bool:
+    """Removes an attachment from the archives, returns False if it was not found"""
+    config = session.server.config.attachments
+    if config.backend == "disk":
+        filepath = blob_path(config.path, digest)
+        if not filepath:
+            return False
+        return await session.server.runners.run(_unlink_blob, filepath)
+    assert session.database, DATABASE_NOT_CONNECTED
+    try:
+        await session.database.delete(
+            index=session.database.dbs.db_attachment, id=digest, refresh='wait_for',
+        )
+    except plugins.database.Timeout:  # Out of time, which is not the same as not found
+        raise
+    except plugins.database.DBError:
+        return False  # attachment not found
+    return True
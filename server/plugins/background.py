@@ -22,11 +22,12 @@ import datetime
 import re
 import sys
 import time
+import typing
 
 from elasticsearch_dsl import Search
 from elasticsearch import VERSION as ES_VERSION
 
-import plugins.configuration
+import plugins.catalogue
 import plugins.server
 import plugins.database
 
@@ -51,16 +52,15 @@ class ProgTimer:
         print("Done in %.2f seconds" % (time.time() - self.start))
 
 
-async def get_lists(database: plugins.configuration.DBConfig) -> dict:
+async def get_lists(db: plugins.database.Database) -> dict:
     """
 
-    :param database: a Pony Mail database configuration
+    :param db: the Pony Mail database
     :return: A dictionary of all mailing lists found, and whether they are considered
              public or private
     """
     lists = {}
-    db = plugins.database.Database(database)
-    limit = database.max_lists
+    limit = db.config.max_lists
 
     # Fetch aggregations of all private emails
     # Do this first, so mixed lists are not marked private
@@ -111,18 +111,15 @@ async def get_lists(database: plugins.configuration.DBConfig) -> dict:
         if list_name in lists:
             lists[list_name]["count"] = ml["doc_count"]
 
-    await db.client.close()
-
     return lists
 
 
-async def get_public_activity(database: plugins.configuration.DBConfig) -> dict:
+async def get_public_activity(db: plugins.database.Database) -> dict:
     """
 
-    :param database: a PyPony database configuration
+    :param db: the PyPony database
     :return: A dictionary with activity stats
     """
-    db = plugins.database.Database(database)
 
     # Fetch aggregations of all public emails
     s = (
@@ -158,7 +155,7 @@ async def get_public_activity(database: plugins.configuration.DBConfig) -> dict:
         .query("match", private=False)
         .filter("range", date={"lt": "now+1d", "gt": "now-14d"})
     )
-    async for docs in db.scan(
+    async for docs in db.parallel_scan(
         index=db.dbs.db_mbox,
         query=s.to_dict(),
         _source_includes=[
@@ -196,8 +193,6 @@ async def get_public_activity(database: plugins.configuration.DBConfig) -> dict:
                     seen_topics.append(subject)
                     thread_count += 1
 
-    await db.client.close()
-
     activity = {
         "hits": no_emails,
         "no_threads": thread_count,
@@ -215,35 +210,42 @@ async def get_data(server: plugins.server.BaseServer):
     """
     async with ProgTimer("Gathering list of archived mailing lists"):
         try:
-            server.data.lists = await get_lists(server.config.database)
+            lists = await get_lists(server.database)
+            server.data.catalogue = await server.runners.run(
+                plugins.catalogue.ListCatalogue, lists, server.config.ui.focus_domain
+            )
+            server.data.lists = lists
             print(f"Found {len(server.data.lists)} lists")
         except plugins.database.DBError as e:
             print("Could not fetch lists - database down or not connected: %s" % e)
     async with ProgTimer("Gathering bi-weekly activity stats"):
         try:
-            server.data.activity = await get_public_activity(server.config.database)
+            server.data.activity = await get_public_activity(server.database)
         except plugins.database.DBError as e:
             print(
                 "Could not fetch activity data - database down or not connected: %s"
                 % e
             )
 
-async def run_tasks(server: plugins.server.BaseServer) -> None:
+async def run_tasks(
+    server: plugins.server.BaseServer, refreshed: typing.Optional[typing.Callable[[], None]] = None
+) -> None:
     """
         Runs long-lived background data gathering tasks such as gathering statistics about email activity and the list
         of archived mailing lists, for populating the pony mail main index.
 
         Generally runs every 2½ minutes, or whatever is set in tasks/refresh_rate in ponymail.yaml
+        If given, refreshed is called after each round, so the supervisor can pass the data on to its workers.
     """
 
     # Initial setup
     server.library_version = ".".join([str(v) for v in ES_VERSION])
-    db = plugins.database.Database(server.config.database)
-    server.engine_version = (await db.info())['version']['number']
-    await db.client.close()
+    server.engine_version = (await server.database.info())['version']['number']
 
     while True:
         await get_data(server)
+        if refreshed:
+            refreshed()
         try:
             await asyncio.wait_for(server.background_event.wait(), timeout=server.config.tasks.refresh_rate)
             break # if the event is set, then we have been asked to stop
@@ -0,0 +1,241 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Caching helpers for Pony Mail codename Foal"""
+
+import asyncio
+import collections
+import os
+import re
+import tempfile
+import threading
+import time
+import typing
+
+HEX_KEY_RE = re.compile(r"^[a-f0-9]+$")  # Disk cache keys are hex digests, so they are always safe file names
+
+
+class LRUCache:
+    """A least-recently-used cache of byte strings, bounded by their total size. All operations are O(1)"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.entries: collections.OrderedDict[str, bytes] = collections.OrderedDict()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: str) -> typing.Optional[bytes]:
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_bytes:
+            return  # Would evict everything else and still not fit
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = value
+        self.size += len(value)
+        while self.size > self.max_bytes:
+            _key, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+
+    def remove(self, key: str) -> None:
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.size -= len(old)
+
+
+class NegativeCache:
+    """Remembers keys that are known to have no value, for a limited time"""
+
+    def __init__(self, ttl: int, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.entries: collections.OrderedDict[str, float] = collections.OrderedDict()
+
+    def __contains__(self, key: str) -> bool:
+        expires = self.entries.get(key)
+        if expires is None:
+            return False
+        if expires < time.time():
+            del self.entries[key]
+            return False
+        return True
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def add(self, key: str) -> None:
+        self.entries.pop(key, None)
+        self.entries[key] = time.time() + self.ttl
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)  # Oldest entry expires first anyway
+
+    def discard(self, key: str) -> None:
+        self.entries.pop(key, None)
+
+
+class SingleFlight:
+    """Runs at most one instance of a coroutine per key at a time; concurrent callers share its result"""
+
+    def __init__(self) -> None:
+        self.inflight: typing.Dict[str, asyncio.Future] = {}
+
+    async def run(self, key: str, func: typing.Callable[[], typing.Awaitable]) -> typing.Any:
+        future = self.inflight.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func())
+            self.inflight[key] = future
+            future.add_done_callback(lambda _f: self.inflight.pop(key, None))
+        # Shield the shared task, so one caller going away does not cancel it for everyone else
+        return await asyncio.shield(future)
+
+
+class DiskCache:
+    """
+    A directory of byte strings keyed by hex digest, for caches that should survive a restart.
+    Entries expire ttl seconds after they were stored, and the oldest entries are evicted
+    once the total size exceeds max_bytes. Methods block on file I/O, so run them in an offloader.
+    """
+
+    def __init__(self, root: str, ttl: int, max_bytes: int):
+        self.root = root
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        self.entries: collections.OrderedDict[str, int] = collections.OrderedDict()  # key -> size, oldest first
+        os.makedirs(root, exist_ok=True)
+        self.load()
+
+    def path(self, key: str) -> str:
+        if not HEX_KEY_RE.match(key):
+            raise ValueError("Invalid cache key: %r" % key)
+        return os.path.join(self.root, key[0:2], key)
+
+    def load(self) -> None:
+        """Indexes what is already on disk, oldest first, dropping anything that has expired"""
+        found = []
+        expired = time.time() - self.ttl
+        for dirpath, _dirnames, filenames in os.walk(self.root):
+            for filename in filenames:
+                filepath = os.path.join(dirpath, filename)
+                if filename.startswith(".tmp-"):
+                    os.unlink(filepath)  # Left over from an interrupted write
+                    continue
+                if not HEX_KEY_RE.match(filename):
+                    continue
+                stat = os.stat(filepath)
+                if stat.st_mtime < expired:
+                    os.unlink(filepath)
+                    continue
+                found.append((stat.st_mtime, filename, stat.st_size))
+        with self.lock:
+            for _mtime, key, size in sorted(found):
+                self.entries[key] = size
+                self.size += size
+        self.evict()
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def get(self, key: str) -> typing.Optional[bytes]:
+        value = self.read(key)
+        with self.lock:  # Lookups run in several offloader threads at once
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def read(self, key: str) -> typing.Optional[bytes]:
+        if key not in self.entries:
+            return None
+        filepath = self.path(key)
+        try:
+            if os.stat(filepath).st_mtime + self.ttl < time.time():
+                self.remove(key)
+                return None
+            with open(filepath, "rb") as f:
+                return f.read()
+        except FileNotFoundError:  # Removed behind our back
+            self.remove(key)
+            return None
+
+    def put(self, key: str, value: bytes) -> None:
+        if len(value) > self.max_bytes:
+            return
+        filepath = self.path(key)
+        dirname = os.path.dirname(filepath)
+        os.makedirs(dirname, exist_ok=True)
+        # Write to a temporary file and rename it into place, so readers never see a partial entry
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(value)
+            os.replace(tmpname, filepath)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.size -= old
+            self.entries[key] = len(value)
+            self.size += len(value)
+        self.evict()
+
+    def remove(self, key: str) -> None:
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is None:
+                return
+            self.size -= old
+        try:
+            os.unlink(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def evict(self) -> None:
+        while True:
+            with self.lock:
+                if self.size <= self.max_bytes or not self.entries:
+                    return
+                key, size = self.entries.popitem(last=False)
+                self.size -= size
+            try:
+                os.unlink(self.path(key))
+            except FileNotFoundError:
+                pass
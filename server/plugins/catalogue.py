@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+List catalogue for Pony Mail codename Foal.
+Every UI page starts with a call to preferences.lua, which returns the tree of lists the user may see.
+The tree only changes when the background task refreshes the list of lists, so all the views of it
+are built and serialised once per refresh, and requests just pick the right one.
+"""
+
+import fnmatch
+import json
+import typing
+
+import plugins.aaa
+import plugins.session
+
+ACCESS_LEVELS = ("public", "all")  # See plugins.aaa.list_access_level
+
+
+class ListCatalogue:
+    """Precomputed per-domain, per-access-level views of server.data.lists"""
+
+    def __init__(self, lists: dict, focus_domain: str):
+        self.focus_domain = focus_domain
+        # The view only depends on the Host header if there is no fixed focus domain
+        self.per_host = not focus_domain
+        self.public: typing.Dict[str, typing.Dict[str, int]] = {}  # domain -> list name -> recent activity
+        self.private: typing.Dict[str, typing.Dict[str, int]] = {}
+        for ml, entry in lists.items():
+            if "@" not in ml:
+                continue
+            lname, ldomain = ml.split("@", 1)
+            if not self.in_focus(ldomain):
+                continue
+            tree = self.private if entry.get("private", True) else self.public
+            tree.setdefault(ldomain, {})[lname] = entry["count"]
+
+        self.views: typing.Dict[typing.Tuple[str, str], str] = {}  # (domain or "", access level) -> JSON
+        scopes = sorted(set(self.public) | set(self.private)) if self.per_host else [""]
+        for scope in scopes:
+            for level in ACCESS_LEVELS:
+                self.views[(scope, level)] = json.dumps(self.tree(scope, level == "all"))
+
+    def in_focus(self, ldomain: str) -> bool:
+        """Whether a domain is shown at all, regardless of who is asking"""
+        if self.focus_domain == "*" or self.per_host:
+            return True
+        if "*" in self.focus_domain:
+            return fnmatch.fnmatch(ldomain, self.focus_domain)
+        return ldomain == self.focus_domain
+
+    def tree(self, scope: str, private: bool) -> dict:
+        """Builds the domain -> list name -> count tree for a scope ("" meaning every domain in focus)"""
+        lists: dict = {}
+        sources = (self.public, self.private) if private else (self.public,)
+        for source in sources:
+            for ldomain, entries in source.items():
+                if scope and ldomain != scope:
+                    continue
+                lists.setdefault(ldomain, {}).update(entries)
+        return lists
+
+    def render(self, session: plugins.session.SessionObject) -> str:
+        """Returns the JSON list tree this session may see"""
+        scope = session.host if self.per_host else ""
+        level = plugins.aaa.list_access_level(session)
+        if level is not None:
+            return self.views.get((scope, level), "{}")
+        # Access is decided per list, so only the public part can be shared
+        lists = self.tree(scope, False)
+        for ldomain, entries in self.private.items():
+            if scope and ldomain != scope:
+                continue
+            for lname, count in entries.items():
+                if plugins.aaa.can_access_list(session, f"{lname}@{ldomain}"):
+                    lists.setdefault(ldomain, {})[lname] = count
+        return json.dumps(lists)
@@ -17,13 +17,27 @@
 # specific language governing permissions and limitations
 # under the License.
 
+import typing
+
+if typing.TYPE_CHECKING:
+    import plugins.catalogue
+
+
 class ServerConfig:
     port: int
     ip: str
+    request_timeout: float
+    workers: int
 
     def __init__(self, subyaml: dict):
         self.ip = subyaml.get("bind", "0.0.0.0")
         self.port = int(subyaml.get("port", 8080))
+        # Seconds an API request may take before its database queries are abandoned; 0 means no limit
+        self.request_timeout = float(subyaml.get("request_timeout", 30))
+        # Number of server processes sharing the port; more than one runs them under a supervisor
+        self.workers = int(subyaml.get("workers", 1))
+        if self.workers < 1:
+            raise ValueError(f"server: workers {self.workers} must be > 0")
 
 
 class TaskConfig:
@@ -84,6 +98,11 @@ class DBConfig:
     max_hits: int
     max_lists: int
     pool_size: int
+    max_connections: int
+    keepalive: int
+    timeout: int
+    scan_method: str
+    scan_slices: int
 
     def __init__(self, subyaml: dict):
         self.dburl = str(subyaml.get("dburl", ""))
@@ -94,7 +113,101 @@ class DBConfig:
         self.db_prefix = str(subyaml.get("db_prefix", "ponymail"))
         self.max_hits = int(subyaml.get("max_hits", 5000))
         self.max_lists = int(subyaml.get("max_lists", 8192))
+        # Maximum number of database requests in flight at once, shared by all API requests
         self.pool_size = int(subyaml.get("pool_size", 15))
+        if self.pool_size < 1:
+            raise ValueError(f"database: pool_size {self.pool_size} must be > 0")
+        # Connections to keep open per database node, idle time before they are closed, and request timeout
+        self.max_connections = int(subyaml.get("max_connections", self.pool_size))
+        self.keepalive = int(subyaml.get("keepalive", 60))
+        self.timeout = int(subyaml.get("timeout", 10))
+        # How to page through large result sets: "pit" (point in time + search_after) or "scroll"
+        self.scan_method = str(subyaml.get("scan_method", "pit"))
+        if self.scan_method not in ("pit", "scroll"):
+            raise ValueError(f"database: unknown scan_method '{self.scan_method}'")
+        # Number of slices to read at once for mbox exports and background tasks
+        self.scan_slices = int(subyaml.get("scan_slices", 3))
+
+
+class AttachmentConfig:
+    backend: str
+    path: str
+
+    def __init__(self, subyaml: dict):
+        # Either "elastic" (base64 in the -attachment index) or "disk" (sharded directory)
+        self.backend = str(subyaml.get("backend", "elastic"))
+        self.path = str(subyaml.get("path", ""))
+        if self.backend not in ("elastic", "disk"):
+            raise ValueError(f"attachments: unknown backend '{self.backend}'")
+        if self.backend == "disk" and not self.path:
+            raise ValueError("attachments: the disk backend requires a path to be set")
+
+
+class GravatarConfig:
+    cache_dir: str
+    cache_ttl: int
+    cache_max_bytes: int
+
+    def __init__(self, subyaml: dict):
+        # Directory for the persistent second-tier cache. Empty means in-memory only.
+        self.cache_dir = str(subyaml.get("cache_dir", ""))
+        self.cache_ttl = int(subyaml.get("cache_ttl", 86400 * 7))  # Refetch from upstream after a week
+        self.cache_max_bytes = int(subyaml.get("cache_max_bytes", 256 * 1024 * 1024))
+
+
+class LimitsConfig:
+    retry_after: int
+    queue_timeout: float
+    endpoints: typing.Dict[str, typing.Tuple[int, int]]
+
+    def __init__(self, subyaml: dict):
+        # Seconds clients are asked to wait before retrying when an endpoint is too busy
+        self.retry_after = int(subyaml.get("retry_after", 5))
+        self.queue_timeout = float(subyaml.get("queue_timeout", 30))
+        # endpoint -> (max requests running at once, max requests waiting), e.g. mbox: {concurrency: 2, queue: 4}
+        self.endpoints = {}
+        for endpoint, limit in (subyaml.get("endpoints") or {}).items():
+            concurrency = int(limit.get("concurrency", 0))
+            if concurrency < 1:
+                raise ValueError(f"limits: concurrency for {endpoint} must be > 0")
+            self.endpoints[endpoint] = (concurrency, int(limit.get("queue", 0)))
+
+
+class MetricsConfig:
+    token: str
+
+    def __init__(self, subyaml: dict):
+        # Bearer token that lets a scraper read /api/metrics without an admin session; empty means admins only
+        self.token = str(subyaml.get("token", ""))
+
+
+class TracingConfig:
+    enabled: bool
+    sample_rate: float
+    slow_threshold: float
+    history: int
+
+    def __init__(self, subyaml: dict):
+        self.enabled = bool(subyaml.get("enabled", False))
+        # Share of requests traced; admins can also ask for a trace with an X-Pony-Trace: 1 header
+        self.sample_rate = float(subyaml.get("sample_rate", 0.01))
+        if not 0 <= self.sample_rate <= 1:
+            raise ValueError("tracing: sample_rate must be between 0 and 1")
+        # Traced requests taking at least this many seconds have their spans written to stderr; 0 disables this
+        self.slow_threshold = float(subyaml.get("slow_threshold", 5))
+        # Number of recent traces kept for admins to look up
+        self.history = int(subyaml.get("history", 200))
+
+
+class HttpCacheConfig:
+    email_max_age: int
+    max_age: int
+
+    def __init__(self, subyaml: dict):
+        # Seconds browsers and proxies may reuse emails and sources without checking back, and
+        # thread and stats responses; after that they revalidate with the ETag
+        self.email_max_age = int(subyaml.get("email_max_age", 300))
+        self.max_age = int(subyaml.get("max_age", 0))
 
 
 class Configuration:
@@ -103,6 +216,12 @@ class Configuration:
     tasks: TaskConfig
     oauth: OAuthConfig
     ui: UIConfig
+    attachments: AttachmentConfig
+    gravatar: GravatarConfig
+    limits: LimitsConfig
+    metrics: MetricsConfig
+    tracing: TracingConfig
+    http_cache: HttpCacheConfig
 
     def __init__(self, yml: dict):
         self.server = ServerConfig(yml.get("server", {}))
@@ -110,6 +229,12 @@ class Configuration:
         self.tasks = TaskConfig(yml.get("tasks", {}))
         self.oauth = OAuthConfig(yml.get("oauth", {}))
         self.ui = UIConfig(yml.get("ui", {}))
+        self.attachments = AttachmentConfig(yml.get("attachments", {}))
+        self.gravatar = GravatarConfig(yml.get("gravatar", {}))
+        self.limits = LimitsConfig(yml.get("limits", {}))
+        self.metrics = MetricsConfig(yml.get("metrics", {}))
+        self.tracing = TracingConfig(yml.get("tracing", {}))
+        self.http_cache = HttpCacheConfig(yml.get("http_cache", {}))
 
 
 class InterData:
@@ -120,8 +245,10 @@ class InterData:
     lists: dict
     sessions: dict
     activity: dict
+    catalogue: typing.Optional["plugins.catalogue.ListCatalogue"]  # Rebuilt whenever lists is refreshed
 
     def __init__(self):
         self.lists = {}
         self.sessions = {}
         self.activity = {}
+        self.catalogue = None
@@ -19,12 +19,23 @@
 This is the Database library stub for Pony Mail codename Foal
 """
 
+import asyncio
+import contextlib
+import contextvars
+import heapq
+import itertools
+import json
+import time
 import uuid
 import typing
+import aiohttp
 import elasticsearch
 import elasticsearch.exceptions
+from elasticsearch._async.http_aiohttp import AIOHttpConnection, ESClientResponse # type: ignore[attr-defined]
 
 import plugins.configuration
+import plugins.metrics
+import plugins.tracing
 
 
 class Timeout (elasticsearch.exceptions.ConnectionTimeout):
@@ -44,19 +55,226 @@ class DBNames:
 
 DBError = elasticsearch.ElasticsearchException
 
+# Event loop time by which the API request being handled must be answered, if it has a deadline.
+# Set once per request by the server; every database request made on its behalf is cut short when it passes.
+request_deadline: contextvars.ContextVar[typing.Optional[float]] = contextvars.ContextVar(
+    "request_deadline", default=None
+)
+
+
+@contextlib.contextmanager
+def no_deadline() -> typing.Iterator[None]:
+    """Lets cleanup requests, such as closing a scroll, through even if the request deadline has passed"""
+    token = request_deadline.set(None)
+    try:
+        yield
+    finally:
+        request_deadline.reset(token)
+
+# Point in time scans size their pages to fetch roughly this much data per request
+PIT_TARGET_PAGE_BYTES = 8 * 1024 * 1024
+PIT_MIN_PAGE_SIZE = 100
+PIT_MAX_PAGE_SIZE = 10000  # index.max_result_window defaults to 10,000
+PIT_SAMPLE_HITS = 10  # Number of hits per page to measure
+PIT_MIN_VERSION = (7, 12)  # Elasticsearch version that can sort on _shard_doc
+SLICE_QUEUE_PAGES = 2  # Pages each slice of a parallel scan may read ahead of the consumer
+
+
+class TunedConnection(AIOHttpConnection):
+    """An AIOHttpConnection that also lets us set how long idle connections are kept open"""
+
+    def __init__(self, *args, keepalive_timeout: float = 60, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.keepalive_timeout = keepalive_timeout
+
+    async def _create_aiohttp_session(self):
+        # Same as AIOHttpConnection._create_aiohttp_session, apart from the keep-alive timeout
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        self.session = aiohttp.ClientSession(
+            headers=self.headers,
+            skip_auto_headers=("accept", "accept-encoding"),
+            auto_decompress=True,
+            loop=self.loop,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            response_class=ESClientResponse,
+            connector=aiohttp.TCPConnector(
+                limit=self._limit,
+                keepalive_timeout=self.keepalive_timeout,
+                use_dns_cache=True,
+                ssl=self._ssl_context,
+            ),
+        )
+
+
+class LimitedTransport(elasticsearch.AsyncTransport):
+    """
+    An AsyncTransport that lets at most max_concurrency requests run at once.
+    Every request made through the client, including elasticsearch_dsl searches, waits its turn here,
+    so a burst of API calls queues for a free slot instead of piling more work onto the database.
+    Requests made while handling an API request also give up, waiting or not, once its deadline passes.
+    """
+
+    def __init__(self, hosts, *args, max_concurrency: int = 15, **kwargs):
+        super().__init__(hosts, *args, **kwargs)
+        self.max_concurrency = max_concurrency
+        self.limiter = asyncio.Semaphore(max_concurrency)
+        self.active = 0
+
+    async def perform_request(self, method, url, headers=None, params=None, body=None):
+        deadline = request_deadline.get()
+        if deadline is None:
+            return await self.limited_request(method, url, headers, params, body)
+        remaining = deadline - asyncio.get_running_loop().time()
+        try:
+            return await asyncio.wait_for(self.limited_request(method, url, headers, params, body), remaining)
+        except asyncio.TimeoutError as e:
+            raise Timeout("N/A", "Request deadline exceeded", e)
+
+    async def limited_request(self, method, url, headers, params, body):
+        start = time.perf_counter()
+        with plugins.tracing.span("db.pool_wait"):
+            await self.limiter.acquire()
+        plugins.metrics.registry.pool_wait.observe(time.perf_counter() - start)
+        self.active += 1
+        try:
+            return await super().perform_request(method, url, headers=headers, params=params, body=body)
+        finally:
+            self.active -= 1
+            self.limiter.release()
+
+
+async def timed(method: str, request: typing.Awaitable) -> typing.Any:
+    """Awaits a database request, recording its wall time and the time Elasticsearch reports it took"""
+    start = time.perf_counter()
+    try:
+        with plugins.tracing.span("db." + method):
+            res = await request
+    except Exception:
+        plugins.metrics.registry.observe_db(method, time.perf_counter() - start, None, failed=True)
+        raise
+    took = res.get("took") if isinstance(res, dict) else None
+    plugins.metrics.registry.observe_db(method, time.perf_counter() - start, took)
+    return res
+
+
+class Descending:
+    """Inverts the ordering of a sort value, so descending sorts can be merged with heapq"""
+    __slots__ = ("value",)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+
+def sort_orders(query: typing.Optional[dict]) -> typing.List[bool]:
+    """Returns whether each sort field of a query is descending"""
+    sort = (query or {}).get("sort") or []
+    if not isinstance(sort, list):
+        sort = [sort]
+    orders = []
+    for clause in sort:
+        order = "asc"
+        if isinstance(clause, dict):
+            spec = next(iter(clause.values()))
+            order = spec.get("order", "asc") if isinstance(spec, dict) else spec
+        orders.append(order == "desc")
+    return orders
+
+
+async def pump_slice(pages: typing.AsyncGenerator[typing.List[dict], None], queue: asyncio.Queue) -> None:
+    """Feeds the pages of one slice into a queue, then None, or the exception that stopped it"""
+    try:
+        async with contextlib.aclosing(pages):
+            async for hits in pages:
+                await queue.put(hits)
+    except Exception as e: # pylint: disable=broad-except
+        await queue.put(e)  # Raised again by the reader
+        return
+    await queue.put(None)
+
+
+async def next_page(queue: asyncio.Queue) -> typing.Optional[typing.List[dict]]:
+    page = await queue.get()
+    if isinstance(page, BaseException):
+        raise page
+    return page
+
+
+async def interleave_slices(queue: asyncio.Queue, slices: int) -> typing.AsyncGenerator[typing.List[dict], None]:
+    """Yields pages from all slices as they arrive"""
+    done = 0
+    while done < slices:
+        page = await next_page(queue)
+        if page is None:
+            done += 1
+        else:
+            yield page
+
+
+async def merge_slices(
+    queues: typing.List[asyncio.Queue], orders: typing.List[bool], size: int
+) -> typing.AsyncGenerator[typing.List[dict], None]:
+    """K-way merge of sorted slices on the sort values of their hits, yielding pages of up to size hits"""
+
+    def key(hit):
+        # Elasticsearch may add a tiebreaker to the sort values, which is ascending
+        return [
+            Descending(value) if descending else value
+            for value, descending in zip(hit["sort"], itertools.chain(orders, itertools.repeat(False)))
+        ]
+
+    heap = []
+    for i, queue in enumerate(queues):
+        page = await next_page(queue)
+        if page:
+            heap.append((key(page[0]), i, 0, page))
+    heapq.heapify(heap)
+    merged: typing.List[dict] = []
+    while heap:
+        _key, i, pos, page = heapq.heappop(heap)
+        merged.append(page[pos])
+        if len(merged) >= size:
+            yield merged
+            merged = []
+        pos += 1
+        if pos == len(page):
+            page, pos = await next_page(queues[i]), 0
+        if page:
+            heapq.heappush(heap, (key(page[pos]), i, pos, page))
+    if merged:
+        yield merged
+
 
 class Database:
     client: elasticsearch.AsyncElasticsearch
     config: plugins.configuration.DBConfig
     dbs: DBNames
     uuid: str
+    pit_supported: typing.ClassVar[bool] = True  # Cleared for all connections the first time opening one fails
+    pit_version_checked: typing.ClassVar[bool] = False
 
     def __init__(self, config: plugins.configuration.DBConfig):
         self.config = config
         self.uuid = str(uuid.uuid4())
         self.dbs = DBNames(config.db_prefix)
+        # One client is shared by the whole server: it keeps up to max_connections connections
+        # per node open for reuse, and runs up to pool_size requests at a time
+        client_args: typing.Dict[str, typing.Any] = {
+            "transport_class": LimitedTransport,
+            "connection_class": TunedConnection,
+            "max_concurrency": config.pool_size,
+            "maxsize": config.max_connections,
+            "keepalive_timeout": config.keepalive,
+            "timeout": config.timeout,
+        }
         if self.config.dburl:
-            self.client = elasticsearch.AsyncElasticsearch([self.config.dburl, ])
+            self.client = elasticsearch.AsyncElasticsearch([self.config.dburl, ], **client_args)
         else:
             self.client = elasticsearch.AsyncElasticsearch(
                 [
@@ -66,50 +284,53 @@ class Database:
                         "url_prefix": config.url_prefix or "",
                         "use_ssl": config.secure,
                     },
-                ]
+                ],
+                **client_args,
             )
 
     async def search(self, index="", **kwargs):
         if not index:
             index = self.dbs.db_mbox
         try:
-            res = await self.client.search(index=index, **kwargs)
+            res = await timed("search", self.client.search(index=index, **kwargs))
             return res
+        except Timeout:
+            raise
         except elasticsearch.exceptions.ConnectionTimeout as e:
             raise Timeout(e)
 
     async def get(self, index="", **kwargs):
         if not index:
             index = self.dbs.db_mbox
-        res = await self.client.get(index=index, **kwargs)
+        res = await timed("get", self.client.get(index=index, **kwargs))
         return res
 
     async def delete(self, index="", **kwargs):
         if not index:
             index = self.dbs.db_session
-        res = await self.client.delete(index=index, **kwargs)
+        res = await timed("delete", self.client.delete(index=index, **kwargs))
         return res
 
     async def index(self, index="", **kwargs):
         if not index:
             index = self.dbs.db_session
-        res = await self.client.index(index=index, **kwargs)
+        res = await timed("index", self.client.index(index=index, **kwargs))
         return res
 
     async def create(self, index=None, **kwargs):
         """Create a new document (put if missing)"""
-        res = await self.client.create(index=index, **kwargs)
+        res = await timed("create", self.client.create(index=index, **kwargs))
         return res
 
     async def info(self, **kwargs):
         """Get ES info"""
-        res = await self.client.info(**kwargs)
+        res = await timed("info", self.client.info(**kwargs))
         return res
 
     async def update(self, index="", **kwargs):
         if not index:
             index = self.dbs.db_session
-        res = await self.client.update(index=index, **kwargs)
+        res = await timed("update", self.client.update(index=index, **kwargs))
         return res
 
     async def scan(self,
@@ -120,8 +341,173 @@ class Database:
                    request_timeout: int = 60,
                    clear_scroll: bool = True,
                    scroll_kwargs: typing.Optional[dict] = None,
-                   **kwargs) -> typing.AsyncIterator[typing.List[dict]]:
-        
+                   **kwargs) -> typing.AsyncGenerator[typing.List[dict], None]:
+        """
+        Yields all hits for a query, a page at a time. Uses a point in time and search_after
+        if the database supports it and scan_method is "pit", or the scroll API otherwise.
+        Leaving the loop early releases the point in time or scroll context once the iterator is closed.
+        """
+        index = kwargs.pop("index", None) or self.dbs.db_mbox
+        pages = None
+        if self.config.scan_method == "pit" and Database.pit_supported:
+            pit_id = await self.open_pit(index, scroll)  # The scroll timeout doubles as the keep-alive
+            if pit_id:
+                pages = self.pit_scan(
+                    pit_id, query, scroll, preserve_order, size, request_timeout, clear_scroll, **kwargs
+                )
+        if pages is None:
+            pages = self.scroll_scan(
+                query, scroll, preserve_order, size, request_timeout, clear_scroll, scroll_kwargs, index=index, **kwargs
+            )
+        async with contextlib.aclosing(pages):
+            async for hits in pages:
+                yield hits
+
+    async def parallel_scan(self,
+                            query: typing.Optional[dict] = None,
+                            slices: int = 0,
+                            scroll: str = "5m",
+                            preserve_order: bool = False,
+                            size: int = 1000,
+                            request_timeout: int = 60,
+                            **kwargs) -> typing.AsyncGenerator[typing.List[dict], None]:
+        """
+        Like scan, but reads the results as several slices at once and merges them into one stream of pages.
+        Without preserve_order, pages are passed on in whatever order the slices return them. With preserve_order,
+        each slice is sorted by the query, and the slices are merged on the sort values of their hits.
+        The number of slices defaults to scan_slices in the configuration; less than two is a plain scan.
+        """
+        slices = slices or self.config.scan_slices
+        orders = sort_orders(query)
+        if preserve_order and not orders:
+            preserve_order = False  # Nothing to preserve
+        if slices < 2:
+            pages = self.scan(
+                query=query, scroll=scroll, preserve_order=preserve_order, size=size,
+                request_timeout=request_timeout, **kwargs
+            )
+            async with contextlib.aclosing(pages):
+                async for hits in pages:
+                    yield hits
+            return
+
+        index = kwargs.pop("index", None) or self.dbs.db_mbox
+        pit_id = None
+        if self.config.scan_method == "pit" and Database.pit_supported:
+            pit_id = await self.open_pit(index, scroll)  # All slices share the one point in time
+        # One queue per slice when merging in order, otherwise one shared queue
+        queues: typing.List[asyncio.Queue] = [
+            asyncio.Queue(maxsize=SLICE_QUEUE_PAGES) for _ in range(slices if preserve_order else 1)
+        ]
+        tasks = []
+        for slice_id in range(slices):
+            sliced = dict(query or {})
+            sliced["slice"] = {"id": slice_id, "max": slices}
+            if pit_id:
+                pages = self.pit_scan(pit_id, sliced, scroll, preserve_order, size, request_timeout, False, **kwargs)
+            else:
+                pages = self.scroll_scan(
+                    sliced, scroll, preserve_order, size, request_timeout, True, None, index=index, **kwargs
+                )
+            tasks.append(asyncio.ensure_future(pump_slice(pages, queues[slice_id % len(queues)])))
+        try:
+            if preserve_order:
+                merged = merge_slices(queues, orders, size)
+            else:
+                merged = interleave_slices(queues[0], slices)
+            async with contextlib.aclosing(merged):
+                async for hits in merged:
+                    yield hits
+        finally:
+            # Stop any slices still running, letting them clear their scroll contexts, then release the point in time
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            if pit_id:
+                with no_deadline():
+                    await self.client.close_point_in_time(body={"id": pit_id}, ignore=(404,)) # pylint: disable=unexpected-keyword-arg
+
+    async def open_pit(self, index: str, keep_alive: str) -> typing.Optional[str]:
+        """Opens a point in time, or returns None if the database does not support them"""
+        if not Database.pit_version_checked:
+            version = (await self.client.info())["version"]
+            number = tuple(int(part) for part in version["number"].split("-")[0].split(".")[:2])
+            Database.pit_version_checked = True  # Only once it is known, so a failed check is tried again
+            # Points in time came with 7.10, but sorting on _shard_doc, and the tiebreaker search_after
+            # relies on, only with 7.12. OpenSearch answers with its own version numbers.
+            if version.get("distribution") != "opensearch" and number < PIT_MIN_VERSION:
+                print("Point in time searches need Elasticsearch 7.12 or later, scrolling instead")
+                Database.pit_supported = False
+                return None
+        try:
+            resp = await self.client.open_point_in_time(index=index, keep_alive=keep_alive) # pylint: disable=unexpected-keyword-arg
+        except elasticsearch.exceptions.ConnectionError:
+            raise
+        except elasticsearch.exceptions.TransportError as e:
+            if e.status_code in (400, 404, 405):  # Unknown endpoint, e.g. OpenSearch or Elasticsearch < 7.10
+                print("Point in time searches not supported by the database, scrolling instead: %s" % e)
+                Database.pit_supported = False
+                return None
+            raise
+        return resp["id"]
+
+    async def pit_scan(self,
+                       pit_id: str,
+                       query: typing.Optional[dict],
+                       keep_alive: str,
+                       preserve_order: bool,
+                       size: int,
+                       request_timeout: int,
+                       close_pit: bool,
+                       **kwargs) -> typing.AsyncGenerator[typing.List[dict], None]:
+        body = query.copy() if query else {}
+        if not preserve_order or "sort" not in body:
+            body["sort"] = ["_shard_doc"]  # Cheapest order, and unique within a point in time
+        body["track_total_hits"] = False
+        try:
+            while True:
+                body["pit"] = {"id": pit_id, "keep_alive": keep_alive}
+                try:
+                    resp = await timed("scan", self.client.search( # pylint: disable=unexpected-keyword-arg
+                        body=body, size=size, request_timeout=request_timeout, **kwargs
+                    ))
+                except Timeout:
+                    raise
+                except elasticsearch.exceptions.ConnectionTimeout as e:
+                    raise Timeout(e)
+                pit_id = resp.get("pit_id", pit_id)
+                hits = resp["hits"]["hits"]
+                if not hits:
+                    break
+                yield hits
+                if len(hits) < size:
+                    break
+                # The sort values include the tiebreaker Elasticsearch adds, so no hits are skipped or repeated
+                body["search_after"] = hits[-1]["sort"]
+                size = self.pit_page_size(hits)
+        finally:
+            if close_pit:
+                with no_deadline():
+                    await self.client.close_point_in_time(body={"id": pit_id}, ignore=(404,)) # pylint: disable=unexpected-keyword-arg
+
+    @staticmethod
+    def pit_page_size(hits: typing.List[dict]) -> int:
+        """Works out how many hits like these fit into PIT_TARGET_PAGE_BYTES"""
+        step = max(1, len(hits) // PIT_SAMPLE_HITS)
+        sample = hits[::step][:PIT_SAMPLE_HITS]
+        average = sum(len(json.dumps(hit.get("_source", {}))) for hit in sample) / len(sample)
+        return max(PIT_MIN_PAGE_SIZE, min(PIT_MAX_PAGE_SIZE, int(PIT_TARGET_PAGE_BYTES / max(average, 1))))
+
+    async def scroll_scan(self,
+                          query: typing.Optional[dict],
+                          scroll: str,
+                          preserve_order: bool,
+                          size: int,
+                          request_timeout: int,
+                          clear_scroll: bool,
+                          scroll_kwargs: typing.Optional[dict],
+                          **kwargs) -> typing.AsyncGenerator[typing.List[dict], None]:
+
         scroll_kwargs = scroll_kwargs or {}
 
         if not preserve_order:
@@ -129,22 +515,28 @@ class Database:
             query["sort"] = "_doc"
 
         # Do the search
-        resp = await self.search(
-            body=query, scroll=scroll, size=size, request_timeout=request_timeout, **kwargs
-        )
+        try:
+            resp = await timed("scan", self.client.search( # pylint: disable=unexpected-keyword-arg
+                body=query, scroll=scroll, size=size, request_timeout=request_timeout, **kwargs
+            ))
+        except Timeout:
+            raise
+        except elasticsearch.exceptions.ConnectionTimeout as e:
+            raise Timeout(e)
         scroll_id = resp.get("_scroll_id")
 
         # While we can scroll, fetch a page
         try:
             while scroll_id and resp["hits"]["hits"]:
                 yield resp["hits"]["hits"]
-                resp = await self.client.scroll(
+                resp = await timed("scan", self.client.scroll(
                     body={"scroll_id": scroll_id, "scroll": scroll}, **scroll_kwargs
-                )
+                ))
                 scroll_id = resp.get("_scroll_id")
 
         # Shut down and clear scroll once done
         finally:
             if scroll_id and clear_scroll:
                 # ignore is a valid keyword!
-                await self.client.clear_scroll(body={"scroll_id": [scroll_id]}, ignore=(404,)) # pylint: disable=unexpected-keyword-arg
+                with no_deadline():
+                    await self.client.clear_scroll(body={"scroll_id": [scroll_id]}, ignore=(404,)) # pylint: disable=unexpected-keyword-arg
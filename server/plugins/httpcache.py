@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+ETag and Cache-Control handling for Pony Mail codename Foal.
+Endpoints work out an entity tag for their response as cheaply as they can, and answer
+304 Not Modified without doing the rest of the work if the client already has that version.
+"""
+
+import hashlib
+import json
+import typing
+
+import aiohttp.web
+
+import plugins.server
+import plugins.session
+import plugins.tracing
+
+IMMUTABLE_MAX_AGE = 31536000  # Content addressed responses never change, so they can be kept for a year
+
+
+def make_etag(*parts: typing.Any) -> str:
+    """A strong entity tag for a response that only depends on these parts"""
+    digest = hashlib.sha256("\x00".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+    return f'"{digest[:32]}"'
+
+
+def viewer(session: plugins.session.SessionObject) -> str:
+    """Who a response is for: documents are anonymised for visitors, and private lists depend on the account"""
+    if not session.credentials:
+        return "anonymous"
+    return "%s:%s:%s" % (session.credentials.oauth_provider, session.credentials.uid, session.credentials.admin)
+
+
+def cache_headers(session: plugins.session.SessionObject, etag: str, max_age: int, immutable: bool = False) -> dict:
+    # Responses for logged in users may hold private mail, so only their own browser may keep them
+    scope = "private" if session.credentials else "public"
+    cache_control = f"{scope}, max-age={max_age}"
+    if immutable:
+        cache_control += ", immutable"
+    return {"ETag": etag, "Cache-Control": cache_control, "Vary": "Cookie"}
+
+
+def matches(session: plugins.session.SessionObject, etag: str) -> bool:
+    """Whether the request's If-None-Match header lists this entity tag (using weak comparison, as RFC 9110 asks)"""
+    for candidate in session.if_none_match.split(","):
+        candidate = candidate.strip()
+        if candidate == "*" or candidate.removeprefix("W/") == etag:
+            return True
+    return False
+
+
+def not_modified(
+    session: plugins.session.SessionObject, etag: str, max_age: int, immutable: bool = False
+) -> typing.Optional[aiohttp.web.Response]:
+    """Returns a 304 response if the client already has this version, or None if the response must be sent"""
+    if matches(session, etag):
+        return aiohttp.web.Response(headers=cache_headers(session, etag, max_age, immutable), status=304)
+    return None
+
+
+async def json_response(
+    server: plugins.server.BaseServer,
+    session: plugins.session.SessionObject,
+    output: dict,
+    max_age: int,
+    etag: typing.Optional[str] = None,
+) -> aiohttp.web.Response:
+    """
+    Encodes a JSON response with caching headers. Without an etag, it is derived from the encoded
+    response, which still saves sending the response again if the client has it already.
+    """
+    with plugins.tracing.span("json"):
+        text = await server.runners.run(json.dumps, output, indent=2)
+    if etag is None:
+        etag = make_etag(viewer(session), text)
+        response = not_modified(session, etag, max_age)
+        if response is not None:
+            return response
+    headers = cache_headers(session, etag, max_age)
+    headers["Content-Type"] = "application/json"
+    return aiohttp.web.Response(headers=headers, status=200, text=text)
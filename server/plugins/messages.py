@@ -24,6 +24,7 @@ pages that need it.
 
 import base64
 import binascii
+import contextlib
 import datetime
 import email.utils
 import hashlib
@@ -36,9 +37,11 @@ import typing
 import plugins.aaa
 import plugins.session
 import plugins.database
+import plugins.tracing
 
 PYPONY_RE_PREFIX = re.compile(r"^([a-zA-Z]+:\s*)+")  # Prefixes on subjects, such as Re: Fwd:, etc.
 DATABASE_NOT_CONNECTED = "Database not connected!"
+watermark_supported = True  # Cleared if the database turns out not to aggregate sequence numbers
 OLD_SHORTENED_ID_LENGTH = 18  # Thread IDs of 18 char length (deprecated) need special care in searches
 NEEDS_QUOTES = re.compile(r'[][\\()<>@,:;".]')  # If these characters are present in an email display name, quote it
 ESCAPES_RE = re.compile(r'[\\"]')  # Characters to escape with backslash in make_address()
@@ -70,6 +73,9 @@ USED_UI_FIELDS = [
 # cc, date, dbid, forum, html_source_only, from_raw, permalinks, references, size, to
 # The body_short contents may replace the body contents, but it is not returned separately
 
+# Limits up to this are fetched with plain searches instead of a scan (the default index.max_result_window)
+MAX_SEARCH_SIZE = 10000
+
 # must always fetch private and deleted
 # list_raw is needed for authentication
 MUST_HAVE = [ 'private', 'deleted', 'list_raw']
@@ -217,6 +223,20 @@ async def get_email(
     """
     Returns a single matching mbox document or None
     """
+    doc, _version = await get_email_versioned(session, permalink, messageid, listid)
+    return doc
+
+
+async def get_email_versioned(
+    session: plugins.session.SessionObject,
+    permalink: typing.Optional[str] = None,
+    messageid: typing.Optional[str] = None,
+    listid: typing.Optional[str] = None,
+) -> typing.Tuple[typing.Optional[dict], typing.Optional[str]]:
+    """
+    Like get_email, but also returns the version of the document: its ID, sequence number and
+    primary term, which change whenever it is updated. Used for ETags.
+    """
     assert session.database, DATABASE_NOT_CONNECTED
     doctype = session.database.dbs.db_mbox
     doc = None
@@ -224,6 +244,8 @@ async def get_email(
         try:
             doc = await session.database.get(index=doctype, id=permalink)
         # Email not found through primary ID, look for other permalinks?
+        except plugins.database.Timeout:  # Out of time, which is not the same as not found
+            raise
         except plugins.database.DBError:
             # If using old shortened hex IDs, regexp for them instead of a direct match
             if len(permalink) == OLD_SHORTENED_ID_LENGTH and re.match(r"^[a-f0-9]+$", permalink):
@@ -235,15 +257,17 @@ async def get_email(
                 index=doctype,
                 size=1,
                 body={
-                    "query": {"bool": {"must": [{matchtype: {"permalinks": permalink}}]}}
+                    "query": {"bool": {"must": [{matchtype: {"permalinks": permalink}}]}},
+                    "seq_no_primary_term": True,
                 },
             )
             if len(res["hits"]["hits"]) == 1:
                 doc = res["hits"]["hits"][0]
     elif messageid:
-        bquery = {"query": {"bool": {"must": [{"term": {"message-id": messageid}}]}}}
+        bquery: dict = {"query": {"bool": {"must": [{"term": {"message-id": messageid}}]}}}
         if listid:  # Specific List ID required?
             bquery = {"query": {"bool": {"must": [{"term": {"message-id": messageid}}, {"term": {"list_raw": listid}}]}}}
+        bquery["seq_no_primary_term"] = True
         res = await session.database.search(
             index=doctype,
             size=1,
@@ -254,20 +278,23 @@ async def get_email(
 
     # Did we find a single doc?
     if doc and isinstance(doc, dict):
+        version = None
+        if doc.get("_seq_no") is not None:
+            version = "%s:%s:%s" % (doc["_id"], doc["_seq_no"], doc.get("_primary_term"))
         doc = doc["_source"]
         doc["id"] = doc["mid"]
         # If deleted by UI, only return if session is admin
         is_admin = session.credentials and session.credentials.admin
         if doc.get("deleted", False) and not is_admin:
-            return None
+            return None, None
         if doc and plugins.aaa.can_access_email(session, doc):
             trim_email(doc)
             if not session.credentials:
                 doc = anonymize(doc)
-            return doc
+            return doc, version
 
     # no doc?
-    return None
+    return None, None
 
 async def get_email_irt(
     session: plugins.session.SessionObject,
@@ -312,6 +339,8 @@ async def get_source(session: plugins.session.SessionObject, permalink: str, raw
     assert session.database, DATABASE_NOT_CONNECTED
     try:
         doc = await session.database.get(index=session.database.dbs.db_source, id=permalink)
+    except plugins.database.Timeout:  # Out of time, which is not the same as not found
+        raise
     except plugins.database.DBError:
         doc = None
     if doc:
@@ -333,71 +362,150 @@ async def get_source(session: plugins.session.SessionObject, permalink: str, raw
     return None
 
 
+def source_filter(metadata_only: bool, source_fields: typing.Optional[typing.List[str]]):
+    """Works out the _source setting for query_batch and query_page"""
+    if metadata_only:  # Only doc IDs and AAA fields.
+        return ["deleted", "private", "mid", "dbid", "list_raw"]
+    if source_fields is not None:
+        temp = source_fields.copy()
+        for hdr in MUST_HAVE:
+            if hdr not in source_fields:
+                temp.append(hdr)
+        return temp
+    return { "excludes": ["body"] }
+
+
+def filter_hits(
+    session: plugins.session.SessionObject,
+    hits: typing.List[dict],
+    metadata_only: bool,
+    source_fields: typing.Optional[typing.List[str]],
+) -> typing.List[dict]:
+    """Turns search hits into email summaries, removing inaccessible mails"""
+    is_admin = session.credentials and session.credentials.admin
+    docs = []
+    for hit in hits:
+        doc = hit["_source"]
+        # If email was delete/hidden and we're not doing an admin query, ignore it
+        if doc.get("deleted", False) and not is_admin:
+            continue
+        if plugins.aaa.can_access_email(session, doc):
+            if "mid" in doc: # might be missing when using source_fields
+                doc["id"] = doc["mid"]
+            # Calculate gravatars if not present in _source
+            wants_gravatar = source_fields is None or "gravatar" in source_fields
+            if not metadata_only and wants_gravatar and "gravatar" not in doc:
+                doc["gravatar"] = gravatar(doc)
+            if not session.credentials:
+                doc = anonymize(doc)
+            if "body_short" in doc:
+                # The body_short field is set to SHORT_BODY_MAX_LEN+1 if the body is longer
+                # than SHORT_BODY_MAX_LEN, so we know if it has been truncated
+                if len(doc["body_short"] or "") > SHORT_BODY_MAX_LEN:
+                    doc["body"] = doc["body_short"][:SHORT_BODY_MAX_LEN] + '...'
+                else:
+                    doc["body"] = doc["body_short"]
+                # stats.py is expecting doc['body'], not body_short
+                del doc["body_short"]
+            trim_email(doc)
+            # drop any added fields
+            if source_fields is not None:
+                for hdr in MUST_HAVE:
+                    if hdr not in source_fields and hdr in doc:
+                        del doc[hdr]
+            docs.append(doc)
+    return docs
+
+
 async def query_batch(
     session: plugins.session.SessionObject,
     query_defuzzed: dict,
     metadata_only: bool = False,
     epoch_order: str = "desc",
-    source_fields: typing.Optional[typing.List[str]] = None
+    source_fields: typing.Optional[typing.List[str]] = None,
+    limit: typing.Optional[int] = None,
+    parallel: bool = False,
 ):
     """
     Advanced query and grab for stats.py
     Also called by mbox.py (using metadata_only=True)
     Yields batches of scan results, filtered to remove inaccessible mails
+    If a limit is given, stops after that many emails, and if it fits into a single search, skips the scan
+    and fetches the newest (or oldest, for epoch_order="asc") emails with plain searches instead.
+    With parallel set, large results are scanned in several slices at once (see Database.parallel_scan).
     """
     assert session.database, DATABASE_NOT_CONNECTED
     preserve_order = True if epoch_order == "asc" else False
     es_query = {
         "query": {"bool": query_defuzzed},
         "sort": [{"epoch": {"order": epoch_order}}],
+        "_source": source_filter(metadata_only, source_fields),
     }
-    if metadata_only:  # Only doc IDs and AAA fields.
-        es_query["_source"] = ["deleted", "private", "mid", "dbid", "list_raw"]
-    elif source_fields is not None:
-        temp = source_fields.copy()
-        for hdr in MUST_HAVE:
-            if hdr not in source_fields:
-                temp.append(hdr)
-        es_query["_source"] = temp
+    if limit is not None and limit <= MAX_SEARCH_SIZE:
+        # mid is unique, so search_after can continue exactly where the previous page ended
+        es_query["sort"] = [{"epoch": {"order": epoch_order}}, {"mid": {"order": epoch_order}}]
+        es_query["track_total_hits"] = False
+        remaining = limit
+        while remaining > 0:
+            res = await session.database.search(body=es_query, size=remaining)
+            hits = res["hits"]["hits"]
+            with plugins.tracing.span("access_filter"):
+                docs = filter_hits(session, hits, metadata_only, source_fields)
+            if len(docs) > 0:
+                yield docs
+            if len(hits) < remaining:  # No more matches
+                break
+            # Only go back for more if some of the emails were not accessible
+            remaining -= len(docs)
+            es_query["search_after"] = hits[-1]["sort"]
+        return
+    yielded = 0
+    if parallel:
+        pages = session.database.parallel_scan(query=es_query, preserve_order=preserve_order)
     else:
-        es_query["_source"] = { "excludes": ["body"] }
-    async for hits in session.database.scan(
-        query=es_query,
-        preserve_order=preserve_order
-    ):
-        is_admin = session.credentials and session.credentials.admin
-        docs = []
-        for hit in hits:
-            doc = hit["_source"]
-            # If email was delete/hidden and we're not doing an admin query, ignore it
-            if doc.get("deleted", False) and not is_admin:
-                continue
-            if plugins.aaa.can_access_email(session, doc):
-                if "mid" in doc: # might be missing when using source_fields
-                    doc["id"] = doc["mid"]
-                # Calculate gravatars if not present in _source
-                if not metadata_only and source_fields is None and "gravatar" not in doc:
-                    doc["gravatar"] = gravatar(doc)
-                if not session.credentials:
-                    doc = anonymize(doc)
-                if "body_short" in doc:
-                    # The body_short field is set to SHORT_BODY_MAX_LEN+1 if the body is longer
-                    # than SHORT_BODY_MAX_LEN, so we know if it has been truncated
-                    if len(doc["body_short"] or "") > SHORT_BODY_MAX_LEN:
-                        doc["body"] = doc["body_short"][:SHORT_BODY_MAX_LEN] + '...'
-                    else:
-                        doc["body"] = doc["body_short"]
-                    # stats.py is expecting doc['body'], not body_short
-                    del doc["body_short"]
-                trim_email(doc)
-                # drop any added fields
-                if source_fields is not None:
-                    for hdr in MUST_HAVE:
-                        if hdr not in source_fields and hdr in doc:
-                            del doc[hdr]
-                docs.append(doc)
-        if len(docs) > 0:
-            yield docs
+        pages = session.database.scan(query=es_query, preserve_order=preserve_order)
+    # Close the scan as soon as we stop early, so the database can release its context
+    async with contextlib.aclosing(pages):
+        async for hits in pages:
+            with plugins.tracing.span("access_filter"):
+                docs = filter_hits(session, hits, metadata_only, source_fields)
+            if limit is not None:
+                docs = docs[:limit - yielded]
+                yielded += len(docs)
+            if len(docs) > 0:
+                yield docs
+            if limit is not None and yielded >= limit:
+                break
+
+
+async def query_page(
+    session: plugins.session.SessionObject,
+    query_defuzzed: dict,
+    page_size: int,
+    search_after: typing.Optional[list] = None,
+    source_fields: typing.Optional[typing.List[str]] = None
+) -> typing.Tuple[typing.List[dict], typing.Optional[list]]:
+    """
+    Fetches one page of emails for stats.py, oldest first.
+    Returns the accessible emails on the page, and the sort values to pass as search_after
+    for the next page, or None if this was the last one.
+    The page can hold fewer than page_size emails if some were filtered out.
+    """
+    assert session.database, DATABASE_NOT_CONNECTED
+    es_query = {
+        "query": {"bool": query_defuzzed},
+        # mid is unique, so no two emails sort the same and none are skipped or repeated between pages
+        "sort": [{"epoch": {"order": "asc"}}, {"mid": {"order": "asc"}}],
+        "_source": source_filter(False, source_fields),
+        "track_total_hits": False,
+    }
+    if search_after:
+        es_query["search_after"] = search_after
+    res = await session.database.search(body=es_query, size=page_size)
+    hits = res["hits"]["hits"]
+    next_after = hits[-1]["sort"] if len(hits) == page_size else None
+    with plugins.tracing.span("access_filter"):
+        return filter_hits(session, hits, False, source_fields), next_after
 
 
 async def query(
@@ -413,21 +521,17 @@ async def query(
     Also called by mbox.py (using metadata_only=True)
     """
     docs = []
-    hits = 0
-    async for batch in query_batch(
+    batches = query_batch(
         session,
         query_defuzzed,
         metadata_only=metadata_only,
         epoch_order=epoch_order,
-        source_fields=source_fields
-    ):
-        for doc in batch:
-            docs.append(doc)
-            hits += 1
-            if hits > query_limit:
-                break
-        if hits > query_limit:
-            break
+        source_fields=source_fields,
+        limit=query_limit,
+    )
+    async with contextlib.aclosing(batches):
+        async for batch in batches:
+            docs.extend(batch)
     return docs
 
 
@@ -529,6 +633,46 @@ async def get_accessible_filter(session: plugins.session.SessionObject, query_de
     return None
 
 
+async def get_watermark(
+    session: plugins.session.SessionObject, query_defuzzed: dict, query_window: typing.Optional[dict] = None
+) -> typing.Optional[str]:
+    """
+    Returns a cheap summary of the emails matching a query, which changes whenever one of them
+    is added, changed or removed: the number of matches, and the sum of their sequence numbers
+    (every write to an email raises its sequence number). Used for ETags.
+    A date range relative to now takes in and lets go of emails without any of them changing, so
+    the number of matches of query_window, and the sum of their epochs, are part of it too.
+    Returns None if the database cannot aggregate sequence numbers.
+    """
+    global watermark_supported  # pylint: disable=global-statement
+    assert session.database, DATABASE_NOT_CONNECTED
+    if not watermark_supported:
+        return None
+    aggs: dict = {"seq_no": {"sum": {"field": "_seq_no"}}}
+    if query_window is not None:
+        aggs["window"] = {"filter": {"bool": query_window}, "aggs": {"epoch": {"sum": {"field": "epoch"}}}}
+    try:
+        res = await session.database.search(
+            index=session.database.dbs.db_mbox,
+            size=0,
+            body={
+                "query": {"bool": query_defuzzed},
+                "track_total_hits": True,
+                "aggs": aggs,
+            },
+        )
+    except plugins.database.DBError as e:
+        if getattr(e, "status_code", None) != 400:  # Only a bad request means it is not supported
+            raise
+        watermark_supported = False
+        return None
+    watermark = "%s:%s" % (res["hits"]["total"]["value"], res["aggregations"]["seq_no"]["value"])
+    if query_window is not None:
+        window = res["aggregations"]["window"]
+        watermark += ":%s:%s" % (window["doc_count"], window["epoch"]["value"])
+    return watermark
+
+
 async def get_activity_span(session: plugins.session.SessionObject, query_defuzzed: dict) -> typing.Tuple[datetime.datetime, datetime.datetime, dict]:
     """
     Fetches the activity span of a search as well as active months within that span
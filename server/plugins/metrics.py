@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Request and database metrics for Pony Mail codename Foal, exported in the Prometheus text format.
+Everything here is recorded from the event loop thread, so recording is a few additions without any locking.
+Cache hits and misses are counted by the caches themselves; the disk cache, which is read from offloader
+threads, counts them under its lock.
+"""
+
+import bisect
+import typing
+
+# Upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+class Histogram:
+    """Counts observations into the latency buckets, Prometheus style"""
+    __slots__ = ("counts", "total", "count")
+
+    def __init__(self) -> None:
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)  # The last bucket is +Inf
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+
+class DBMethodStats:
+    """Timings of one Database method: wall time as seen by us, and the time Elasticsearch says it took"""
+    __slots__ = ("wall", "took", "errors")
+
+    def __init__(self) -> None:
+        self.wall = Histogram()
+        self.took = 0.0  # Seconds, summed over the responses that report it
+        self.errors = 0
+
+
+class Registry:
+    """Holds the metrics of this server process"""
+
+    def __init__(self) -> None:
+        self.requests: typing.Dict[typing.Tuple[str, int], Histogram] = {}
+        self.database: typing.Dict[str, DBMethodStats] = {}
+        self.pool_wait = Histogram()
+        # Name -> function returning the cache (anything with hits and misses), or None if it is disabled
+        self.caches: typing.Dict[str, typing.Callable[[], typing.Any]] = {}
+
+    def observe_request(self, endpoint: str, status: int, seconds: float) -> None:
+        histogram = self.requests.get((endpoint, status))
+        if histogram is None:
+            histogram = self.requests[(endpoint, status)] = Histogram()
+        histogram.observe(seconds)
+
+    def observe_db(self, method: str, seconds: float, took: typing.Optional[int], failed: bool = False) -> None:
+        stats = self.database.get(method)
+        if stats is None:
+            stats = self.database[method] = DBMethodStats()
+        stats.wall.observe(seconds)
+        if took is not None:
+            stats.took += took / 1000
+        if failed:
+            stats.errors += 1
+
+
+# The registry everything in this process records into
+registry = Registry()
+
+
+def escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class Exposition:
+    """Builds a scrape response in the Prometheus text format"""
+
+    def __init__(self) -> None:
+        self.lines: typing.List[str] = []
+
+    def family(self, name: str, kind: str, description: str) -> None:
+        self.lines.append(f"# HELP {name} {description}")
+        self.lines.append(f"# TYPE {name} {kind}")
+
+    def sample(self, name: str, labels: typing.Dict[str, str], value: float) -> None:
+        if labels:
+            name += "{" + ",".join(f'{key}="{escape(str(val))}"' for key, val in labels.items()) + "}"
+        self.lines.append(f"{name} {value!r}" if isinstance(value, float) else f"{name} {value}")
+
+    def histogram(self, name: str, labels: typing.Dict[str, str], histogram: Histogram) -> None:
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS + (float("inf"),), histogram.counts):
+            cumulative += count
+            self.sample(f"{name}_bucket", {**labels, "le": "+Inf" if bound == float("inf") else str(bound)}, cumulative)
+        self.sample(f"{name}_sum", labels, histogram.total)
+        self.sample(f"{name}_count", labels, histogram.count)
+
+    def text(self) -> str:
+        return "\n".join(self.lines) + "\n"
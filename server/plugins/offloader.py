@@ -30,6 +30,10 @@ class ExecutorPool:
         # If no thread count is specified, will default to: min(32, os.cpu_count() + 4)
         self.threads = concurrent.futures.ThreadPoolExecutor(max_workers=threads)
 
+    def queue_depth(self) -> int:
+        """Number of tasks waiting for a free thread"""
+        return self.threads._work_queue.qsize()  # pylint: disable=protected-access
+
     async def run(self, func, *args, **kwargs):
         if DEBUG:
             print("[Runner] initiating runner")
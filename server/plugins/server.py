@@ -21,10 +21,15 @@ import asyncio
 import typing
 
 import aiohttp
-from elasticsearch import AsyncElasticsearch
 
 import plugins.configuration
+import plugins.database
+import plugins.limiter
 import plugins.offloader
+import plugins.tracing
+
+if typing.TYPE_CHECKING:
+    import plugins.supervisor
 
 
 class Endpoint:
@@ -48,10 +53,13 @@ class BaseServer:
     server: typing.Optional[aiohttp.web.Server]
     data: plugins.configuration.InterData
     handlers: typing.Dict[str, Endpoint]
-    database: AsyncElasticsearch
-    dbpool: asyncio.Queue
+    database: plugins.database.Database
+    limiters: typing.Dict[str, plugins.limiter.EndpointLimiter]
     runners: plugins.offloader.ExecutorPool
+    tracer: plugins.tracing.Tracer
     streamlock: asyncio.Lock
+    link: typing.Optional["plugins.supervisor.WorkerLink"]  # to the supervisor, when running as one of several workers
+    cleanups: typing.List[typing.Callable[[], typing.Awaitable[None]]]  # run on shutdown, for endpoints holding connections
     # provided by background.py
     library_version: str
     engine_version: str
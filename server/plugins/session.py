@@ -71,6 +71,7 @@ class SessionObject:
     database: typing.Optional[plugins.database.Database]
     remote: str
     host: str
+    if_none_match: str
     server: plugins.server.BaseServer
 
     def __init__(self, server: plugins.server.BaseServer, **kwargs):
@@ -79,6 +80,7 @@ class SessionObject:
         self.created = int(time.time())
         self.host = "??"
         self.remote = "??"
+        self.if_none_match = ""
         if kwargs:
             self.last_accessed = kwargs.get("last_accessed", 0)
             self.credentials = SessionCredentials(kwargs.get("credentials"))
@@ -115,12 +117,13 @@ async def get_session(
             del server.data.sessions[session_id]
         else:
 
-            # Make a copy so we don't have a race condition with the database pool object
+            # Make a copy so we don't have a race condition with the per-request fields
             # In case the session is used twice within the same loop
             session = copy.copy(x_session)
-            session.database = await server.dbpool.get()
+            session.database = server.database
             session.host = request.headers.get("X-Forwarded-Host", request.host)
             session.remote = request.remote
+            session.if_none_match = request.headers.get("If-None-Match", "")
 
             # Do we need to update the timestamp in ES?
             if (now - session.last_accessed) > FOAL_SAVE_SESSION_INTERVAL:
@@ -131,9 +134,10 @@ async def get_session(
 
     # If not in local memory, start a new session object
     session = SessionObject(server)
-    session.database = await server.dbpool.get()
+    session.database = server.database
     session.host = request.headers.get("X-Forwarded-Host", request.host or "??")
     session.remote = request.remote or "??"
+    session.if_none_match = request.headers.get("If-None-Match", "")
 
     # If a cookie was supplied, look for a session object in ES
     if session_id and session.database:
@@ -191,16 +195,13 @@ async def set_session(server: plugins.server.BaseServer, cid: str, **credentials
     session.credentials = SessionCredentials(credentials)
     server.data.sessions[session_id] = session
 
-    # Grab temporary DB handle since session objects at init do not have this
+    # Session objects at init do not have a DB handle
     # We just need this to be able to save the session in ES.
-    session.database = await server.dbpool.get()
+    session.database = server.database
 
     # Save session and account data
     await save_session(session)
     await save_credentials(session)
-
-    # Put DB handle back into the pool
-    server.dbpool.put_nowait(session.database)
     return cookie[FOAL_COOKIE_NAME].OutputString()
 
 
@@ -224,6 +225,13 @@ async def remove_session(session: SessionObject):
     await session.database.delete(index=session.database.dbs.db_session, id=session.cookie)
 
 
+def forget_session(server: plugins.server.BaseServer, session_id: str):
+    """Drop a session from memory, in this process and in any other workers sharing the port"""
+    server.data.sessions.pop(session_id, None)
+    if server.link:
+        server.link.send(("forget_session", session_id))
+
+
 async def save_credentials(session: SessionObject):
     """Save a user account object in the ES database"""
     assert session.database, DATABASE_NOT_CONNECTED
@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Multi-process mode for Pony Mail codename Foal.
+A supervisor process starts a number of worker processes, each running a complete server
+bound to the same port with SO_REUSEPORT, so the kernel spreads connections over all of them.
+The supervisor runs the only background refresh, and hands its results to every worker over a pipe.
+The same pipes carry session changes that other workers must know about, such as logouts.
+"""
+
+import asyncio
+import multiprocessing
+import multiprocessing.connection
+import signal
+import time
+import typing
+
+import yaml
+
+import plugins.background
+import plugins.configuration
+import plugins.database
+import plugins.offloader
+import plugins.server
+
+RESTART_DELAY = 1  # Seconds to wait before restarting a worker that died, so a crashing worker does not spin
+
+# Messages are (kind, payload) tuples:
+#   "data": dict of InterData fields and database versions, supervisor -> worker, after every refresh
+#   "forget_session": session id, worker -> supervisor -> all other workers, when a session ends
+Message = typing.Tuple[str, typing.Any]
+
+
+def data_message(server: plugins.server.BaseServer) -> Message:
+    return "data", {
+        "lists": server.data.lists,
+        "activity": server.data.activity,
+        "catalogue": server.data.catalogue,
+        "library_version": server.library_version,
+        "engine_version": server.engine_version,
+    }
+
+
+class WorkerLink:
+    """A worker's end of its pipe to the supervisor"""
+
+    def __init__(self, conn: multiprocessing.connection.Connection, index: int):
+        self.conn = conn
+        self.index = index
+
+    def send(self, message: Message) -> None:
+        self.conn.send(message)
+
+    def listen(self, server: plugins.server.BaseServer) -> None:
+        """Applies messages from the supervisor as they come in. The server stops if the supervisor goes away"""
+        asyncio.get_running_loop().add_reader(self.conn.fileno(), self.receive, server)
+
+    def receive(self, server: plugins.server.BaseServer) -> None:
+        try:
+            message = self.conn.recv()
+        except EOFError:
+            asyncio.get_running_loop().remove_reader(self.conn.fileno())
+            server.background_event.set()
+            return
+        self.apply(server, message)
+
+    @staticmethod
+    def apply(server: plugins.server.BaseServer, message: Message) -> None:
+        kind, payload = message
+        if kind == "data":
+            server.data.lists = payload["lists"]
+            server.data.activity = payload["activity"]
+            server.data.catalogue = payload["catalogue"]
+            server.library_version = payload["library_version"]
+            server.engine_version = payload["engine_version"]
+        elif kind == "forget_session":
+            server.data.sessions.pop(payload, None)
+
+
+class Supervisor(plugins.server.BaseServer):
+    """Starts the workers, restarts them if they die, and refreshes the data they all share"""
+
+    def __init__(self, config_file: str, workers: int, target: typing.Callable, *args):
+        print(f"==== Apache Pony Mail supervisor starting {workers} workers ====")
+        self.config = plugins.configuration.Configuration(yaml.safe_load(open(config_file)))
+        self.data = plugins.configuration.InterData()
+        self.runners = plugins.offloader.ExecutorPool()
+        self.database = plugins.database.Database(self.config.database)
+        self.background_event = asyncio.Event()
+        self.link = None
+        self.workers = workers
+        self.target = target  # Runs a worker: target(*args, link)
+        self.args = args
+        # Spawn rather than fork, so workers do not inherit the supervisor's event loop and threads
+        self.context = multiprocessing.get_context("spawn")
+        self.processes: typing.List[typing.Optional[multiprocessing.process.BaseProcess]] = [None] * workers
+        self.conns: typing.List[typing.Optional[multiprocessing.connection.Connection]] = [None] * workers
+        self.outboxes: typing.List[typing.List[Message]] = [[] for _ in range(workers)]
+        self.writers: typing.List[typing.Optional[asyncio.Future]] = [None] * workers
+        self.refreshed = False
+
+    def start_worker(self, index: int) -> None:
+        conn, worker_conn = self.context.Pipe()
+        process = self.context.Process(
+            target=self.target, args=(*self.args, WorkerLink(worker_conn, index)), name=f"ponymail-worker-{index}"
+        )
+        process.start()
+        worker_conn.close()  # The worker has its own copy now
+        self.processes[index] = process
+        self.conns[index] = conn
+        self.outboxes[index] = []  # Whatever the last worker did not get is of no use to this one
+        self.writers[index] = None
+        asyncio.get_running_loop().add_reader(conn.fileno(), self.receive, index)
+        if self.refreshed:  # Catch up with the latest refresh straight away
+            self.send(index, data_message(self))
+        print(f"Started worker {index} (pid {process.pid})")
+
+    def send(self, index: int, message: Message) -> None:
+        """
+        Queues a message for a worker. Writing to a pipe blocks while it is full, which it stays if
+        the worker stops reading, so the writes are done in a thread, one at a time per worker.
+        A refresh makes any refresh still waiting stale, so only the latest is kept.
+        """
+        conn = self.conns[index]
+        if conn is None:
+            return
+        outbox = self.outboxes[index]
+        if message[0] == "data":
+            outbox[:] = [waiting for waiting in outbox if waiting[0] != "data"]
+        outbox.append(message)
+        writer = self.writers[index]
+        if writer is None or writer.done():
+            self.writers[index] = asyncio.ensure_future(self.write(conn, outbox))
+
+    @staticmethod
+    async def write(conn: multiprocessing.connection.Connection, outbox: typing.List[Message]) -> None:
+        loop = asyncio.get_running_loop()
+        while outbox:
+            try:
+                await loop.run_in_executor(None, conn.send, outbox.pop(0))
+            except OSError:  # The worker died, and will be restarted
+                outbox.clear()
+                return
+
+    def broadcast(self, message: Message, skip: typing.Optional[int] = None) -> None:
+        for index in range(self.workers):
+            if index != skip:
+                self.send(index, message)
+
+    def receive(self, index: int) -> None:
+        conn = self.conns[index]
+        assert conn is not None
+        try:
+            message = conn.recv()
+        except (EOFError, ConnectionResetError):
+            asyncio.get_running_loop().remove_reader(conn.fileno())
+            conn.close()
+            self.conns[index] = None
+            return
+        self.handle_message(index, message)
+
+    def handle_message(self, index: int, message: Message) -> None:
+        kind, _payload = message
+        if kind == "forget_session":
+            self.broadcast(message, skip=index)
+
+    def data_refreshed(self) -> None:
+        self.refreshed = True
+        self.broadcast(data_message(self))
+
+    async def watch_workers(self) -> None:
+        """Restarts workers that have died, until we are asked to stop"""
+        while not self.background_event.is_set():
+            for index, process in enumerate(self.processes):
+                if process is not None and not process.is_alive():
+                    print(f"Worker {index} (pid {process.pid}) exited with code {process.exitcode}, restarting")
+                    conn = self.conns[index]
+                    if conn is not None:
+                        asyncio.get_running_loop().remove_reader(conn.fileno())
+                        conn.close()
+                        self.conns[index] = None
+                    self.processes[index] = None
+                    await asyncio.sleep(RESTART_DELAY)
+                    self.start_worker(index)
+            try:
+                await asyncio.wait_for(self.background_event.wait(), timeout=1)
+            except asyncio.TimeoutError:
+                pass
+
+    def stop_workers(self) -> None:
+        for process in self.processes:
+            if process is not None and process.is_alive():
+                process.terminate()
+        deadline = time.time() + 10
+        for process in self.processes:
+            if process is not None:
+                process.join(max(0.0, deadline - time.time()))
+
+    async def supervise(self) -> None:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, self.background_event.set)
+        for index in range(self.workers):
+            self.start_worker(index)
+        watcher = asyncio.ensure_future(self.watch_workers())
+        try:
+            await plugins.background.run_tasks(self, refreshed=self.data_refreshed)
+        finally:
+            self.background_event.set()
+            await watcher
+            self.stop_workers()
+            await self.database.client.close()
+
+    def run(self) -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_until_complete(self.supervise())
+        except KeyboardInterrupt:
+            # The workers share our process group, so they got the interrupt as well
+            self.background_event.set()
+            self.stop_workers()
+            loop.run_until_complete(self.database.client.close())
+        loop.close()
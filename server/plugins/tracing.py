@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Request tracing for Pony Mail codename Foal.
+A sample of API requests is traced: each stage of the request, wrapped in span(), is timed,
+and the resulting tree of spans can be looked up by request ID afterwards.
+Requests that are not traced only pay for one context variable lookup per span.
+"""
+
+import collections
+import contextlib
+import contextvars
+import random
+import sys
+import time
+import typing
+import uuid
+
+import plugins.configuration
+
+
+class Span:
+    """One timed stage of a request, and the stages within it"""
+    __slots__ = ("name", "start", "end", "children")
+
+    def __init__(self, name: str):
+        self.name = name
+        self.start = time.perf_counter()
+        self.end: typing.Optional[float] = None
+        self.children: typing.List[Span] = []
+
+    def finish(self) -> None:
+        self.end = time.perf_counter()
+
+    @property
+    def duration(self) -> float:
+        return (self.end or time.perf_counter()) - self.start
+
+    def as_dict(self, origin: float) -> dict:
+        """The span tree, with times in milliseconds since origin"""
+        return {
+            "name": self.name,
+            "start": round((self.start - origin) * 1000, 3),
+            "duration": round(self.duration * 1000, 3),
+            "children": [child.as_dict(origin) for child in self.children],
+        }
+
+    def lines(self, depth: int = 0) -> typing.Iterator[str]:
+        yield "%10.1fms  %s%s" % (self.duration * 1000, "  " * depth, self.name)
+        for child in self.children:
+            yield from child.lines(depth + 1)
+
+
+class Trace:
+    """The spans of one traced request"""
+
+    def __init__(self, request_id: str, endpoint: str, path: str):
+        self.request_id = request_id
+        self.endpoint = endpoint
+        self.path = path
+        self.started = time.time()
+        self.status = 0
+        self.root = Span(endpoint)
+
+    def as_dict(self) -> dict:
+        return {
+            "id": self.request_id,
+            "endpoint": self.endpoint,
+            "path": self.path,
+            "started": int(self.started),
+            "status": self.status,
+            "duration": round(self.root.duration * 1000, 3),
+            "spans": self.root.as_dict(self.root.start),
+        }
+
+
+# The innermost span of the request being handled, if it is being traced
+current_span: contextvars.ContextVar[typing.Optional[Span]] = contextvars.ContextVar("current_span", default=None)
+
+
+@contextlib.contextmanager
+def span(name: str) -> typing.Iterator[None]:
+    """Times the code within as a stage of the current request, if it is being traced"""
+    parent = current_span.get()
+    if parent is None:
+        yield
+        return
+    child = Span(name)
+    parent.children.append(child)
+    token = current_span.set(child)
+    try:
+        yield
+    finally:
+        child.finish()
+        current_span.reset(token)
+
+
+class Tracer:
+    """Decides which requests to trace, and keeps the most recent traces for admins to look at"""
+
+    def __init__(self, config: plugins.configuration.TracingConfig):
+        self.config = config
+        self.traces: collections.OrderedDict[str, Trace] = collections.OrderedDict()
+
+    def start(self, endpoint: str, path: str, forced: bool = False) -> typing.Optional[Trace]:
+        """Starts tracing a request if it is sampled (or forced), making its root span the current span"""
+        if not self.config.enabled or not (forced or random.random() < self.config.sample_rate):
+            return None
+        trace = Trace(uuid.uuid4().hex[:16], endpoint, path)
+        current_span.set(trace.root)
+        return trace
+
+    def finish(self, trace: Trace, status: int) -> None:
+        trace.root.finish()
+        trace.status = status
+        current_span.set(None)
+        self.traces[trace.request_id] = trace
+        while len(self.traces) > self.config.history:
+            self.traces.popitem(last=False)
+        if self.config.slow_threshold and trace.root.duration >= self.config.slow_threshold:
+            self.log_slow(trace)
+
+    @staticmethod
+    def log_slow(trace: Trace) -> None:
+        sys.stderr.write(
+            "Slow request %s (%.1fms, status %u): %s\n"
+            % (trace.request_id, trace.root.duration * 1000, trace.status, trace.path)
+        )
+        for line in trace.root.lines():
+            sys.stderr.write("%s: %s\n" % (trace.request_id, line))
+
+    def get(self, request_id: str) -> typing.Optional[Trace]:
+        return self.traces.get(request_id)
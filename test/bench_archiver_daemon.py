@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares archiving throughput of piping each message to archiver.py with handing it to
+# archiver-daemon.py, through archiver-client.py (as the MTA would) and over one open connection.
+# Messages are archived with --dry by default, so no database is needed and the figures show the
+# start-up overhead alone; with --live they also include connecting to and writing to the database.
+# Needs tools/archiver.yaml.
+#
+# Run from the top-level directory as:
+#   PYTHONPATH=. python3 test/bench_archiver_daemon.py [--count N] [--live]
+
+import argparse
+import glob
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+from tools.plugins import delivery
+
+TOOLS = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "tools")
+RESOURCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources")
+
+
+def load_messages(count):
+    files = sorted(glob.glob(os.path.join(RESOURCES, "*.eml")))
+    messages = [open(path, "rb").read() for path in files]
+    return [messages[i % len(messages)] for i in range(count)]
+
+
+def per_process(script, extra, messages, options):
+    for raw in messages:
+        subprocess.run(
+            [sys.executable, os.path.join(TOOLS, script), *extra, *options],
+            input=raw, stdout=subprocess.DEVNULL, check=True,
+        )
+
+
+def one_connection(path, messages, options):
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        stream = sock.makefile("rwb")
+        for raw in messages:
+            status, _output = delivery.submit_over(stream, options, raw)
+            assert status == 0
+
+
+def wait_for(path):
+    for _ in range(100):
+        if os.path.exists(path):
+            return
+        time.sleep(0.1)
+    raise TimeoutError("archiver-daemon.py did not start")
+
+
+def report(name, count, elapsed, baseline=None):
+    line = "%-32s %8.1f msg/s %8.2f ms/msg" % (name, count / elapsed, 1000 * elapsed / count)
+    if baseline:
+        line += "   %5.1fx" % (baseline / elapsed)
+    print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--count", type=int, default=50, help="Messages to archive per run")
+    parser.add_argument("--live", action="store_true", help="Write to the database configured in archiver.yaml")
+    args = parser.parse_args()
+    options = [] if args.live else ["--dry"]
+    messages = load_messages(args.count)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "archiver.sock")
+        daemon = subprocess.Popen(
+            [sys.executable, os.path.join(TOOLS, "archiver-daemon.py"), "--socket", path],
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            wait_for(path)
+            print("Archiving %u messages%s" % (args.count, "" if args.live else " (--dry)"))
+
+            start = time.perf_counter()
+            per_process("archiver.py", [], messages, options)
+            baseline = time.perf_counter() - start
+            report("archiver.py per message", args.count, baseline)
+
+            start = time.perf_counter()
+            per_process("archiver-client.py", ["--socket", path], messages, options)
+            report("archiver-client.py per message", args.count, time.perf_counter() - start, baseline)
+
+            start = time.perf_counter()
+            one_connection(path, messages, options)
+            report("daemon, one connection", args.count, time.perf_counter() - start, baseline)
+        finally:
+            daemon.terminate()
+            daemon.wait()
+
+
+if __name__ == "__main__":
+    main()
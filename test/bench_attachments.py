@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares archive (store) and serve (fetch) throughput of the two attachment backends.
+# The elastic figures only cover the local encoding work done on our side of the
+# connection (base64 + JSON), so they are a lower bound on the real cost.
+#
+# Run from the top-level directory as:
+#   PYTHONPATH=. python3 test/bench_attachments.py [--count N] [--size BYTES]
+
+import argparse
+import base64
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+
+from tools.plugins.blobstore import BlobStore
+
+
+def make_corpus(count, size):
+    corpus = {}
+    for _ in range(count):
+        data = os.urandom(size)
+        corpus[hashlib.sha256(data).hexdigest()] = data
+    return corpus
+
+
+def bench_elastic(corpus):
+    docs = {}
+    start = time.time()
+    for digest, data in corpus.items():
+        # This is what the archiver sends for each attachment
+        docs[digest] = json.dumps({"source": base64.standard_b64encode(data).decode("ascii")})
+    stored = time.time() - start
+    start = time.time()
+    for digest in corpus:
+        base64.decodebytes(json.loads(docs[digest])["source"].encode("utf-8"))
+    served = time.time() - start
+    return stored, served, sum(len(x) for x in docs.values())
+
+
+def bench_disk(corpus, root):
+    blobs = BlobStore(root)
+    start = time.time()
+    for digest, data in corpus.items():
+        blobs.put(digest, data)
+    stored = time.time() - start
+    start = time.time()
+    for digest in corpus:
+        blobs.get(digest)
+    served = time.time() - start
+    return stored, served, sum(len(x) for x in corpus.values())
+
+
+def report(name, count, size, stored, served, stored_bytes):
+    mib = count * size / 1048576
+    print(
+        "%-8s archive: %8.1f att/s %8.1f MiB/s | serve: %8.1f att/s %8.1f MiB/s | stored: %.1f MiB"
+        % (name, count / stored, mib / stored, count / served, mib / served, stored_bytes / 1048576)
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Attachment backend benchmark")
+    parser.add_argument("--count", type=int, default=2000, help="Number of attachments (default 2000)")
+    parser.add_argument("--size", type=int, default=64 * 1024, help="Attachment size in bytes (default 64KiB)")
+    args = parser.parse_args()
+
+    corpus = make_corpus(args.count, args.size)
+    root = tempfile.mkdtemp(prefix="pmfoal-blobs-")
+    try:
+        report("elastic", args.count, args.size, *bench_elastic(corpus))
+        report("disk", args.count, args.size, *bench_disk(corpus, root))
+    finally:
+        shutil.rmtree(root)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares request latency under concurrency for the old database pool (pool_size
+# separate clients, checked out from a queue per API request) and the shared client.
+# Requests go to a local stand-in for Elasticsearch that answers every search after
+# a fixed delay, so the figures show queueing and client overhead only.
+#
+# Run from the top-level directory as:
+#   python3 test/bench_database.py [--concurrency N] [--requests N] [--pool-size N] [--delay MS]
+
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import aiohttp.test_utils
+import aiohttp.web
+import elasticsearch
+
+# The server code imports its plugins as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server"))
+
+import plugins.configuration # pylint: disable=wrong-import-position
+import plugins.database # pylint: disable=wrong-import-position
+
+SEARCH_RESPONSE = '{"took": 1, "timed_out": false, "hits": {"total": {"value": 0}, "hits": []}}'
+
+
+async def start_fake_es(delay, sockets):
+    async def search(request):
+        sockets.add(request.transport.get_extra_info("peername"))
+        await asyncio.sleep(delay)
+        return aiohttp.web.Response(text=SEARCH_RESPONSE, content_type="application/json")
+
+    app = aiohttp.web.Application()
+    app.router.add_route("*", "/{index}/_search", search)
+    server = aiohttp.test_utils.TestServer(app)
+    await server.start_server()
+    return server
+
+
+async def run_clients(concurrency, requests, call):
+    latencies = []
+
+    async def worker():
+        for _ in range(requests):
+            start = time.perf_counter()
+            await call()
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return sorted(latencies), time.perf_counter() - start
+
+
+async def bench_pool(url, pool_size, concurrency, requests):
+    """The old way: pool_size databases with a client each, one checked out per API request"""
+    pool: asyncio.Queue = asyncio.Queue()
+    for _ in range(pool_size):
+        pool.put_nowait(elasticsearch.AsyncElasticsearch([url]))
+
+    async def call():
+        client = await pool.get()
+        try:
+            await client.search(index="ponymail-mbox", body={"query": {"match_all": {}}})
+        finally:
+            pool.put_nowait(client)
+
+    try:
+        return await run_clients(concurrency, requests, call)
+    finally:
+        while not pool.empty():
+            await pool.get_nowait().close()
+
+
+async def bench_shared(url, pool_size, concurrency, requests):
+    """The new way: one client for everyone, with pool_size requests in flight at most"""
+    db = plugins.database.Database(plugins.configuration.DBConfig({"dburl": url, "pool_size": pool_size}))
+
+    async def call():
+        await db.search(body={"query": {"match_all": {}}})
+
+    try:
+        return await run_clients(concurrency, requests, call)
+    finally:
+        await db.client.close()
+
+
+def report(name, latencies, elapsed, sockets):
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p / 100))] * 1000
+
+    print(
+        "%-7s p50: %7.2f ms  p99: %7.2f ms  max: %7.2f ms | %8.1f req/s | %3u sockets"
+        % (name, percentile(50), percentile(99), latencies[-1] * 1000, len(latencies) / elapsed, len(sockets))
+    )
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Database client latency benchmark")
+    parser.add_argument("--concurrency", type=int, default=100, help="Concurrent API requests (default 100)")
+    parser.add_argument("--requests", type=int, default=20, help="Requests per concurrent client (default 20)")
+    parser.add_argument("--pool-size", type=int, default=15, help="database/pool_size (default 15)")
+    parser.add_argument("--delay", type=float, default=5, help="Simulated search time in ms (default 5)")
+    args = parser.parse_args()
+
+    for name, bench in (("pool", bench_pool), ("shared", bench_shared)):
+        sockets: set = set()
+        server = await start_fake_es(args.delay / 1000, sockets)
+        try:
+            latencies, elapsed = await bench(str(server.make_url("/")), args.pool_size, args.concurrency, args.requests)
+        finally:
+            await server.close()
+        report(name, latencies, elapsed, sockets)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
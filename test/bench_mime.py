@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Compares finding the body and attachments of the messages in test/resources with
+# archiver.walk_message (one pass) and with a pass for the body followed by one for the
+# attachments, as compute_updates used to do. The corpus has no attachments, so each message
+# is also archived again with --attachments files of --size bytes added, as inline text parts
+# (which are body candidates too) and binary attachments. Both must find the same things.
+# Needs tools/archiver.yaml.
+#
+# Run from the top-level directory as:
+#   PYTHONPATH=. python3 test/bench_mime.py [--rounds N] [--attachments N] [--size BYTES]
+
+import argparse
+import email.mime.application
+import email.mime.multipart
+import email.mime.text
+import glob
+import mailbox
+import os
+import time
+
+from tools import archiver
+
+RESOURCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources")
+
+
+def load_corpus():
+    raws = []
+    for path in sorted(glob.glob(os.path.join(RESOURCES, "*.eml"))):
+        with open(path, "rb") as f:
+            raws.append(f.read())
+    for path in sorted(glob.glob(os.path.join(RESOURCES, "*.mbox"))):
+        raws.extend(message.as_bytes() for message in mailbox.mbox(path, create=False))
+    return raws
+
+
+def with_attachments(raw, count, size):
+    """Wraps a message's text in a multipart message with count attachments"""
+    original = archiver.parse_message(raw)
+    outer = email.mime.multipart.MIMEMultipart()
+    for key in ("From", "To", "Subject", "Date", "Message-ID", "List-Id"):
+        if original.get(key):
+            outer[key] = str(original[key])
+    outer.attach(email.mime.text.MIMEText("See the attached files.\n"))
+    for number in range(count):
+        if number % 2:
+            part = email.mime.application.MIMEApplication(os.urandom(size))
+            part.add_header("Content-Disposition", "attachment", filename="data-%u.bin" % number)
+        else:
+            part = email.mime.text.MIMEText("log line\n" * (size // 9))
+            part.add_header("Content-Disposition", "inline", filename="log-%u.txt" % number)
+        outer.attach(part)
+    return outer.as_bytes()
+
+
+def two_passes(archie, msg):
+    body = None
+    first_html = None
+    for part in msg.walk():
+        if body is None and part.get_content_type() in ["text/plain", "text/enriched"]:
+            body = archiver.Body(part)
+        elif not first_html and part.get_content_type() == "text/html":
+            first_html = archiver.Body(part)
+    body = archie.choose_body(archiver.MessageParts(body, first_html, [], {}))
+    attachments, contents = archiver.message_attachments(msg)
+    return body, attachments, contents
+
+
+def one_pass(archie, msg):
+    parts = archiver.walk_message(msg)
+    return archie.choose_body(parts), parts.attachments, parts.contents
+
+
+def result(found):
+    body, attachments, contents = found
+    return (body and (str(body), body.bytes, body.character_set, body.html_as_source), attachments, contents)
+
+
+def bench(name, corpus, rounds):
+    archie = archiver.Archiver(parse_html=False)
+    messages = [archiver.parse_message(raw) for raw in corpus]
+    mib = sum(len(raw) for raw in corpus) / 1048576
+    for msg in messages:
+        assert result(two_passes(archie, msg)) == result(one_pass(archie, msg))
+    for method in (two_passes, one_pass):
+        start = time.time()
+        for _ in range(rounds):
+            for msg in messages:
+                method(archie, msg)
+        elapsed = (time.time() - start) / rounds
+        print(
+            "%-18s %-10s %8.3f ms/msg %8.1f MiB/s"
+            % (name, method.__name__, elapsed * 1000 / len(messages), mib / elapsed)
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="MIME walk benchmark")
+    parser.add_argument("--rounds", type=int, default=20, help="Times to go through the corpus (default 20)")
+    parser.add_argument("--attachments", type=int, default=4, help="Attachments added to each message (default 4)")
+    parser.add_argument("--size", type=int, default=256 * 1024, help="Attachment size in bytes (default 256KiB)")
+    args = parser.parse_args()
+
+    corpus = load_corpus()
+    bench("corpus", corpus, args.rounds)
+    bench("with attachments", [with_attachments(raw, args.attachments, args.size) for raw in corpus], args.rounds)
+
+
+if __name__ == "__main__":
+    main()
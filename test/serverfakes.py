@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Stand-ins for the server, session and database that endpoints and server plugins are given,
+# shared by the tests of the server code. Importing this also makes the server's plugins and
+# endpoints importable, as the server code imports them as top-level modules.
+
+import os
+import sys
+
+import aiohttp.web # pylint: disable=unused-import # plugins.server expects it to be loaded
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "server"))
+
+import plugins.configuration # pylint: disable=wrong-import-position
+import plugins.database # pylint: disable=wrong-import-position
+from plugins.offloader import ExecutorPool # pylint: disable=wrong-import-position
+
+
+class FakeDatabase:
+    """Records the searches made; tests override answer() with the hits they need"""
+    dbs = plugins.database.DBNames("ponymail")
+
+    def __init__(self):
+        self.searches = []
+
+    async def search(self, **kwargs):
+        if "body" in kwargs:
+            kwargs["body"] = dict(kwargs["body"])  # As it was, as callers reuse it for the next page
+        self.searches.append(kwargs)
+        return self.answer(**kwargs)
+
+    def answer(self, **kwargs):
+        return {"hits": {"hits": []}}
+
+
+class FakeSession:
+    """What endpoints read from plugins.session.SessionObject"""
+    def __init__(self, database=None, if_none_match="", credentials=None, host="localhost"):
+        self.database = database
+        self.if_none_match = if_none_match
+        self.credentials = credentials
+        self.host = host
+
+
+class FakeServer:
+    """A server with the default configuration"""
+    def __init__(self):
+        self.config = plugins.configuration.Configuration({})
+        self.runners = ExecutorPool()
@@ -18,10 +18,16 @@
 # To be run as: python3 -m pytest test/test_archiver.py
 # This ensures sys.path is set up correctly
 
+import collections
+import json
 import sys
 import email.errors
 import email.header
 import email.utils
+
+import elasticsearch.helpers
+import pytest
+
 from tools import archiver
 
 def show(dict):
@@ -51,3 +57,181 @@ def test_archiver_1():
     print(_irt)
     print("--skipit--")
     print(skipit)
+
+
+class FakeIndices:
+    def __init__(self):
+        self.checks = 0
+
+    def exists(self, index):
+        self.checks += 1
+        return True
+
+
+class FakeElastic:
+    """Records the bulk requests made, and fails the documents for the indices listed in fail,
+    or refuses them (400) for those listed in reject"""
+
+    db_mbox = "ponymail-mbox"
+    db_source = "ponymail-source"
+    db_attachment = "ponymail-attachment"
+    db_auditlog = "ponymail-auditlog"
+    wait_for_active_shards = 1
+
+    def __init__(self, fail=(), reject=()):
+        self.indices = FakeIndices()
+        self.requests = []
+        self.fail = fail
+        self.reject = reject
+
+    def bulk(self, actions, **kwargs):
+        self.requests.append(list(actions))
+        errors = [{"index": {"_index": a["_index"], "error": "nope"}} for a in actions if a["_index"] in self.fail]
+        errors += [
+            {"index": {"_index": a["_index"], "_id": a.get("_id"), "status": 400, "error": "mapper_parsing_exception"}}
+            for a in actions if a["_index"] in self.reject
+        ]
+        return len(actions) - len(errors), errors
+
+
+def archive(elastic, dump=None):
+    archie = archiver.Archiver()
+    archie.attachments.blobs = None  # Attachments go to the database
+    raw = open("test/resources/dev.activemq.apache.org-51149.eml", "rb").read()
+    mlist = collections.namedtuple("mlist", ["list_id", "archive_public"])("<dev.activemq.apache.org>", True)
+    return archie.archive_message(mlist, archiver.parse_message(raw), raw, dump=dump, elastic=elastic)
+
+def test_archive_bulk():
+    archiver.auditlog_indices.clear()
+    elastic = FakeElastic()
+    _lid, mid = archive(elastic)
+    archive(elastic)
+    # One request per message, and the audit log is only looked for once
+    assert len(elastic.requests) == 2
+    assert elastic.indices.checks == 1
+    indices = [action["_index"] for action in elastic.requests[0]]
+    assert indices == ["ponymail-mbox", "ponymail-source", "ponymail-auditlog"]
+    assert elastic.requests[0][0]["_id"] == mid
+
+def test_archive_dump_on_fail(tmp_path):
+    elastic = FakeElastic(fail=["ponymail-source"])
+    with pytest.raises(SystemExit):
+        archive(elastic, dump=str(tmp_path))
+    dumps = list(tmp_path.iterdir())
+    assert len(dumps) == 1
+    dumped = json.load(open(dumps[0]))
+    assert dumped["mbox"]["mid"] == dumped["id"]
+    assert dumped["mbox_source"]["source"]
+    # Without a dump directory, the failure is raised
+    with pytest.raises(elasticsearch.helpers.BulkIndexError):
+        archive(elastic)
+
+class ThreadElastic:
+    """Answers the threading searches from a list of messages"""
+
+    db_mbox = "ponymail-mbox"
+
+    def __init__(self, messages):
+        self.messages = messages
+        self.requests = 0
+
+    def answer(self, body):
+        if "aggs" in body:
+            wanted = body["query"]["terms"]["message-id"]
+            buckets = []
+            for msgid in wanted:
+                found = [m for m in self.messages if m["message-id"] == msgid]
+                if found:
+                    buckets.append({"key": msgid, "doc_count": len(found), "message": {"hits": {"hits": [{"_source": found[0]}]}}})
+            return {"aggregations": {"by_id": {"buckets": buckets}}}
+        tops = [m for m in self.messages if m.get("top")]
+        return {"hits": {"hits": [{"_source": {"mid": m["mid"]}} for m in tops[-1:]]}}
+
+    def msearch(self, index, body):
+        self.requests += 1
+        return {"responses": [self.answer(search) for search in body[1::2]]}
+
+    def search(self, index, body):
+        self.requests += 1
+        return self.answer(body)
+
+def test_thread_properties():
+    messages = [
+        {"mid": "first", "message-id": "<a@example.org>", "thread": "first", "top": True},
+        {"mid": "twin1", "message-id": "<twin@example.org>", "thread": "first"},
+        {"mid": "twin2", "message-id": "<twin@example.org>", "thread": "first"},
+        {"mid": "reply", "message-id": "<b@example.org>", "thread": "first"},
+    ]
+    elastic = ThreadElastic(messages)
+    # The closest identifier naming exactly one message wins: twin is ambiguous, c is unknown
+    ojson = {"mid": "new", "forum": "dev@example.org", "epoch": 10, "in-reply-to": "<twin@example.org>",
+             "references": "<a@example.org> <b@example.org> <c@example.org>"}
+    assert archiver.get_parent_candidates(ojson) == [
+        "<twin@example.org>", "<c@example.org>", "<b@example.org>", "<a@example.org>"
+    ]
+    archiver.add_thread_properties(elastic, ojson)
+    assert (ojson["top"], ojson["thread"], ojson["previous"]) == (False, "first", "reply")
+    assert elastic.requests == 1
+    # Without a known parent, the message starts a thread that follows the latest one
+    ojson = {"mid": "new", "forum": "dev@example.org", "epoch": 10, "in-reply-to": "<c@example.org>"}
+    archiver.add_thread_properties(elastic, ojson)
+    assert (ojson["top"], ojson["thread"], ojson["previous"]) == (True, "new", "first")
+    assert elastic.requests == 2
+
+def test_spool(tmp_path):
+    archiver.auditlog_indices.clear()
+    archie = archiver.Archiver()
+    archie.attachments.blobs = None
+    archie.spool = archiver.Spool(str(tmp_path))
+    raw = open("test/resources/dev.activemq.apache.org-51149.eml", "rb").read()
+    mlist = collections.namedtuple("mlist", ["list_id", "archive_public"])("<dev.activemq.apache.org>", True)
+    # Archiving only writes to the spool
+    _lid, mid = archie.archive_message(mlist, archiver.parse_message(raw), raw, elastic=FakeElastic())
+    assert archie.spool.backlog()[0] == 1
+
+    # The flusher keeps it until the database takes it
+    elastic = FakeElastic(fail=["ponymail-mbox"])
+    with pytest.raises(elasticsearch.helpers.BulkIndexError):
+        archiver.flush_spool(archie, elastic)
+    assert archie.spool.backlog()[0] == 1
+    elastic = FakeElastic()
+    assert archiver.flush_spool(archie, elastic) == 1
+    assert archie.spool.backlog()[0] == 0
+    assert elastic.requests[0][0]["_id"] == mid
+
+    # A message the database refuses is set aside rather than holding up the spool
+    archie.archive_message(mlist, archiver.parse_message(raw), raw, elastic=FakeElastic())
+    assert archiver.flush_spool(archie, FakeElastic(reject=["ponymail-mbox"])) == 0
+    assert archie.spool.backlog()[0] == 0
+    assert json.load(open(tmp_path / "failed" / ("%s.json" % mid)))["id"] == mid
+
+def test_thread_properties_pending():
+    elastic = ThreadElastic([{"mid": "old", "message-id": "<old@example.org>", "thread": "old", "top": True, "epoch": 1}])
+    # A thread start and its reply, spooled together, so neither is searchable yet
+    start = {"mid": "start", "message-id": "<start@example.org>", "forum": "dev@example.org", "epoch": 5}
+    reply = {"mid": "reply", "message-id": "<reply@example.org>", "forum": "dev@example.org", "epoch": 6,
+             "in-reply-to": "<start@example.org>"}
+    pending = {}
+    for ojson in (start, reply):
+        archiver.add_thread_properties(elastic, ojson, pending=pending)
+        pending.setdefault(ojson["message-id"], []).append(ojson)
+    assert (start["top"], start["thread"], start["previous"]) == (True, "start", "old")
+    assert (reply["top"], reply["thread"], reply["previous"]) == (False, "start", "start")
+
+
+def test_walk_message():
+    raw = (
+        b"Content-Type: multipart/mixed; boundary=XX\n\n"
+        b"--XX\nContent-Type: text/html\n\n<p>hi</p>\n"
+        b"--XX\nContent-Type: text/plain\nContent-Disposition: inline; filename=notes.txt\n\nhello\n"
+        b"--XX\nContent-Type: application/octet-stream\nContent-Disposition: attachment; filename=a.bin\n"
+        b"Content-Transfer-Encoding: base64\n\nAAEC\n"
+        b"--XX--\n"
+    )
+    parts = archiver.walk_message(archiver.parse_message(raw))
+    assert str(parts.body) == "hello"
+    assert str(parts.html) == "<p>hi</p>"
+    # The inline text part is both the body and an attachment
+    assert [(a["filename"], a["size"]) for a in parts.attachments] == [("notes.txt", 5), ("a.bin", 3)]
+    assert parts.contents == {a["hash"]: b64 for a, b64 in zip(parts.attachments, ["aGVsbG8=", "AAEC"])}
+    assert str(archiver.Archiver(parse_html=False).choose_body(parts)) == "hello"
@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import asyncio
+import hashlib
+import os
+
+import pytest
+
+# To be run as: python3 -m pytest test/test_blobstore.py
+# This ensures sys.path is set up correctly
+
+from tools.plugins.blobstore import BLOB_MODE, BlobStore
+
+import serverfakes
+
+import plugins.attachments # pylint: disable=wrong-import-position
+import plugins.configuration # pylint: disable=wrong-import-position
+
+def test_blobstore_roundtrip(tmp_path):
+    blobs = BlobStore(str(tmp_path))
+    data = b"Hello, attachment!"
+    digest = hashlib.sha256(data).hexdigest()
+    assert blobs.get(digest) is None
+    assert blobs.put(digest, data) is True
+    assert blobs.put(digest, data) is False # content-addressed, already stored
+    assert blobs.get(digest) == data
+    # sharded by the first two pairs of hex digits
+    assert os.path.isfile(os.path.join(str(tmp_path), digest[0:2], digest[2:4], digest))
+    assert blobs.delete(digest) is True
+    assert blobs.delete(digest) is False
+    assert blobs.exists(digest) is False
+
+def test_blobstore_mode(tmp_path):
+    # Blobs are read by the API server, which usually runs as another user: not 0600 as mkstemp makes them
+    blobs = BlobStore(str(tmp_path))
+    data = b"readable"
+    digest = hashlib.sha256(data).hexdigest()
+    blobs.put(digest, data)
+    assert os.stat(blobs.path(digest)).st_mode & 0o777 == BLOB_MODE
+    umask = os.umask(0)
+    os.umask(umask)
+    assert BLOB_MODE == 0o666 & ~umask
+
+def test_blobstore_invalid_digest(tmp_path):
+    blobs = BlobStore(str(tmp_path))
+    for digest in ("../../etc/passwd", "abc", "A" * 64, ""):
+        with pytest.raises(ValueError):
+            blobs.path(digest)
+
+def disk_session(root):
+    session = serverfakes.FakeSession()
+    session.server = serverfakes.FakeServer()
+    session.server.config.attachments = plugins.configuration.AttachmentConfig({"backend": "disk", "path": root})
+    return session
+
+def test_server_reads_blobstore(tmp_path):
+    # The archiver writes blobs and the API server reads and removes them, each with its own copy of the layout
+    blobs = BlobStore(str(tmp_path))
+    data = b"Shared layout"
+    digest = hashlib.sha256(data).hexdigest()
+    blobs.put(digest, data)
+    assert plugins.attachments.blob_path(str(tmp_path), digest) == blobs.path(digest)
+    session = disk_session(str(tmp_path))
+    assert asyncio.run(plugins.attachments.get_attachment(session, digest)) == data
+    assert asyncio.run(plugins.attachments.remove_attachment(session, digest)) is True
+    assert not blobs.exists(digest)
+    assert asyncio.run(plugins.attachments.get_attachment(session, digest)) is None
+    assert asyncio.run(plugins.attachments.remove_attachment(session, digest)) is False
+
+def test_server_invalid_digest(tmp_path):
+    session = disk_session(str(tmp_path))
+    for digest in ("../../etc/passwd", "abc", "A" * 64, ""):
+        assert plugins.attachments.blob_path(str(tmp_path), digest) is None
+        assert asyncio.run(plugins.attachments.get_attachment(session, digest)) is None
+        assert asyncio.run(plugins.attachments.remove_attachment(session, digest)) is False
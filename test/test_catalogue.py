@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# To be run as: python3 -m pytest test/test_catalogue.py
+# This ensures sys.path is set up correctly
+
+import fnmatch
+import json
+
+from serverfakes import FakeSession
+
+import plugins.aaa # pylint: disable=wrong-import-position
+from plugins.catalogue import ListCatalogue # pylint: disable=wrong-import-position
+
+LISTS = {
+    "dev@foo.apache.org": {"count": 10, "private": False},
+    "private@foo.apache.org": {"count": 2, "private": True},
+    "users@bar.apache.org": {"count": 0, "private": False},
+    "dev@example.org": {"count": 5, "private": False},
+    "security@example.org": {"count": 1, "private": True},
+    "nodomain": {"count": 3, "private": False},
+}
+
+
+class FakeCredentials:
+    def __init__(self, authoritative):
+        self.authoritative = authoritative
+
+
+def session_for(host, authoritative=None):
+    return FakeSession(host=host, credentials=FakeCredentials(authoritative) if authoritative is not None else None)
+
+
+def per_request_lists(lists, focus_domain, session):
+    """The list tree as preferences.lua used to build it on every request"""
+    tree = {}
+    for ml, entry in lists.items():
+        if "@" in ml:
+            lname, ldomain = ml.split("@", 1)
+            can_access = True
+            if entry.get("private", True):
+                can_access = plugins.aaa.can_access_list(session, ml)
+            if focus_domain != "*":
+                if "*" in focus_domain:
+                    if not fnmatch.fnmatch(ldomain, focus_domain):
+                        continue
+                elif ldomain != (focus_domain or session.host):
+                    continue
+            if can_access:
+                tree.setdefault(ldomain, {})[lname] = entry["count"]
+    return tree
+
+
+def test_catalogue_views():
+    sessions = [
+        session_for(host, auth)
+        for host in ("foo.apache.org", "example.org", "unknown.org")
+        for auth in (None, False, True)
+    ]
+    for focus_domain in ("*", "*.apache.org", "example.org", ""):
+        catalogue = ListCatalogue(LISTS, focus_domain)
+        for session in sessions:
+            expected = per_request_lists(LISTS, focus_domain, session)
+            assert json.loads(catalogue.render(session)) == expected, (focus_domain, session.host)
+
+
+def test_catalogue_per_list_access(monkeypatch):
+    # A custom AAA that decides per list falls back to checking each private list
+    monkeypatch.setattr(plugins.aaa, "list_access_level", lambda session: None)
+    monkeypatch.setattr(plugins.aaa, "can_access_list", lambda session, listid: listid == "private@foo.apache.org")
+    catalogue = ListCatalogue(LISTS, "*")
+    session = session_for("foo.apache.org", True)
+    assert json.loads(catalogue.render(session)) == per_request_lists(LISTS, "*", session)
+    assert "security" not in json.loads(catalogue.render(session))["example.org"]
@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# To be run as: python3 -m pytest test/test_database.py
+# This ensures sys.path is set up correctly
+
+import asyncio
+import contextlib
+
+import elasticsearch.exceptions
+import pytest
+
+import serverfakes
+
+import plugins.attachments # pylint: disable=wrong-import-position
+import plugins.configuration # pylint: disable=wrong-import-position
+import plugins.database # pylint: disable=wrong-import-position
+import plugins.messages # pylint: disable=wrong-import-position
+
+DOCS = [{"_id": str(i), "_source": {"n": i}, "sort": [i]} for i in range(2500)]
+
+
+class FakeClient:
+    """Just enough of AsyncElasticsearch for Database.scan"""
+    def __init__(self, pit=True, version="7.17.0", info_failures=0):
+        self.pit = pit
+        self.version = version
+        self.info_failures = info_failures
+        self.open_pits = set()
+        self.scrolls = 0
+        self.searches = []
+
+    async def info(self):
+        if self.info_failures:
+            self.info_failures -= 1
+            raise elasticsearch.exceptions.ConnectionError("N/A", "connection refused", None)
+        return {"version": {"number": self.version}}
+
+    async def open_point_in_time(self, index, keep_alive):
+        if not self.pit:
+            raise elasticsearch.exceptions.RequestError(400, "no handler found", {})
+        self.open_pits.add("pit-1")
+        return {"id": "pit-1"}
+
+    async def close_point_in_time(self, body, ignore=()):
+        self.open_pits.discard(body["id"])
+
+    async def search(self, body, size, **kwargs):
+        self.searches.append((dict(body), size, kwargs))
+        if "scroll" in kwargs:
+            self.scrolls += 1
+            return {"_scroll_id": "scroll-1", "hits": {"hits": DOCS[:size]}}
+        assert body["pit"]["id"] in self.open_pits
+        assert "index" not in kwargs  # Not allowed together with a point in time
+        docs = DOCS
+        if "slice" in body:
+            docs = [doc for doc in docs if int(doc["_id"]) % body["slice"]["max"] == body["slice"]["id"]]
+        descending = body["sort"] == [{"n": {"order": "desc"}}]
+        if descending:
+            docs = docs[::-1]
+        if "search_after" in body:
+            after = body["search_after"][0]
+            docs = [doc for doc in docs if (doc["sort"][0] < after if descending else doc["sort"][0] > after)]
+        return {"pit_id": "pit-1", "hits": {"hits": docs[:size]}}
+
+    async def scroll(self, body):
+        return {"_scroll_id": "scroll-1", "hits": {"hits": []}}
+
+    async def clear_scroll(self, body, ignore=()):
+        pass
+
+
+def make_database(client):
+    db = plugins.database.Database(plugins.configuration.DBConfig({}))
+    db.client = client
+    return db
+
+
+async def collect(db, stop_after=None):
+    ids = []
+    async for hits in db.scan(query={"query": {"match_all": {}}}, size=1000):
+        ids.extend(hit["_id"] for hit in hits)
+        if stop_after and len(ids) >= stop_after:
+            break
+    return ids
+
+
+def test_pit_scan():
+    client = FakeClient()
+    ids = asyncio.run(collect(make_database(client)))
+    assert ids == [str(i) for i in range(2500)]
+    assert not client.open_pits
+    # The documents are tiny, so pages grow after the first one
+    assert client.searches[0][1] == 1000
+    assert client.searches[1][1] == plugins.database.PIT_MAX_PAGE_SIZE
+    assert client.searches[1][0]["search_after"] == [999]
+
+
+async def stop_early(client):
+    db = make_database(client)
+    scan = db.scan(query={"query": {"match_all": {}}})
+    await scan.__anext__()
+    assert client.open_pits
+    await scan.aclose()
+    assert not client.open_pits  # Released straight away, not when the point in time expires
+
+
+def test_pit_scan_early_termination():
+    asyncio.run(stop_early(FakeClient()))
+
+
+def test_scroll_fallback():
+    client = FakeClient(pit=False)
+    try:
+        ids = asyncio.run(collect(make_database(client)))
+        assert len(ids) == 1000
+        assert client.scrolls == 1
+        assert plugins.database.Database.pit_supported is False
+    finally:
+        plugins.database.Database.pit_supported = True
+
+
+def test_scroll_before_7_12():
+    # Elasticsearch 7.10 and 7.11 have points in time, but cannot sort on _shard_doc
+    client = FakeClient(version="7.11.2")
+    plugins.database.Database.pit_version_checked = False
+    try:
+        ids = asyncio.run(collect(make_database(client)))
+        assert len(ids) == 1000
+        assert client.scrolls == 1
+        assert not client.open_pits
+    finally:
+        plugins.database.Database.pit_supported = True
+        plugins.database.Database.pit_version_checked = False
+
+
+def test_version_check_retried():
+    # The version could not be checked the first time, so it is checked again rather than assumed
+    client = FakeClient(version="7.11.2", info_failures=1)
+    plugins.database.Database.pit_version_checked = False
+    try:
+        with pytest.raises(elasticsearch.exceptions.ConnectionError):
+            asyncio.run(collect(make_database(client)))
+        assert len(asyncio.run(collect(make_database(client)))) == 1000
+        assert client.scrolls == 1
+        assert not client.open_pits
+    finally:
+        plugins.database.Database.pit_supported = True
+        plugins.database.Database.pit_version_checked = False
+
+
+async def collect_parallel(db, order=None, stop_after=None):
+    query = {"query": {"match_all": {}}}
+    if order:
+        query["sort"] = [{"n": {"order": order}}]
+    ids = []
+    async with contextlib.aclosing(db.parallel_scan(query=query, slices=3, preserve_order=bool(order), size=100)) as pages:
+        async for hits in pages:
+            ids.extend(int(hit["_id"]) for hit in hits)
+            if stop_after and len(ids) >= stop_after:
+                break
+    return ids
+
+
+def test_parallel_scan():
+    client = FakeClient()
+    db = make_database(client)
+    assert sorted(asyncio.run(collect_parallel(db))) == list(range(2500))
+    assert {query[0]["slice"]["id"] for query in client.searches} == {0, 1, 2}
+    # Merged back into order across the slices
+    assert asyncio.run(collect_parallel(db, "asc")) == list(range(2500))
+    assert asyncio.run(collect_parallel(db, "desc")) == list(range(2499, -1, -1))
+    assert not client.open_pits
+
+
+def test_parallel_scan_early_termination():
+    client = FakeClient()
+    ids = asyncio.run(collect_parallel(make_database(client), "asc", stop_after=100))
+    assert ids == list(range(100))
+    assert not client.open_pits
+
+
+class SlowConnection(plugins.database.TunedConnection):
+    """Answers every request after a delay, without a database behind it"""
+    async def perform_request(self, method, url, params=None, body=None, timeout=None, ignore=(), headers=None):
+        await asyncio.sleep(0.2)
+        return 200, {}, "{}"
+
+
+async def run_deadline_test():
+    transport = plugins.database.LimitedTransport([{}], connection_class=SlowConnection, max_concurrency=1)
+    loop = asyncio.get_running_loop()
+    # No deadline, so the request is allowed to take its time
+    assert await transport.perform_request("GET", "/") == {}
+    # The request is given up once the deadline passes, along with the ones queued behind it
+    plugins.database.request_deadline.set(loop.time() + 0.1)
+    results = await asyncio.gather(*[transport.perform_request("GET", "/") for _ in range(3)], return_exceptions=True)
+    assert all(isinstance(result, plugins.database.Timeout) for result in results)
+    assert loop.time() < plugins.database.request_deadline.get() + 0.05
+    # Cleanup is still let through
+    with plugins.database.no_deadline():
+        assert await transport.perform_request("GET", "/") == {}
+
+
+def test_request_deadline():
+    asyncio.run(run_deadline_test())
+
+
+class FailingDatabase(serverfakes.FakeDatabase):
+    """Fails every get and delete with the given error"""
+    def __init__(self, error):
+        super().__init__()
+        self.error = error
+
+    async def get(self, **_kwargs):
+        raise self.error
+
+    async def delete(self, **_kwargs):
+        raise self.error
+
+
+def failing_session(error):
+    session = serverfakes.FakeSession(FailingDatabase(error))
+    session.server = serverfakes.FakeServer()
+    return session
+
+
+def test_lookups_past_deadline():
+    # Not found is an answer, but running out of time is not, and must reach the server as such
+    session = failing_session(elasticsearch.exceptions.NotFoundError(404, "not found", {}))
+    assert asyncio.run(plugins.attachments.get_attachment(session, "f00d")) is None
+    assert asyncio.run(plugins.attachments.remove_attachment(session, "f00d")) is False
+    assert asyncio.run(plugins.messages.get_source(session, "abc")) is None
+    session = failing_session(plugins.database.Timeout("N/A", "Request deadline exceeded", None))
+    for lookup in (
+        plugins.attachments.get_attachment(session, "f00d"),
+        plugins.attachments.remove_attachment(session, "f00d"),
+        plugins.messages.get_source(session, "abc"),
+        plugins.messages.get_email_versioned(session, permalink="abc"),
+    ):
+        with pytest.raises(plugins.database.Timeout):
+            asyncio.run(lookup)
@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# To be run as: python3 -m pytest test/test_dedup.py
+# This ensures sys.path is set up correctly
+
+from tools.plugins.dedup import ArchivedIds, BloomFilter
+
+
+class DedupElastic:
+    """Holds the mbox documents of one list, and serves them two at a time"""
+
+    db_mbox = "ponymail-mbox"
+
+    def __init__(self, docs):
+        self.docs = docs
+        self.pages = []
+        self.msearches = 0
+
+    def count(self, index, body):
+        return {"count": len(self.docs)}
+
+    def page(self):
+        hits = [{"_id": d["mid"], "_source": d} for d in self.pages[:2]]
+        del self.pages[:2]
+        return {"_scroll_id": "s", "hits": {"hits": hits}}
+
+    def search(self, index, scroll, body):
+        self.pages = list(self.docs)
+        return self.page()
+
+    def scroll(self, scroll, scroll_id):
+        return self.page()
+
+    def clear_scroll(self, scroll_id):
+        pass
+
+    def msearch(self, index, body):
+        self.msearches += 1
+        responses = []
+        for query in body[1::2]:
+            message_id = query["query"]["bool"]["must"][0]["term"]["message-id"]
+            hits = [{"_source": {"mid": d["mid"]}} for d in self.docs if d["message-id"] == message_id]
+            responses.append({"hits": {"hits": hits[:1]}})
+        return {"responses": responses}
+
+
+DOCS = [{"message-id": "<%u@example.org>" % n, "mid": "mid%u" % n} for n in range(5)]
+LOOKUP = [("<1@example.org>", "<dev.example.org>"), ("<new@example.org>", "<dev.example.org>"),
+          ("<4@example.org>", "<dev.example.org>")]
+
+
+def test_bloom_filter():
+    bloom = BloomFilter(1000, error_rate=0.01)
+    for n in range(1000):
+        bloom.add("<%u@example.org>" % n)
+    assert all("<%u@example.org>" % n in bloom for n in range(1000))
+    false_positives = sum("<%u@example.net>" % n in bloom for n in range(10000))
+    assert false_positives < 300
+
+
+def test_archived_ids():
+    elastic = DedupElastic(DOCS)
+    archived = ArchivedIds(elastic)
+    assert archived.find(LOOKUP) == ["mid1", None, "mid4"]
+    assert elastic.msearches == 0  # Answered from the Message-Ids read beforehand
+    assert archived.lists["<dev.example.org>"]["<3@example.org>"] == "mid3"
+
+
+def test_archived_ids_large():
+    elastic = DedupElastic(DOCS)
+    archived = ArchivedIds(elastic, max_ids=3)
+    assert archived.find(LOOKUP) == ["mid1", None, "mid4"]
+    # The Bloom filter lets only the likely duplicates through, which are looked up at once
+    assert elastic.msearches == 1
+    assert archived.lookups == 2
+
+
+def test_archived_ids_added():
+    # Messages archived during the run are found again, before the database shows them
+    for max_ids in (100, 3):
+        elastic = DedupElastic(DOCS)
+        archived = ArchivedIds(elastic, max_ids=max_ids)
+        assert archived.find(LOOKUP)[1] is None
+        assert archived.added("<new@example.org>", "<dev.example.org>") is None
+        archived.add("<new@example.org>", "<dev.example.org>", "newmid")
+        assert archived.added("<new@example.org>", "<dev.example.org>") == "newmid"
+        searches = elastic.msearches
+        assert archived.find(LOOKUP) == ["mid1", "newmid", "mid4"]
+        assert elastic.msearches == searches + (max_ids == 3)  # Only mid1 and mid4 need looking up
+        # Not archived after all
+        archived.forget("<new@example.org>", "<dev.example.org>")
+        assert archived.find(LOOKUP)[1] is None
@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# To be run as: python3 -m pytest test/test_delivery.py
+# This ensures sys.path is set up correctly
+
+import io
+import json
+import socket
+import threading
+
+from tools.plugins import delivery
+
+MESSAGE = b"List-Id: <dev.example.org>\r\nSubject: dots\r\n\r\n.leading dot\r\n..two\r\nend\r\n"
+
+
+class FakeServer:
+    """Records deliveries instead of archiving them"""
+
+    def __init__(self, status=0):
+        self.status = status
+        self.lmtp_argv = ["--private"]
+        self.delivered = []
+
+    def deliver(self, argv, raw_message):
+        self.delivered.append((argv, raw_message))
+        return self.status, "Done archiving\n"
+
+
+def serve(handler, server):
+    """Connects a handler to one end of a socket pair, in a thread, and returns the other end"""
+    ours, theirs = socket.socketpair()
+    threading.Thread(target=handler, args=(theirs, "test", server), daemon=True).start()
+    return ours
+
+
+def test_read_data():
+    stuffed = b".leading\r\n..two dots\r\nplain\r\n.\r\nnext command\r\n"
+    rfile = io.BytesIO(stuffed)
+    assert delivery.read_data(rfile) == b"leading\r\n.two dots\r\nplain\r\n"
+    assert rfile.readline() == b"next command\r\n"
+
+
+def test_socket_protocol():
+    server = FakeServer(status=255)
+    stream = serve(delivery.SocketHandler, server).makefile("rwb")
+    # One connection can carry several messages
+    for lid in ("dev", "users"):
+        status, output = delivery.submit_over(stream, ["--lid", lid], MESSAGE)
+        assert status == 255
+        assert output == "Done archiving\n"
+    assert server.delivered == [(["--lid", "dev"], MESSAGE), (["--lid", "users"], MESSAGE)]
+
+
+
+def test_socket_bad_request():
+    for line in (b"not json\n", b'{"args": []}\n', b'{"size": 5}\n', b'{"args": [], "size": "five"}\n',
+                 b'{"args": [], "size": -1}\n', b'{"args": "--lid", "size": 5}\n', b"[]\n"):
+        server = FakeServer()
+        stream = serve(delivery.SocketHandler, server).makefile("rwb")
+        stream.write(line)
+        stream.flush()
+        reply = json.loads(stream.readline())
+        assert reply["status"] == -1
+        assert reply["output"].startswith("Bad request")
+        assert stream.readline() == b""  # and the connection is closed
+        assert not server.delivered
+
+
+class LMTPClient:
+    """Talks LMTP line by line; smtplib.LMTP does not read the reply for each recipient after DATA"""
+
+    def __init__(self, sock):
+        self.stream = sock.makefile("rwb")
+        assert self.reply().startswith("220 ")
+
+    def reply(self):
+        return self.stream.readline().decode("utf-8").rstrip("\r\n")
+
+    def command(self, line):
+        self.stream.write(line.encode("utf-8") + b"\r\n")
+        self.stream.flush()
+        reply = self.reply()
+        while reply[3:4] == "-":  # Multi-line reply
+            reply = self.reply()
+        return reply
+
+    def send(self, recipients, raw_message):
+        assert self.command("MAIL FROM:<list@example.org>").startswith("250 ")
+        for recipient in recipients:
+            assert self.command("RCPT TO:<%s>" % recipient).startswith("250 ")
+        assert self.command("DATA").startswith("354 ")
+        stuffed = raw_message.replace(b"\r\n.", b"\r\n..")
+        if stuffed.startswith(b"."):
+            stuffed = b"." + stuffed
+        self.stream.write(stuffed + b".\r\n")
+        self.stream.flush()
+        return [self.reply() for _ in recipients]
+
+
+def test_lmtp():
+    server = FakeServer()
+    client = LMTPClient(serve(delivery.LMTPHandler, server))
+    assert client.command("LHLO test").startswith("250 ")
+    replies = client.send(["archive@example.org", "backup@example.org"], MESSAGE)
+    assert [reply[:3] for reply in replies] == ["250", "250"]
+    # Archived once, with the LMTP options, and exactly as sent despite the dot-stuffing
+    assert server.delivered == [(["--private"], MESSAGE)]
+
+    # Failures are temporary, so the MTA tries again
+    server.status = 255
+    assert [reply[:3] for reply in client.send(["archive@example.org"], MESSAGE)] == ["451"]
+    assert client.command("QUIT").startswith("221 ")
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# To be run as: python3 -m pytest test/test_gravatar.py
+# This ensures sys.path is set up correctly
+
+import asyncio
+import threading
+
+import aiohttp.test_utils
+import aiohttp.web
+
+import serverfakes
+from serverfakes import FakeServer, FakeSession
+
+from endpoints import gravatar # pylint: disable=wrong-import-position
+from plugins.cache import DiskCache, LRUCache # pylint: disable=wrong-import-position
+
+KNOWN = "0123456789abcdef0123456789abcdef"
+UNKNOWN = "fedcba9876543210fedcba9876543210"
+
+
+class FakeDatabase(serverfakes.FakeDatabase):
+    """Only KNOWN appears in the archives"""
+    def answer(self, **kwargs):
+        gid = kwargs["body"]["query"]["bool"]["must"][0]["term"]["gravatar"]
+        return {"hits": {"hits": [{"_id": "x"}] if gid == KNOWN else []}}
+
+
+async def start_upstream(fetches, monkeypatch):
+
+    # Stands in for secure.gravatar.com
+    async def avatar(request):
+        fetches.append(request.match_info["gid"])
+        await asyncio.sleep(0.05)  # Long enough for concurrent requests to pile up
+        return aiohttp.web.Response(body=b"PNG:" + request.match_info["gid"].encode())
+
+    app = aiohttp.web.Application()
+    app.router.add_get("/avatar/{gid}.png", avatar)
+    upstream = aiohttp.test_utils.TestServer(app)
+    await upstream.start_server()
+    monkeypatch.setattr(gravatar, "GRAVATAR_URL", str(upstream.make_url("/avatar/%s.png")))
+    return upstream
+
+
+def reset_caches():
+    gravatar.gravatar_cache = LRUCache(gravatar.CACHE_MAX_BYTES)
+    gravatar.gravatar_unknown.entries.clear()
+
+
+async def run_upstream_test(monkeypatch):
+    fetches = []
+    upstream = await start_upstream(fetches, monkeypatch)
+    session = FakeSession(FakeDatabase())
+    reset_caches()
+    try:
+        # Ten concurrent misses for the same hash cause one lookup and one upstream fetch
+        responses = await asyncio.gather(*[gravatar.process(None, session, {"md5": KNOWN}) for _ in range(10)])
+        assert all(r.body == b"PNG:" + KNOWN.encode() for r in responses)
+        assert fetches == [KNOWN]
+        assert len(session.database.searches) == 1
+
+        # Now served from memory
+        response = await gravatar.process(None, session, {"md5": KNOWN})
+        assert response.body == b"PNG:" + KNOWN.encode()
+        assert fetches == [KNOWN]
+
+        # Unknown hashes get the default image, and are only looked up once
+        for _ in range(3):
+            response = await gravatar.process(None, session, {"md5": UNKNOWN})
+            assert response.body == gravatar.gravatar_default
+        assert len(session.database.searches) == 2
+        assert fetches == [KNOWN]
+    finally:
+        await gravatar.close_client_session()
+        await upstream.close()
+
+
+def test_gravatar_upstream(monkeypatch):
+    asyncio.run(run_upstream_test(monkeypatch))
+
+
+async def run_disk_test(cache_dir, monkeypatch):
+    fetches = []
+    upstream = await start_upstream(fetches, monkeypatch)
+    server = FakeServer()
+    session = FakeSession(FakeDatabase())
+    reset_caches()
+    gravatar.gravatar_disk = DiskCache(cache_dir, 3600, 1024 * 1024)
+    try:
+        response = await gravatar.process(server, session, {"md5": KNOWN})
+        assert response.body == b"PNG:" + KNOWN.encode()
+        assert fetches == [KNOWN]
+
+        # A restart empties memory, but the disk tier is reloaded from the same directory
+        reset_caches()
+        gravatar.gravatar_disk = DiskCache(cache_dir, 3600, 1024 * 1024)
+        assert KNOWN in gravatar.gravatar_disk
+        response = await gravatar.process(server, session, {"md5": KNOWN})
+        assert response.body == b"PNG:" + KNOWN.encode()
+        assert fetches == [KNOWN]  # not fetched again
+        assert len(session.database.searches) == 1  # nor checked again
+    finally:
+        gravatar.gravatar_disk = None
+        await gravatar.close_client_session()
+        await upstream.close()
+
+
+def test_gravatar_disk_tier(tmp_path, monkeypatch):
+    asyncio.run(run_disk_test(str(tmp_path), monkeypatch))
+
+
+def test_lru_cache_byte_budget():
+    cache = LRUCache(10)
+    cache.put("a", b"1234")
+    cache.put("b", b"1234")
+    assert cache.get("a") == b"1234"  # a is now the most recently used
+    cache.put("c", b"1234")  # over budget, evicts b
+    assert "b" not in cache
+    assert cache.get("a") == b"1234"
+    assert cache.get("c") == b"1234"
+    assert cache.size == 8
+    cache.put("d", b"12345678901")  # larger than the whole budget, not cached
+    assert "d" not in cache
+    assert cache.size == 8
+
+
+def test_disk_cache_counts_from_threads(tmp_path):
+    cache = DiskCache(str(tmp_path), 3600, 1024 * 1024)
+    cache.put(KNOWN, b"PNG")
+
+    def lookups():
+        for _ in range(1000):
+            cache.get(KNOWN)
+            cache.get(UNKNOWN)
+
+    threads = [threading.Thread(target=lookups) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert (cache.hits, cache.misses) == (8000, 8000)
+
+
+async def run_cleanup_test():
+    server = FakeServer()
+    server.cleanups = []
+    gravatar.register(server)
+    client = gravatar.get_client_session()
+    for cleanup in server.cleanups:  # As the server does when it shuts down
+        await cleanup()
+    assert client.closed
+    assert gravatar.client_session is None
+
+
+def test_gravatar_client_closed_on_shutdown():
+    asyncio.run(run_cleanup_test())
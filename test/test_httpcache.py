@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# To be run as: python3 -m pytest test/test_httpcache.py
+# This ensures sys.path is set up correctly
+
+import asyncio
+import json
+
+import serverfakes
+from serverfakes import FakeServer, FakeSession
+
+from endpoints import email as email_endpoint # pylint: disable=wrong-import-position
+import plugins.httpcache # pylint: disable=wrong-import-position
+
+EMAIL = {
+    "mid": "abc", "message-id": "<abc@example.org>", "epoch": 1000, "private": False,
+    "list_raw": "<dev.example.org>", "from": "Jane <jane@example.org>", "subject": "Hello", "body": "Hi",
+    "attachments": [{"hash": "f00d", "filename": "a.txt", "content_type": "text/plain", "size": 4}],
+}
+
+
+class FakeDatabase(serverfakes.FakeDatabase):
+    """Holds EMAIL, at version seq_no"""
+    def __init__(self):
+        super().__init__()
+        self.seq_no = 1
+        self.gets = 0
+
+    async def get(self, index, id):  # pylint: disable=redefined-builtin
+        self.gets += 1
+        return {"_id": id, "_seq_no": self.seq_no, "_primary_term": 1, "_source": dict(EMAIL)}
+
+
+def test_matches():
+    session = FakeSession(None, 'W/"x", "abc"')
+    assert plugins.httpcache.matches(session, '"abc"')
+    assert plugins.httpcache.matches(session, '"x"')  # If-None-Match uses the weak comparison
+    assert not plugins.httpcache.matches(session, '"ab"')
+    assert plugins.httpcache.matches(FakeSession(None, "*"), '"abc"')
+    assert not plugins.httpcache.matches(FakeSession(None), '"abc"')
+
+
+async def run_email_test():
+    server = FakeServer()
+    database = FakeDatabase()
+    response = await email_endpoint.process(server, FakeSession(database), {"id": "abc"})
+    assert response.status == 200
+    assert json.loads(response.text)["mid"] == "abc"
+    assert response.headers["Cache-Control"] == "public, max-age=300"
+    etag = response.headers["ETag"]
+
+    # The client has this version already
+    response = await email_endpoint.process(server, FakeSession(database, etag), {"id": "abc"})
+    assert response.status == 304
+    assert response.headers["ETag"] == etag
+
+    # Any update to the document changes the tag
+    database.seq_no += 1
+    response = await email_endpoint.process(server, FakeSession(database, etag), {"id": "abc"})
+    assert response.status == 200
+    assert response.headers["ETag"] != etag
+
+    # Attachments never change, and are checked before fetching them
+    indata = {"id": "abc", "attachment": "true", "file": "f00d"}
+    tag = plugins.httpcache.make_etag("attachment", "f00d", "text/plain", "a.txt")
+    response = await email_endpoint.process(server, FakeSession(database, tag), indata)
+    assert response.status == 304
+    assert "immutable" in response.headers["Cache-Control"]
+
+
+def test_email_etag():
+    asyncio.run(run_email_test())
+
+
+async def run_content_tag_test():
+    server = FakeServer()
+    response = await plugins.httpcache.json_response(server, FakeSession(None), {"thread": 1}, 0)
+    assert response.status == 200
+    etag = response.headers["ETag"]
+    response = await plugins.httpcache.json_response(server, FakeSession(None, etag), {"thread": 1}, 0)
+    assert response.status == 304
+    response = await plugins.httpcache.json_response(server, FakeSession(None, etag), {"thread": 2}, 0)
+    assert response.status == 200
+
+
+def test_content_etag():
+    asyncio.run(run_content_tag_test())
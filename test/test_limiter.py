@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# To be run as: python3 -m pytest test/test_limiter.py
+# This ensures sys.path is set up correctly
+
+import asyncio
+
+import serverfakes # pylint: disable=unused-import # puts the server code on sys.path
+
+from plugins.limiter import EndpointLimiter # pylint: disable=wrong-import-position
+
+
+async def run_limiter_test():
+    limiter = EndpointLimiter(concurrency=1, queue_depth=1, queue_timeout=5)
+    assert await limiter.acquire()  # runs straight away
+    queued = asyncio.ensure_future(limiter.acquire())  # waits for a turn
+    await asyncio.sleep(0)
+    assert limiter.state()["waiting"] == 1
+    assert not await limiter.acquire()  # queue is full, turned away
+    limiter.release()
+    assert await queued
+    limiter.release()
+    assert limiter.state() == {
+        "concurrency": 1, "queue_depth": 1, "active": 0, "waiting": 0, "served": 2, "rejected": 1,
+    }
+
+    # Waiting too long for a turn also gets a request turned away
+    limiter = EndpointLimiter(concurrency=1, queue_depth=10, queue_timeout=0.01)
+    assert await limiter.acquire()
+    assert not await limiter.acquire()
+    assert limiter.state()["waiting"] == 0
+    assert limiter.state()["rejected"] == 1
+
+
+def test_limiter():
+    asyncio.run(run_limiter_test())
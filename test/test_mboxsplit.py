@@ -0,0 +1,87 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# To be run as: python3 -m pytest test/test_mboxsplit.py
+# This ensures sys.path is set up correctly
+
+import glob
+import gzip
+import io
+import mailbox
+import os
+
+import pytest
+
+from tools.plugins.mboxo_patch import MboxoReader
+from tools.plugins.mboxsplit import read_messages, split_stream
+
+RESOURCES = os.path.join(os.path.dirname(os.path.abspath(__file__)), "resources")
+
+# Text before the first message, a blank line that belongs to the message, no blank line
+# before a "From " line, a mangled ">From " line, CRLF lines and no newline at the end
+AWKWARD = (
+    b"preamble\n"
+    b"From a@example.org Mon Jan  1 00:00:00 2024\nSubject: one\n\nbody\n\n\n"
+    b"From b@example.org Mon Jan  1 00:00:00 2024\nSubject: two\n\n>From here\nnot>From\n"
+    b"From c@example.org Mon Jan  1 00:00:00 2024\r\nSubject: three\r\n\r\nbody\r\n\r\n"
+    b"From d@example.org Mon Jan  1 00:00:00 2024\nSubject: four\n\nlast"
+)
+
+
+def mailbox_messages(path, mboxo):
+    """The raw messages as mailbox.mbox and MboxoReader read them"""
+    box = mailbox.mbox(path, create=False)
+    raws = []
+    for key in box.iterkeys():
+        file = box.get_file(key, True)
+        if mboxo:
+            file = MboxoReader(file)
+        raws.append(file.read())
+        file.close()
+    return raws
+
+
+def mbox_paths(tmp_path):
+    awkward = tmp_path / "awkward.mbox"
+    awkward.write_bytes(AWKWARD)
+    return sorted(glob.glob(os.path.join(RESOURCES, "*.mbox"))) + [str(awkward)]
+
+
+@pytest.mark.parametrize("mboxo", [True, False])
+def test_same_as_mailbox(tmp_path, mboxo):
+    for path in mbox_paths(tmp_path):
+        expected = mailbox_messages(path, mboxo)
+        assert list(read_messages(path, mboxo)) == expected, path
+        compressed = tmp_path / "compressed.mbox.gz"
+        with open(path, "rb") as f:
+            compressed.write_bytes(gzip.compress(f.read()))
+        assert list(read_messages(str(compressed), mboxo)) == expected, path
+
+
+def test_split_stream_chunks():
+    expected = list(split_stream(io.BytesIO(AWKWARD)))
+    assert len(expected) == 4
+    # Boundaries split between reads are found all the same
+    for chunk_size in (1, 2, 5, 6, 7, 64):
+        assert list(split_stream(io.BytesIO(AWKWARD), chunk_size)) == expected
+
+
+def test_empty(tmp_path):
+    empty = tmp_path / "empty.mbox"
+    empty.write_bytes(b"")
+    assert not list(read_messages(str(empty)))
+    assert not list(split_stream(io.BytesIO(b"no messages\n")))
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# To be run as: python3 -m pytest test/test_metrics.py
+# This ensures sys.path is set up correctly
+
+import asyncio
+
+import aiohttp.web
+
+import serverfakes
+
+import plugins.database # pylint: disable=wrong-import-position
+import plugins.metrics # pylint: disable=wrong-import-position
+from endpoints import metrics # pylint: disable=wrong-import-position
+from plugins.cache import LRUCache # pylint: disable=wrong-import-position
+from plugins.limiter import EndpointLimiter # pylint: disable=wrong-import-position
+
+
+class FakeServer(serverfakes.FakeServer):
+    """With the database connection pool and limiters that the metrics report on"""
+    def __init__(self):
+        super().__init__()
+        self.database = plugins.database.Database(self.config.database)
+        self.limiters = {"mbox": EndpointLimiter(2, 4, 30)}
+
+
+def test_histogram_buckets():
+    histogram = plugins.metrics.Histogram()
+    for seconds in (0.001, 0.005, 0.2, 100):
+        histogram.observe(seconds)
+    out = plugins.metrics.Exposition()
+    out.histogram("latency", {"endpoint": "stats"}, histogram)
+    lines = out.text().splitlines()
+    # Buckets are cumulative, and an observation on a bound falls into that bucket
+    assert 'latency_bucket{endpoint="stats",le="0.005"} 2' in lines
+    assert 'latency_bucket{endpoint="stats",le="0.25"} 3' in lines
+    assert 'latency_bucket{endpoint="stats",le="30.0"} 3' in lines
+    assert 'latency_bucket{endpoint="stats",le="+Inf"} 4' in lines
+    assert 'latency_count{endpoint="stats"} 4' in lines
+
+
+def test_render():
+    registry = plugins.metrics.registry = plugins.metrics.Registry()
+    registry.observe_request("stats", 200, 0.03)
+    registry.observe_request("stats", 200, 0.04)
+    registry.observe_request("mbox", 503, 0.0)
+    registry.observe_db("search", 0.05, 12)
+    registry.observe_db("search", 0.5, None, failed=True)
+    cache = LRUCache(100)
+    cache.put("a", b"1")
+    cache.get("a")
+    cache.get("b")
+    registry.caches["test"] = lambda: cache
+    registry.caches["disabled"] = lambda: None
+
+    async def run():
+        server = FakeServer()
+        try:
+            return metrics.render(server)
+        finally:
+            await server.database.client.close()
+
+    lines = asyncio.run(run()).splitlines()
+    assert 'ponymail_http_requests_total{endpoint="stats",status="200"} 2' in lines
+    assert 'ponymail_http_requests_total{endpoint="mbox",status="503"} 1' in lines
+    assert 'ponymail_db_request_duration_seconds_count{method="search"} 2' in lines
+    assert 'ponymail_db_took_seconds_total{method="search"} 0.012' in lines
+    assert 'ponymail_db_errors_total{method="search"} 1' in lines
+    assert 'ponymail_db_pool_size 15' in lines
+    assert 'ponymail_offloader_queue_depth 0' in lines
+    assert 'ponymail_cache_hit_ratio{cache="test"} 0.5' in lines
+    assert not any('cache="disabled"' in line for line in lines)
+    assert 'ponymail_limiter_waiting{endpoint="mbox"} 0' in lines
+    # Every sample belongs to a family declared before it
+    declared = set()
+    for line in lines:
+        if line.startswith("# TYPE "):
+            declared.add(line.split()[2])
+        elif not line.startswith("#"):
+            name = line.split("{")[0].split()[0]
+            assert any(name == family or name.startswith(family + "_") for family in declared), line
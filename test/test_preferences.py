@@ -0,0 +1,75 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# To be run as: python3 -m pytest test/test_preferences.py
+# This ensures sys.path is set up correctly
+
+import asyncio
+import json
+
+import serverfakes
+from serverfakes import FakeSession
+
+import endpoints.preferences # pylint: disable=wrong-import-position
+import plugins.configuration # pylint: disable=wrong-import-position
+from plugins.catalogue import ListCatalogue # pylint: disable=wrong-import-position
+
+LISTS = {
+    "dev@foo.apache.org": {"count": 10, "private": False},
+    "private@foo.apache.org": {"count": 2, "private": True},
+}
+
+
+class FakeServer(serverfakes.FakeServer):
+    def __init__(self):
+        super().__init__()
+        self.foal_version = "test"
+        self.server_version = "test"
+        self.data = plugins.configuration.InterData()
+        self.data.lists = LISTS
+
+
+class FakeCredentials:
+    uid = "jdoe"
+    email = "jdoe@foo.apache.org"
+    name = 'J. "<lists>" Doe\n}'  # Everything that would trip up splicing
+    admin = False
+    authoritative = True
+
+
+def preferences(server, session):
+    response = asyncio.run(endpoints.preferences.process(server, session, {}))
+    return json.loads(response.text)
+
+
+def test_preferences_lists():
+    server = FakeServer()
+    for catalogue in (None, ListCatalogue(LISTS, "*")):  # Before and after the first refresh
+        server.data.catalogue = catalogue
+        prefs = preferences(server, FakeSession())
+        assert prefs["lists"] == {"foo.apache.org": {"dev": 10}}
+        assert prefs["login"] == {}
+        assert prefs["versions"] == {"foal": "test"}
+
+
+def test_preferences_credentials():
+    server = FakeServer()
+    server.data.catalogue = ListCatalogue(LISTS, "*")
+    prefs = preferences(server, FakeSession(credentials=FakeCredentials()))
+    assert prefs["lists"] == {"foo.apache.org": {"dev": 10, "private": 2}}
+    assert prefs["login"]["credentials"]["fullname"] == FakeCredentials.name
+    assert list(prefs) == ["login", "versions", "lists"]
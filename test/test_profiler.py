@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# To be run as: python3 -m pytest test/test_profiler.py
+# This ensures sys.path is set up correctly
+
+import json
+
+from tools import archiver
+from tools.plugins import profiler
+
+
+def test_profile(tmp_path):
+    log = tmp_path / "profile.jsonl"
+    prof = profiler.Profiler(str(log))
+    raw = open("test/resources/rfc2822-A5.eml", "rb").read()
+    archie = archiver.Archiver()
+    for number in range(2):
+        prof.begin(number=number)
+        archie.compute_updates("<a.b.c>", False, archiver.parse_message(raw), raw)
+        profiler.label(done=True)
+    with prof.stage("es_bulk"):
+        pass
+    prof.close()
+
+    entries = [json.loads(line) for line in log.read_text().splitlines()]
+    assert [(e["number"], e["done"]) for e in entries] == [(0, True), (1, True)]
+    assert {"parse", "mime", "generator", "unflow"} <= set(entries[0]["stages_ms"])
+    assert entries[0]["counters"]["bytes"] == len(raw)
+    assert prof.messages == 2
+    assert prof.stages["parse"].calls == 2
+    assert prof.batch_stages["es_bulk"].calls == 1
+    summary = prof.summary()
+    assert summary.startswith("Profile of 2 messages")
+    assert "es_bulk (batch)" in summary
+
+
+def test_not_profiling():
+    # Outside a profiled message, stages and counters do nothing
+    assert profiler.stage("parse") is profiler.NOT_PROFILING
+    profiler.count("bytes", 10)
+    profiler.label(mid="x")
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# To be run as: python3 -m pytest test/test_spool.py
+# This ensures sys.path is set up correctly
+
+import threading
+
+from tools.plugins.spool import Spool
+
+
+def test_append_and_flush(tmp_path):
+    spool = Spool(str(tmp_path), segment_size=200)
+    for i in range(10):
+        spool.append({"id": i, "padding": "x" * 50})
+    assert len(spool.segments()) > 1  # Rotated as segments filled up
+    assert spool.backlog()[0] == 10
+
+    batches = list(spool.batches(4))
+    assert [record["id"] for batch in batches for record in batch.records] == list(range(10))
+    # Nothing is consumed until committed
+    assert spool.backlog()[0] == 10
+    spool.commit(batches[0].end)
+    assert spool.backlog()[0] == 10 - len(batches[0].records)
+    assert [record["id"] for record in next(spool.batches(100)).records][0] == len(batches[0].records)
+
+    for batch in spool.batches(100):
+        spool.commit(batch.end)
+    assert spool.backlog() == (0, 0)
+    assert len(spool.segments()) == 1  # Finished segments are deleted, the newest is kept for writers
+
+    # Appending carries on after the checkpoint
+    spool.append({"id": 10})
+    assert [record["id"] for batch in spool.batches(100) for record in batch.records] == [10]
+
+
+def test_partial_record(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append({"id": 1})
+    spool.close()
+    with open(spool.segment_path(spool.segments()[-1]), "ab") as f:
+        f.write(b'{"id": 2, "cut short')  # As a crash in the middle of a write would leave it
+    assert [record["id"] for batch in spool.batches(100) for record in batch.records] == [1]
+
+
+def test_append_after_partial_record(tmp_path):
+    spool = Spool(str(tmp_path))
+    spool.append({"id": 1})
+    with open(spool.segment_path(spool.segments()[-1]), "ab") as f:
+        f.write(b'{"id": 2, "trunc')  # Another writer crashed here
+    spool.append({"id": 3})
+    Spool(str(tmp_path)).append({"id": 4})  # And after a restart
+    assert len(spool.segments()) == 2
+    assert [record["id"] for batch in spool.batches(100) for record in batch.records] == [1, 3, 4]
+
+
+def test_group_commit(tmp_path):
+    spool = Spool(str(tmp_path))
+    threads = [threading.Thread(target=spool.append, args=({"id": i},)) for i in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert spool.synced == 20
+    assert sorted(record["id"] for batch in spool.batches(100) for record in batch.records) == list(range(20))
@@ -0,0 +1,142 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# To be run as: python3 -m pytest test/test_stats.py
+# This ensures sys.path is set up correctly
+
+import asyncio
+import datetime
+
+import pytest
+
+import serverfakes
+from serverfakes import FakeSession
+
+from endpoints import stats # pylint: disable=wrong-import-position
+import plugins.messages # pylint: disable=wrong-import-position
+
+# Five public emails, two of them sent in the same second
+EMAILS = [
+    {"mid": "m%u" % i, "epoch": 1000 + i // 2, "private": False, "list_raw": "<dev.example.org>",
+     "from": "Jane <jane@example.org>", "subject": "Hello", "body_short": "Hi"}
+    for i in range(5)
+]
+
+
+class FakeDatabase(serverfakes.FakeDatabase):
+    """Answers search_after queries over EMAILS the way Elasticsearch would"""
+    def answer(self, body, size, **_kwargs):
+        hits = [{"_source": dict(doc), "sort": [doc["epoch"], doc["mid"]]} for doc in EMAILS]
+        hits.sort(key=lambda hit: hit["sort"])
+        if "search_after" in body:
+            hits = [hit for hit in hits if hit["sort"] > body["search_after"]]
+        return {"hits": {"hits": hits[:size]}}
+
+
+async def fetch_all_pages(session, page_size):
+    mids = []
+    cursor = None
+    while True:
+        search_after = stats.decode_cursor(cursor) if cursor else None
+        page, next_after = await plugins.messages.query_page(session, {"must": []}, page_size, search_after)
+        mids.extend(doc["mid"] for doc in page)
+        cursor = stats.encode_cursor(next_after)
+        if not cursor:
+            return mids
+
+
+def test_query_page():
+    session = FakeSession(FakeDatabase())
+    mids = asyncio.run(fetch_all_pages(session, 2))
+    assert mids == ["m0", "m1", "m2", "m3", "m4"]  # every email exactly once, oldest first
+    assert len(session.database.searches) == 3
+    assert "search_after" not in session.database.searches[0]["body"]
+
+
+def test_cursor():
+    assert stats.decode_cursor(stats.encode_cursor([1000, "m1"])) == [1000, "m1"]
+    assert stats.encode_cursor(None) is None
+    for cursor in ("", "not a cursor!", stats.encode_cursor(["x", "y"]), stats.encode_cursor([1])):
+        with pytest.raises(ValueError):
+            stats.decode_cursor(cursor)
+
+
+def test_query_limit(monkeypatch):
+    # m1 is private, so the anonymous user cannot see it and a second search fills the gap
+    monkeypatch.setitem(EMAILS[1], "private", True)
+    session = FakeSession(FakeDatabase())
+    docs = asyncio.run(plugins.messages.query(session, {"must": []}, query_limit=3, epoch_order="asc"))
+    assert [doc["mid"] for doc in docs] == ["m0", "m2", "m3"]
+    assert len(session.database.searches) == 2  # plain searches, no scan
+    assert session.database.searches[1]["body"]["search_after"] == [1001, "m2"]
+
+
+class WatermarkDatabase(serverfakes.FakeDatabase):
+    """Aggregates EMAILS for get_watermark, with window holding the mids in the date range"""
+    def __init__(self):
+        super().__init__()
+        self.window = ["m3", "m4"]
+
+    def answer(self, index, size, body):
+        in_window = [doc for doc in EMAILS if doc["mid"] in self.window]
+        aggregations = {"seq_no": {"value": 5}}
+        if "window" in body["aggs"]:
+            aggregations["window"] = {"doc_count": len(in_window), "epoch": {"value": sum(d["epoch"] for d in in_window)}}
+        return {"hits": {"total": {"value": len(EMAILS)}}, "aggregations": aggregations}
+
+
+def test_watermark_window():
+    session = FakeSession(WatermarkDatabase())
+    before = asyncio.run(plugins.messages.get_watermark(session, {"must": []}, {"must": []}))
+    # As now moves on, an email leaves the range and another one enters it, though none of them changed
+    session.database.window = ["m1", "m4"]
+    after = asyncio.run(plugins.messages.get_watermark(session, {"must": []}, {"must": []}))
+    assert before != after
+    assert asyncio.run(plugins.messages.get_watermark(session, {"must": []})) == "5:5"
+
+
+async def revalidate(monkeypatch):
+    """Fetches the stats of a list, then asks again with the ETag of that response"""
+    searches = []
+
+    async def fake_query(_session, _query, **_kwargs):
+        searches.append(_query)
+        return [dict(doc) for doc in EMAILS]
+
+    async def fake_activity_span(_session, _query):
+        return datetime.datetime(2020, 1, 1), datetime.datetime(2020, 2, 1), {}
+
+    async def fake_accessible_filter(_session, _query):
+        return None
+
+    monkeypatch.setattr(plugins.messages, "query", fake_query)
+    monkeypatch.setattr(plugins.messages, "get_activity_span", fake_activity_span)
+    monkeypatch.setattr(plugins.messages, "get_accessible_filter", fake_accessible_filter)
+    server = serverfakes.FakeServer()
+    indata = {"list": "dev", "domain": "example.org", "quick": ""}
+    first = await stats.process(server, FakeSession(WatermarkDatabase()), indata)
+    assert first.status == 200
+    second = await stats.process(server, FakeSession(WatermarkDatabase(), first.headers["ETag"]), indata)
+    return first, second, searches
+
+
+def test_stats_first_revalidation(monkeypatch):
+    # The tag of the first response, sent without If-None-Match, is the one a revalidation works out
+    first, second, searches = asyncio.run(revalidate(monkeypatch))
+    assert second.status == 304
+    assert second.headers["ETag"] == first.headers["ETag"]
+    assert len(searches) == 1  # The full query only ran for the first response
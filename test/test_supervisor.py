@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# To be run as: python3 -m pytest test/test_supervisor.py
+# This ensures sys.path is set up correctly
+
+import asyncio
+import multiprocessing
+
+import serverfakes # pylint: disable=unused-import # puts the server code on sys.path
+
+import plugins.configuration # pylint: disable=wrong-import-position
+import plugins.session # pylint: disable=wrong-import-position
+import plugins.supervisor # pylint: disable=wrong-import-position
+
+
+class FakeWorker:
+    """The state a worker keeps in memory, with its end of the pipe"""
+
+    def __init__(self, index, conn):
+        self.data = plugins.configuration.InterData()
+        self.link = plugins.supervisor.WorkerLink(conn, index)
+        self.library_version = ""
+        self.engine_version = ""
+
+    def poll(self):
+        """Applies the messages waiting in the pipe, as the event loop would, and returns their kinds"""
+        kinds = []
+        while self.link.conn.poll(0.1):
+            message = self.link.conn.recv()
+            plugins.supervisor.WorkerLink.apply(self, message)
+            kinds.append(message[0])
+        return kinds
+
+
+class FakeSupervisor(plugins.supervisor.Supervisor):
+    def __init__(self, workers):  # pylint: disable=super-init-not-called # No config, database or processes
+        self.workers = workers
+        self.data = plugins.configuration.InterData()
+        self.conns = []
+        self.fakes = []
+        for index in range(workers):
+            conn, worker_conn = multiprocessing.Pipe()
+            self.conns.append(conn)
+            self.fakes.append(FakeWorker(index, worker_conn))
+        self.outboxes = [[] for _ in range(workers)]
+        self.writers = [None] * workers
+        self.refreshed = False
+        self.library_version = "7.13.4"
+        self.engine_version = "7.17.0"
+
+    async def sent(self):
+        """Waits until the workers have been sent all queued messages"""
+        await asyncio.gather(*[writer for writer in self.writers if writer is not None])
+
+
+async def refresh(supervisor):
+    supervisor.data_refreshed()
+    await supervisor.sent()
+
+
+def test_shared_data():
+    supervisor = FakeSupervisor(3)
+    supervisor.data.lists = {"example.org": {"dev": 10}}
+    supervisor.data.catalogue = "catalogue"
+    asyncio.run(refresh(supervisor))
+    for worker in supervisor.fakes:
+        worker.poll()
+        assert worker.data.lists == {"example.org": {"dev": 10}}
+        assert worker.data.catalogue == "catalogue"
+        assert worker.engine_version == "7.17.0"
+
+
+def test_forget_session():
+    supervisor = FakeSupervisor(3)
+    for worker in supervisor.fakes:
+        worker.data.sessions["cookie"] = object()
+        worker.data.sessions["other"] = object()
+    # Worker 1 logs the session out, and tells the supervisor, which tells the others
+    plugins.session.forget_session(supervisor.fakes[1], "cookie")
+
+    async def receive():
+        supervisor.receive(1)
+        await supervisor.sent()
+
+    asyncio.run(receive())
+    for worker in supervisor.fakes:
+        worker.poll()
+        assert "cookie" not in worker.data.sessions
+        assert "other" in worker.data.sessions
+    # The worker that sent it does not get it back
+    assert not supervisor.fakes[1].link.conn.poll()
+
+
+async def run_stuck_worker_test():
+    supervisor = FakeSupervisor(2)
+    stuck, other = supervisor.fakes
+    # Each refresh is larger than the pipe can hold, so the first one is left half written
+    for n in range(5):
+        supervisor.data.lists = {"example.org": {"dev": n}, "padding": "x" * 1024 * 1024}
+        supervisor.data_refreshed()
+        await asyncio.sleep(0.1)  # The supervisor is not held up meanwhile
+    # Nor are the other workers
+    assert other.link.conn.poll(0)
+    # Of the refreshes waiting, only the latest is sent once the worker reads again
+    loop = asyncio.get_running_loop()
+    kinds, _ = await asyncio.gather(loop.run_in_executor(None, stuck.poll), loop.run_in_executor(None, other.poll))
+    await supervisor.sent()
+    assert kinds == ["data", "data"]
+    assert stuck.data.lists["example.org"] == {"dev": 4}
+
+
+def test_stuck_worker():
+    asyncio.run(run_stuck_worker_test())
@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# To be run as: python3 -m pytest test/test_tracing.py
+# This ensures sys.path is set up correctly
+
+import asyncio
+
+import serverfakes # pylint: disable=unused-import # puts the server code on sys.path
+
+import plugins.configuration # pylint: disable=wrong-import-position
+import plugins.tracing # pylint: disable=wrong-import-position
+from plugins.tracing import span # pylint: disable=wrong-import-position
+
+
+def make_tracer(**config):
+    return plugins.tracing.Tracer(plugins.configuration.TracingConfig({"enabled": True, **config}))
+
+
+async def handle(tracer, forced):
+    """Stands in for Server.handle_request, with two stages running concurrently in the second"""
+    trace = tracer.start("stats", "/api/stats.lua?list=dev", forced=forced)
+    with span("defuzz"):
+        pass
+    with span("query"):
+        async def fetch(name):
+            with span(name):
+                await asyncio.sleep(0.01)
+        await asyncio.gather(fetch("db.search"), fetch("db.scan"))
+    if trace:
+        tracer.finish(trace, 200)
+    return trace
+
+
+def test_span_tree():
+    tracer = make_tracer(sample_rate=0)
+    assert asyncio.run(handle(tracer, forced=False)) is None  # Not sampled
+    assert not tracer.traces
+    trace = asyncio.run(handle(tracer, forced=True))
+    assert tracer.get(trace.request_id) is trace
+    tree = trace.as_dict()
+    assert tree["status"] == 200
+    assert [child["name"] for child in tree["spans"]["children"]] == ["defuzz", "query"]
+    query = tree["spans"]["children"][1]
+    assert sorted(child["name"] for child in query["children"]) == ["db.scan", "db.search"]
+    assert query["duration"] >= 10
+
+
+def test_sampling_and_history():
+    tracer = make_tracer(sample_rate=1, history=3)
+    traces = [asyncio.run(handle(tracer, forced=False)) for _ in range(5)]
+    assert list(tracer.traces) == [trace.request_id for trace in traces[2:]]
+    # Disabled tracing ignores forced traces too
+    tracer = plugins.tracing.Tracer(plugins.configuration.TracingConfig({"sample_rate": 1}))
+    assert asyncio.run(handle(tracer, forced=True)) is None
+
+
+def test_slow_log(capsys):
+    tracer = make_tracer(slow_threshold=0.005)
+    trace = asyncio.run(handle(tracer, forced=True))
+    err = capsys.readouterr().err
+    assert f"Slow request {trace.request_id}" in err
+    assert f"{trace.request_id}: " in err and "db.search" in err
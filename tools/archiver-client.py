@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Drop-in replacement for archiver.py in /etc/aliases or .forward files, which hands
+the message on standard input to archiver-daemon.py instead of archiving it itself.
+
+    mylist: "| /opt/ponymail/tools/archiver-client.py --socket /run/ponymail/archiver.sock --lid mylist@example.org"
+
+All options except --socket are passed on to the daemon, and mean the same as for archiver.py.
+The client prints what archiver.py would have, and exits with the same status. If the daemon
+cannot be reached, it exits with EX_TEMPFAIL so the MTA keeps the message and tries again later.
+Only the standard library is loaded, to keep the start-up cost per message low.
+"""
+
+import sys
+
+if not __package__:
+    from plugins import delivery # pylint: disable=no-name-in-module
+else:
+    from .plugins import delivery
+
+DEFAULT_SOCKET = "/run/ponymail/archiver.sock"
+EX_TEMPFAIL = 75  # from sysexits.h
+
+
+def main():
+    argv = sys.argv[1:]
+    path = DEFAULT_SOCKET
+    if "--socket" in argv:
+        where = argv.index("--socket")
+        path = argv[where + 1]
+        del argv[where:where + 2]
+    raw_message = sys.stdin.buffer.read()
+    try:
+        status, output = delivery.submit(path, argv, raw_message)
+    except (OSError, delivery.ProtocolError) as err:
+        print("Could not hand the message to the archiver daemon at %s: %s" % (path, err))
+        sys.exit(EX_TEMPFAIL)
+    sys.stdout.write(output)
+    if status:
+        sys.exit(status)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,171 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Long-running archiver service.
+
+Piping each message to archiver.py starts a new Python process, which loads all of the archiver's
+modules and connects to the database again for every message. This daemon does that once, and then
+archives messages handed to it by archiver-client.py over a Unix socket, or by the MTA over LMTP.
+
+Run it as:
+    archiver-daemon.py --socket /run/ponymail/archiver.sock [--lmtp 127.0.0.1:8024] [-- LMTP archiver.py options]
+
+and replace archiver.py in /etc/aliases by the client, which takes the same options:
+    mylist: "| /opt/ponymail/tools/archiver-client.py --socket /run/ponymail/archiver.sock --lid mylist@example.org"
+
+Messages delivered over LMTP are archived with the archiver.py options given after --.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import signal
+import socketserver
+import sys
+import threading
+import typing
+
+if not __package__:
+    import archiver
+    from plugins import delivery # pylint: disable=no-name-in-module
+    from plugins.elastic import Elastic # pylint: disable=no-name-in-module
+else:
+    from . import archiver
+    from .plugins import delivery
+    from .plugins.elastic import Elastic
+
+
+class ArchiverDaemon:
+    """Archives messages with one database connection, kept open between them"""
+
+    def __init__(self, lmtp_argv: typing.List[str]):
+        self.lmtp_argv = lmtp_argv
+        self.elastic: typing.Optional[Elastic] = None
+        # One message at a time: archiver.py's output is captured by swapping sys.stdout
+        self.lock = threading.Lock()
+
+    def connection(self) -> Elastic:
+        if self.elastic is None:
+            self.elastic = Elastic()
+        return self.elastic
+
+    def deliver(self, argv: typing.List[str], raw_message: bytes) -> typing.Tuple[int, str]:
+        """Archives a message as archiver.py would with these options, returns its exit status and output"""
+        output = io.StringIO()
+        with self.lock, contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            status = self.archive(argv, raw_message)
+        text = output.getvalue()
+        sys.stdout.write(text)
+        sys.stdout.flush()
+        return status, text
+
+    def archive(self, argv: typing.List[str], raw_message: bytes) -> int:
+        try:
+            args = archiver.get_parser().parse_args(argv)
+        except SystemExit as e:  # argparse has already said what is wrong
+            return int(e.code or 0)
+        elastic = None
+        if not (args.dry or args.digest):
+            try:
+                elastic = self.connection()
+            except Exception as err:
+                # archive_message will try again, and dump the message if asked to
+                print("Could not connect to the database: %s" % err)
+        try:
+            return archiver.archive_input(args, argv, raw_message, elastic)
+        except SystemExit as e:
+            # archive_message exits after dumping a message it could not index (--dumponfail)
+            return int(e.code or 0)
+
+
+class DeliveryServer:
+    """What the handlers in plugins/delivery.py expect of their server"""
+    deliver: typing.Callable[[typing.List[str], bytes], typing.Tuple[int, str]]
+    lmtp_argv: typing.List[str]
+
+
+class UnixServer(DeliveryServer, socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+class TCPServer(DeliveryServer, socketserver.ThreadingMixIn, socketserver.TCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def make_server(address: str, handler, daemon: ArchiverDaemon, mode: int) -> socketserver.BaseServer:
+    """Listens on a Unix socket if the address is a path, or on host:port otherwise"""
+    server: typing.Union[UnixServer, TCPServer]
+    if "/" in address:
+        if os.path.exists(address):
+            os.unlink(address)  # Left over from a previous run
+        server = UnixServer(address, handler)
+        os.chmod(address, mode)
+    else:
+        host, _, port = address.rpartition(":")
+        server = TCPServer((host or "127.0.0.1", int(port)), handler)
+    server.deliver = daemon.deliver
+    server.lmtp_argv = daemon.lmtp_argv
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Archives messages handed to it over a socket or LMTP.")
+    parser.add_argument("--socket", help="Unix socket to accept messages from archiver-client.py on")
+    parser.add_argument("--lmtp", help="Address to accept LMTP deliveries on: host:port, or the path of a Unix socket")
+    parser.add_argument(
+        "--mode", default="660", help="Permissions (octal) for Unix sockets, which the MTA must be able to use"
+    )
+    parser.add_argument(
+        "lmtp_args", nargs=argparse.REMAINDER, help="archiver.py options for messages received over LMTP, after --"
+    )
+    args = parser.parse_args()
+    if not (args.socket or args.lmtp):
+        parser.error("at least one of --socket or --lmtp is required")
+    lmtp_argv = args.lmtp_args[1:] if args.lmtp_args[:1] == ["--"] else args.lmtp_args
+    archiver.get_parser().parse_args(lmtp_argv)  # Check them now rather than on every message
+
+    daemon = ArchiverDaemon(lmtp_argv)
+    servers = []
+    if args.socket:
+        servers.append(make_server(args.socket, delivery.SocketHandler, daemon, int(args.mode, 8)))
+        print("Accepting messages from archiver-client.py on %s" % args.socket)
+    if args.lmtp:
+        servers.append(make_server(args.lmtp, delivery.LMTPHandler, daemon, int(args.mode, 8)))
+        print("Accepting LMTP deliveries on %s" % args.lmtp)
+    sys.stdout.flush()
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda _signum, _frame: stop.set())
+    threads = [threading.Thread(target=server.serve_forever, daemon=True) for server in servers]
+    for thread in threads:
+        thread.start()
+    try:
+        stop.wait()
+    except KeyboardInterrupt:
+        pass
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+    for address in (args.socket, args.lmtp):
+        if address and "/" in address and os.path.exists(address):
+            os.unlink(address)
+
+
+if __name__ == "__main__":
+    main()
@@ -58,23 +58,29 @@ import uuid
 import mimetypes
 
 import elasticsearch
+import elasticsearch.helpers
 import formatflowed
 import netaddr
 
 if not __package__:
     from plugins import ponymailconfig # pylint: disable=no-name-in-module
-    from plugins import generators, textlib # pylint: disable=no-name-in-module
+    from plugins import generators, profiler, textlib # pylint: disable=no-name-in-module
+    from plugins.blobstore import AttachmentStore # pylint: disable=no-name-in-module
     from plugins.elastic import Elastic # pylint: disable=no-name-in-module
+    from plugins.spool import Spool # pylint: disable=no-name-in-module
 else:
     from .plugins import ponymailconfig # pylint: disable=no-name-in-module
-    from .plugins import generators, textlib # pylint: disable=no-name-in-module
+    from .plugins import generators, profiler, textlib # pylint: disable=no-name-in-module
+    from .plugins.blobstore import AttachmentStore # pylint: disable=no-name-in-module
     from .plugins.elastic import Elastic # pylint: disable=no-name-in-module
+    from .plugins.spool import Spool # pylint: disable=no-name-in-module
 
 # This is what we will default to if we are presented with emails without character sets and US-ASCII doesn't work.
 DEFAULT_CHARACTER_SET = 'utf-8'
 
 # Standard "short body" max length for email aggregations
 SHORT_BODY_MAX_LEN = 200 # This must be the same as server.plugins.messages.SHORT_BODY_MAX_LEN
+RETRYABLE_STATUSES = (408, 429)  # Client errors that go away by themselves
 
 # Fetch config from same dir as archiver.py
 config = ponymailconfig.PonymailConfig()
@@ -82,6 +88,9 @@ config = ponymailconfig.PonymailConfig()
 # Set some vars before we begin
 logger = None
 
+# Whether each audit log index exists, only checked once per process
+auditlog_indices: typing.Dict[str, bool] = {}
+
 normalize_lid = textlib.normalize_lid  # Unit test fallback
 
 # If MailMan is enabled, import and set it up
@@ -126,15 +135,19 @@ def mbox_source(b: bytes) -> str:
 
 # Common method shared with import-mbox to ensure consistency
 def parse_message(raw_message):
-    return email.message_from_bytes(raw_message, policy=policy)
+    profiler.count("bytes", len(raw_message))
+    with profiler.stage("parse"):
+        return email.message_from_bytes(raw_message, policy=policy)
 
 def parse_attachment(
     part: email.message.Message,
+    payload: typing.Optional[bytes] = None,
 ) -> typing.Tuple[typing.Optional[dict], typing.Optional[str]]:
     """
     Parses an attachment in an email, turns it into a dict with a content-type, sha256 digest, file size and file name.
     Also returns the attachment contents as base64 encoded string.
     :param part: The message part to parse
+    :param payload: The part's decoded payload, if the caller already has it
     :return: attachment info and contents as b64 string
     """
     cd = part.get("Content-Disposition", None)
@@ -144,7 +157,7 @@ def parse_attachment(
         dispositions = str(cd).strip().split(";")
         cdtype = dispositions[0].lower()
         if cdtype in {"attachment", "inline"}:
-            fd = part.get_payload(decode=True)
+            fd = part.get_payload(decode=True) if payload is None else payload
             filename = part.get_filename()
             # If attachment is without a name, invent it.
             ctype = part.get_content_type()
@@ -200,7 +213,7 @@ class Body:
         self.character_set = None
         self.string: typing.Optional[str] = None
         self.flowed = "format=flowed" in part.get("content-type", "")
-        self.bytes = part.get_payload(decode=True)
+        self.bytes = typing.cast(typing.Optional[bytes], part.get_payload(decode=True))
         self.html_as_source = False
         if self.bytes is not None:
             assert(isinstance(self.bytes, bytes)) # decode=True generates bytes
@@ -275,6 +288,61 @@ class Body:
         return self.string
 
 
+class MessageParts(typing.NamedTuple):
+    body: typing.Optional[Body]  # The first text/plain or text/enriched part
+    html: typing.Optional[Body]  # The first text/html part
+    attachments: list
+    contents: dict  # Attachment contents as b64 strings, by hash
+
+
+def walk_message(msg: email.message.Message, verbose: bool = False) -> MessageParts:
+    """
+    Finds the body candidates and the attachments of an email in one pass over its parts.
+    A part that is both (an inline text part with a file name) only has its payload decoded once.
+    :param msg: The email to parse
+    :param verbose: Whether to print the content type of each part
+    :return: the body candidates, attachment metadata and attachment contents
+    """
+    body = None
+    first_html = None
+    attachments = []
+    contents = {}
+    for part in msg.walk():
+        profiler.count("parts")
+        # can be called from importer
+        if verbose:
+            print("Content-Type: %s" % part.get_content_type())
+        payload = None
+        """
+            Find the first body part and the first HTML part
+            Note: cannot use break here because firstHTML is needed if len(body) <= 1
+        """
+        try:
+            if body is None and part.get_content_type() in [
+                "text/plain",
+                "text/enriched",
+            ]:
+                body = Body(part)
+                payload = body.bytes
+            elif (
+                not first_html
+                and part.get_content_type() == "text/html"
+            ):
+                first_html = Body(part)
+                payload = first_html.bytes
+        except Exception as err:
+            entry = sys.exc_info()[-1]
+            if entry: # avoid mypy complaint
+                print('Error on line {}:'.format(entry.tb_lineno), type(err).__name__, err)
+            else: # Should not happen, but just in case
+                print('Failed to create Body(part):',type(err).__name__, err)
+        part_meta, part_file = parse_attachment(part, payload)
+        if part_meta:
+            attachments.append(part_meta)
+            contents[part_meta["hash"]] = part_file
+    return MessageParts(body, first_html, attachments, contents)
+
+
 def message_identifiers(header, reverse=False):
     if "<" not in header:
         return []
@@ -313,24 +381,63 @@ def get_by_message_id(elastic, msgid, timeout="5s"):
     return None
 
 
-def get_parent_info(elastic, ojson, timeout=5, limit=10):
-    parent_identifiers = get_parent_identifiers(ojson)
-    if not parent_identifiers:
-        return None
-    for parent_identifier in parent_identifiers:
-        parent_info = get_by_message_id(elastic, parent_identifier, timeout)
-        if parent_info is not None:
-            return parent_info
-        limit -= 1
-        if limit < 1:
-            break
+def get_parent_candidates(ojson, limit=10):
+    """The first limit parent identifiers, closest first, without repeats"""
+    candidates = []
+    for identifier in get_parent_identifiers(ojson)[:limit]:
+        if identifier not in candidates:
+            candidates.append(identifier)
+    return candidates
+
+
+def parent_search(candidates, timeout="5s"):
+    """Counts the messages with each candidate identifier, keeping one of each, in a single search"""
+    return {
+        "query": {"terms": {"message-id": candidates}},
+        "aggs": {
+            "by_id": {
+                "terms": {"field": "message-id", "size": len(candidates)},
+                "aggs": {"message": {"top_hits": {"size": 1}}},
+            }
+        },
+        "size": 0,
+        "timeout": timeout,
+    }
+
+
+def closest_parent(candidates, data, pending=None):
+    """Picks the closest candidate that identifies exactly one message, as looking them up in turn would.
+    Messages in pending (by message-id) are not searchable yet, but count as well."""
+    buckets = {bucket["key"]: bucket for bucket in data["aggregations"]["by_id"]["buckets"]}
+    for candidate in candidates:
+        bucket = buckets.get(candidate)
+        found = {}
+        count = 0
+        if bucket:
+            hit = bucket["message"]["hits"]["hits"][0]["_source"]
+            found[hit["mid"]] = hit
+            count = bucket["doc_count"]
+        for message in (pending or {}).get(candidate, []):
+            if message["mid"] not in found:  # Unless it has been indexed by now
+                found[message["mid"]] = message
+                count += 1
+        if count == 1:
+            return next(iter(found.values()))
     return None
 
 
-def get_previous_mid(elastic, ojson, timeout="5s"):
+def get_parent_info(elastic, ojson, timeout="5s", limit=10):
+    candidates = get_parent_candidates(ojson, limit)
+    if not candidates:
+        return None
+    data = elastic.search(index=elastic.db_mbox, body=parent_search(candidates, timeout))
+    return closest_parent(candidates, data)
+
+
+def previous_search(ojson, timeout="5s"):
     forum = ojson["forum"]
     latest = ojson.get("epoch", 1) - 1
-    data = elastic.search(index=elastic.db_mbox, body={
+    return {
         "query": {
             "bool": {
                 "must": [
@@ -342,19 +449,55 @@ def get_previous_mid(elastic, ojson, timeout="5s"):
         },
         "sort": [{"epoch": "desc"}],
         "size": 1,
-        "_source": "mid",
-    }, timeout=timeout)
+        "_source": ["mid", "epoch"],
+        "timeout": timeout,
+    }
+
+
+def previous_mid(ojson, data, pending=None):
+    """The latest thread started in the same forum before this message, including those in pending"""
+    latest = None
     for hit in data["hits"]["hits"]:
-        return hit["_source"]["mid"]
-    return None
+        latest = hit["_source"]
+    before = ojson.get("epoch", 1) - 1
+    for messages in (pending or {}).values():
+        for message in messages:
+            if (
+                message.get("top") and message["forum"] == ojson["forum"] and message["epoch"] <= before
+                and (latest is None or message["epoch"] > latest.get("epoch", 0))
+            ):
+                latest = message
+    return latest["mid"] if latest else None
 
 
-def add_thread_properties(elastic, ojson, timeout="5s", limit=5):
-    parent_info = get_parent_info(elastic, ojson, timeout, limit)
+def get_previous_mid(elastic, ojson, timeout="5s"):
+    data = elastic.search(index=elastic.db_mbox, body=previous_search(ojson, timeout))
+    return previous_mid(ojson, data)
+
+
+def add_thread_properties(elastic, ojson, timeout="5s", limit=5, pending=None):
+    """Sets top, thread and previous. Messages in pending, by message-id, are taken into account even though
+    they are not searchable yet, as when indexing several messages from the spool in one bulk request."""
+    candidates = get_parent_candidates(ojson, limit)
+    if candidates:
+        # Look for the parent and the previous thread together, in one round trip,
+        # even though the previous thread is only needed if there is no parent
+        responses = elastic.msearch(index=elastic.db_mbox, body=[
+            {}, parent_search(candidates, timeout),
+            {}, previous_search(ojson, timeout),
+        ])["responses"]
+        for response in responses:
+            if "error" in response:
+                raise elasticsearch.exceptions.TransportError(response.get("status", "N/A"), response["error"])
+        parent_info = closest_parent(candidates, responses[0], pending)
+        previous_data = responses[1]
+    else:
+        parent_info = None
+        previous_data = elastic.search(index=elastic.db_mbox, body=previous_search(ojson, timeout))
     if parent_info is None:
         top = True
         thread = ojson["mid"]
-        previous = get_previous_mid(elastic, ojson, timeout)
+        previous = previous_mid(ojson, previous_data, pending)
     else:
         top = False
         thread = parent_info.get("thread")
@@ -366,6 +509,35 @@ def add_thread_properties(elastic, ojson, timeout="5s", limit=5):
     return ojson
 
 
+def auditlog_exists(elastic) -> bool:
+    if elastic.db_auditlog not in auditlog_indices:
+        try:
+            exists = elastic.indices.exists(index=elastic.db_auditlog)
+        except elasticsearch.exceptions.AuthorizationException:
+            exists = False
+        auditlog_indices[elastic.db_auditlog] = exists
+    return auditlog_indices[elastic.db_auditlog]
+
+
+def thread_message(elastic, ojson, pending=None):
+    """Adds the threading properties, if the archiver is configured to"""
+    if config.get("archiver", "threadinfo"):
+        try:
+            timeout = int(config.get("archiver", "threadtimeout") or 5)
+            timeout = str(timeout) + "s"
+            limit = int(config.get("archiver", "threadparents") or 10)
+            ojson = add_thread_properties(elastic, ojson, timeout, limit, pending)
+        except Exception as err:
+            print("Could not add thread info", err)
+            if logger:
+                logger.info("Could not add thread info %s", err)
+        else:
+            print("Added thread info successfully", ojson["mid"])
+            if logger:
+                logger.info("Added thread info successfully %s", ojson["mid"])
+    return ojson
+
+
 class Archiver(object):  # N.B. Also used by import-mbox.py
     """The general archiver class. Compatible with MailMan3 archiver classes."""
 
@@ -400,6 +572,10 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
         self.cropout = config.get("debug", "cropout")
         self.verbose = verbose
         self.ignore_body = ignore_body
+        self.attachments = AttachmentStore()
+        # With a spool, messages are written there and indexed later by flush-spool.py
+        spool_path = config.get("spool", "path")
+        self.spool = Spool(spool_path) if spool_path else None
         if self.html:
             import html2text
 
@@ -411,34 +587,16 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
         :param msg: The email or part of it to examine for proper body
         :return: archiver.Body object
         """
-        body = None
-        first_html = None
-        for part in msg.walk():
-            # can be called from importer
-            if self.verbose:
-                print("Content-Type: %s" % part.get_content_type())
-            """
-                Find the first body part and the first HTML part
-                Note: cannot use break here because firstHTML is needed if len(body) <= 1
-            """
-            try:
-                if body is None and part.get_content_type() in [
-                    "text/plain",
-                    "text/enriched",
-                ]:
-                    body = Body(part)
-                elif (
-                    not first_html
-                    and part.get_content_type() == "text/html"
-                ):
-                    first_html = Body(part)
-            except Exception as err:
-                entry = sys.exc_info()[-1]
-                if entry: # avoid mypy complaint
-                    print('Error on line {}:'.format(entry.tb_lineno), type(err).__name__, err)
-                else: # Should not happen, but just in case
-                    print('Failed to create Body(part):',type(err).__name__, err)
+        return self.choose_body(walk_message(msg, self.verbose))
 
+    def choose_body(self, parts: MessageParts) -> typing.Optional[Body]:
+        """
+            Picks the text body, or the HTML one if there is no useful text, from the parts of an email
+        :param parts: The body candidates found by walk_message
+        :return: archiver.Body object
+        """
+        body = parts.body
+        first_html = parts.html
         # this requires a GPL lib, user will have to install it themselves
         if first_html and (
             body is None
@@ -450,7 +608,8 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
 
             # Convert HTML to text if mod is installed and enabled, otherwise keep the source as-is
             if self.html:
-                body.assign(self.html2text(str(body)))
+                with profiler.stage("html2text"):
+                    body.assign(self.html2text(str(body)))
                 body.html_as_source = False
         return body
 
@@ -565,8 +724,12 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
             epoch = int(email.utils.mktime_tz(message_date))
         # message_date calculations are all done, prepare the index entry
         date_as_string = time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(epoch))
-        body = self.message_body(msg)
-        attachments, contents = message_attachments(msg)
+        with profiler.stage("mime"):
+            parts = walk_message(msg, self.verbose)
+        body = self.choose_body(parts)
+        attachments, contents = parts.attachments, parts.contents
+        profiler.count("attachments", len(attachments))
+        profiler.count("attachment_bytes", sum(attachment["size"] for attachment in attachments))
         irt = ""
 
         output_json = None
@@ -583,14 +746,15 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
             for generator in self.generator.split(" "):
                 if generator:
                     try:
-                        mid = generators.generate(
-                            generator,
-                            msg,
-                            generator_body,
-                            lid,
-                            attachments,
-                            raw_msg,
-                        )
+                        with profiler.stage("generator"):
+                            mid = generators.generate(
+                                generator,
+                                msg,
+                                generator_body,
+                                lid,
+                                attachments,
+                                raw_msg,
+                            )
                     except Exception as err:
                         if logger:
                             # N.B. use .get just in case there is no message-id
@@ -621,7 +785,8 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
             ghash = hashlib.md5(mailaddr.encode("utf-8")).hexdigest()
 
             notes.append(["ARCHIVE: Email archived as %s at %u" % (document_id, time.time())])
-            body_unflowed = body.unflow() if body else ""
+            with profiler.stage("unflow"):
+                body_unflowed = body.unflow() if body else ""
             body_shortened = body_unflowed[:SHORT_BODY_MAX_LEN+1]  # +1 so that we can tell if larger than std short body.
 
             output_json = {
@@ -654,7 +819,9 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
 
         return output_json, contents, msg_metadata, irt, False
 
-    def archive_message(self, mlist, msg, raw_message=None, dry=False, dump=None, defaultepoch=None, digest=False):
+    def archive_message(
+        self, mlist, msg, raw_message=None, dry=False, dump=None, defaultepoch=None, digest=False, elastic=None
+    ):
         """Send the message to the archiver.
 
         :param mlist: The IMailingList object.
@@ -662,6 +829,7 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
         :param raw_message: Raw message bytes
         :param dry: Whether or not to actually run
         :param dump: Optional path for dump on fail
+        :param elastic: Optional database connection to reuse, otherwise a new one is made
 
         :return (lid, mid)
         """
@@ -698,72 +866,34 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
             print("**** Dry run, not saving message to database *****")
             return lid, ojson["mid"]
 
-        if dump:
-            try:
-                elastic = Elastic()
-            except elasticsearch.exceptions.ElasticsearchException as e:
-                print(e)
-                print(
-                    "ES connection failed, but dumponfail specified, dumping to %s"
-                    % dump
-                )
-        else:
-            elastic = Elastic()
-
-        if config.get("archiver", "threadinfo"):
-            try:
-                timeout = int(config.get("archiver", "threadtimeout") or 5)
-                timeout = str(timeout) + "s"
-                limit = int(config.get("archiver", "threadparents") or 10)
-                ojson = add_thread_properties(elastic, ojson, timeout, limit)
-            except Exception as err:
-                print("Could not add thread info", err)
-                if logger:
-                    logger.info("Could not add thread info %s", err)
-            else:
-                print("Added thread info successfully", ojson["mid"])
-                if logger:
-                    logger.info("Added thread info successfully %s", ojson["mid"])
+        record = self.message_record(lid, private, ojson, contents, msg_metadata, irt, raw_message)
+        if self.spool is not None:
+            # Indexing, threading and notifications are left to flush-spool.py
+            with profiler.stage("spool"):
+                self.spool.append(record)
+            if logger:
+                logger.info("Pony Mail spooled message %s", ojson["mid"])
+            return lid, ojson["mid"]
 
-        try:
-            if contents:
-                for key in contents:
-                    elastic.index(
-                        index=elastic.db_attachment,
-                        id=key,
-                        body={"source": contents[key]},
+        if elastic is None:
+            if dump:
+                try:
+                    elastic = Elastic()
+                except elasticsearch.exceptions.ElasticsearchException as e:
+                    print(e)
+                    print(
+                        "ES connection failed, but dumponfail specified, dumping to %s"
+                        % dump
                     )
+            else:
+                elastic = Elastic()
 
-            elastic.index(
-                index=elastic.db_mbox, id=ojson["mid"], body=ojson,
-            )
+        with profiler.stage("es_thread"):
+            thread_message(elastic, ojson)
 
-            elastic.index(
-                index=elastic.db_source,
-                id=ojson["dbid"],
-                body={
-                    "message-id": msg_metadata["message-id"],
-                    "source": mbox_source(raw_message),
-                },
-            )
-            # Write to audit log
-            try:
-                auditlog_exists = elastic.indices.exists(index=elastic.db_auditlog)
-            except elasticsearch.exceptions.AuthorizationException:
-                auditlog_exists = False
-            if auditlog_exists:
-                elastic.index(
-                    index=elastic.db_auditlog,
-                    body={
-                        "date": time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(time.time())),
-                        "action": "index",
-                        "remote": "internal",
-                        "author": "archiver.py",
-                        "target": ojson["mid"],
-                        "lid": lid,
-                        "log": f"Indexed email {ojson['message-id']} for {lid} as {ojson['mid']}",
-                    }
-                )
+        try:
+            with profiler.stage("es_index"):
+                self.index_records(elastic, [record])
 
         # If we have a dump dir and ES failed, push to dump dir instead as a JSON object
         # We'll leave it to another process to pick up the slack.
@@ -776,21 +906,7 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
                 uid = uuid.uuid4()
                 mbox_path = os.path.join(dump, "%s.json" % uid)
                 with open(mbox_path, "w") as f:
-                    json.dump(
-                        {
-                            "id": ojson["mid"],
-                            "mbox": ojson,
-                            "mbox_source": {
-                                "id": ojson["dbid"],
-                                "permalink": ojson["mid"],
-                                "message-id": msg_metadata["message-id"],
-                                "source": mbox_source(raw_message),
-                            },
-                            "attachments": contents,
-                        },
-                        f,
-                        indent=2,
-                    )
+                    json.dump(record, f, indent=2)
                     f.close()
                 sys.exit(0)  # We're exiting here, the rest can't be done without ES
             # otherwise fail as before
@@ -798,6 +914,86 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
 
         if logger:
             logger.info("Pony Mail archived message %s successfully", ojson["mid"])
+        with profiler.stage("es_notify"):
+            self.notify(elastic, record)
+        return lid, ojson["mid"]
+
+    def message_record(self, lid, private, ojson, contents, msg_metadata, irt, raw_message):
+        """Everything needed to index a message later, in the format of --dumponfail files and the spool"""
+        return {
+            "id": ojson["mid"],
+            "mbox": ojson,
+            "mbox_source": {
+                "id": ojson["dbid"],
+                "permalink": ojson["mid"],
+                "message-id": msg_metadata["message-id"],
+                "source": mbox_source(raw_message),
+            },
+            "attachments": contents,
+            # For the audit log and notifications
+            "lid": lid,
+            "private": private,
+            "metadata": msg_metadata,
+            "irt": irt,
+        }
+
+    def index_records(self, elastic, records, **kwargs):
+        """Writes all documents of the messages with a single bulk request"""
+        actions = []
+        for record in records:
+            ojson = record["mbox"]
+            if record["attachments"]:
+                for key, b64 in record["attachments"].items():
+                    action = self.attachments.bulk_action(elastic, key, b64)
+                    if action:
+                        actions.append(action)
+
+            actions.append({"_index": elastic.db_mbox, "_id": ojson["mid"], "_source": ojson})
+
+            actions.append({
+                "_index": elastic.db_source,
+                "_id": record["mbox_source"]["id"],
+                "_source": {
+                    "message-id": record["mbox_source"]["message-id"],
+                    "source": record["mbox_source"]["source"],
+                },
+            })
+            # Write to audit log
+            if auditlog_exists(elastic):
+                lid = record["lid"]
+                actions.append({
+                    "_index": elastic.db_auditlog,
+                    "_source": {
+                        "date": time.strftime("%Y/%m/%d %H:%M:%S", time.gmtime(time.time())),
+                        "action": "index",
+                        "remote": "internal",
+                        "author": "archiver.py",
+                        "target": ojson["mid"],
+                        "lid": lid,
+                        "log": f"Indexed email {ojson['message-id']} for {lid} as {ojson['mid']}",
+                    },
+                })
+
+        _success, errors = elastic.bulk(
+            actions,
+            chunk_size=len(actions),
+            raise_on_error=False,
+            wait_for_active_shards=elastic.wait_for_active_shards,
+            **kwargs,
+        )
+        # Any document that did not make it means the message is not properly archived
+        if errors:
+            raise elasticsearch.helpers.BulkIndexError(
+                "%u document(s) failed to index" % len(errors), errors
+            )
+
+    def notify(self, elastic, record):
+        """Tells users about replies to the messages they sent through Pony Mail"""
+        ojson = record["mbox"]
+        lid = record["lid"]
+        private = record["private"]
+        msg_metadata = record["metadata"]
+        irt = record["irt"]
         oldrefs = []
 
         # Is this a direct reply to a pony mail email?
@@ -873,7 +1069,6 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
                         )
                         if logger:
                             logger.info("Notification sent to %s for %s", cid, mid)
-        return lid, ojson["mid"]
 
     def list_url(self, _mlist):
         """ Required by MM3 plugin API
@@ -886,7 +1081,58 @@ class Archiver(object):  # N.B. Also used by import-mbox.py
         return None
 
 
-def main():
+def rejected_records(records, errors):
+    """The records whose documents the database refused for good (a 4xx other than 408 or 429),
+    or None if any document failed in a way that is worth trying again"""
+    rejected_ids = set()
+    for error in errors:
+        details = next(iter(error.values()), {})
+        status = details.get("status")
+        if not isinstance(status, int) or not 400 <= status < 500 or status in RETRYABLE_STATUSES:
+            return None
+        rejected_ids.add(details.get("_id"))
+    return [
+        record for record in records
+        if rejected_ids & {record["id"], record["mbox_source"]["id"], *(record["attachments"] or ())}
+    ]
+
+
+def flush_spool(archie, elastic, batch_size=100):
+    """Indexes the messages waiting in the archiver's spool, a bulk request per batch, and returns how many.
+    Messages the database refuses are set aside in the spool's failed directory; other errors are raised,
+    leaving the batch in the spool to be tried again."""
+    flushed = 0
+    for batch in archie.spool.batches(batch_size):
+        # Messages in the same batch can reply to each other, but are not searchable until indexed
+        pending: typing.Dict[str, list] = {}
+        for record in batch.records:
+            ojson = thread_message(elastic, record["mbox"], pending)
+            pending.setdefault(ojson["message-id"], []).append(ojson)
+        indexed = batch.records
+        try:
+            # Wait until they are searchable, so the next batch can find its parents among them
+            archie.index_records(elastic, batch.records, refresh="wait_for")
+        except elasticsearch.helpers.BulkIndexError as err:
+            rejected = rejected_records(batch.records, err.errors)
+            if rejected is None:
+                raise
+            # Trying again would only fail again, and hold up every message after these
+            for record in rejected:
+                path = archie.spool.reject(record)
+                print("The database refused %s, set it aside as %s: %s" % (record["id"], path, err.errors))
+            rejected_ids = {record["id"] for record in rejected}
+            indexed = [record for record in batch.records if record["id"] not in rejected_ids]
+        for record in indexed:
+            try:
+                archie.notify(elastic, record)
+            except Exception as err:  # The message is archived, which is what matters
+                print("Could not send notifications for %s: %s" % (record["id"], err))
+        archie.spool.commit(batch.end)
+        flushed += len(indexed)
+    return flushed
+
+
+def get_parser():
     parser = argparse.ArgumentParser(description="Command line options.")
     parser.add_argument(
         "--lid", dest="lid", type=str, nargs=1, help="Alternate specific list ID"
@@ -973,28 +1219,51 @@ def main():
         help="If no date could be found in the email, use this epoch. Set to 'skip' to skip importing on bad date",
     )
     parser.add_argument("--generator", dest="generator", help="Override the generator.")
-    args = parser.parse_args()
+    parser.add_argument(
+        "--profile",
+        dest="profile",
+        action="store_true",
+        help="Show how long each stage of archiving took",
+    )
+    parser.add_argument(
+        "--profile-log",
+        dest="profile_log",
+        help="With --profile, also append the timings of the message to this file as a JSON line",
+    )
+    return parser
 
-    if args.verbose:
-        logging.basicConfig(stream=sys.stdout, level=logging.INFO)
 
+def archive_input(args, argv, raw_message, elastic=None):
+    """Archives one message with the given command line options, as archiver.py does for its standard input.
+    Also used by archiver-daemon.py, which keeps a database connection (elastic) open between messages.
+    Returns the exit status for archiver.py.
+    """
+    prof = None
+    if args.profile:
+        prof = profiler.Profiler(args.profile_log)
+        prof.begin()
+    try:
+        return process_input(args, argv, raw_message, elastic)
+    finally:
+        if prof:
+            prof.close()
+            print(prof.summary())
+
+
+def process_input(args, argv, raw_message, elastic=None):
+    """The work of archive_input, apart from profiling"""
     archie = Archiver(
         generator=args.generator,
         parse_html=args.html2text,
         ignore_body=args.ibody,
         verbose=args.verbose,
     )
-    # use binary input so parser can use appropriate charset
-    input_stream = sys.stdin.buffer
-
     try:
-        raw_message = input_stream.read()
-        
         try:
             msg = parse_message(raw_message)
         except Exception as err:
             print("STDIN parser exception: %s" % err)
-            sys.exit(-1)
+            return -1
 
         if args.altheader:
             alt_header = args.altheader[0]
@@ -1003,8 +1272,8 @@ def main():
                     msg.replace_header("List-ID", msg.get(alt_header))
                 except KeyError:
                     msg.add_header("list-id", msg.get(alt_header))
-        elif "altheader" in sys.argv:
-            alt_header = sys.argv[len(sys.argv) - 1]
+        elif "altheader" in argv:
+            alt_header = argv[len(argv) - 1]
             if alt_header in msg:
                 try:
                     msg.replace_header("List-ID", msg.get(alt_header))
@@ -1025,7 +1294,7 @@ def main():
                 msg.get("list-id") and fnmatch.fnmatch(msg.get("list-id"), ignore_from)
             ):
                 print("Ignoring message as instructed by --ignore flag")
-                sys.exit(0)
+                return 0
 
         # Check CIDR if need be
         if args.allowfrom:
@@ -1047,7 +1316,7 @@ def main():
                         pass
             if not good:
                 print("No whitelisted IP found in message, aborting")
-                sys.exit(-1)
+                return -1
         # Replace date header with $now?
         if args.makedate:
             msg.replace_header("date", email.utils.formatdate())
@@ -1073,7 +1342,10 @@ def main():
             )
 
             try:
-                lid, mid = archie.archive_message(list_data, msg, raw_message, args.dry, args.dump, args.defaultepoch, args.digest)
+                lid, mid = archie.archive_message(
+                    list_data, msg, raw_message, args.dry, args.dump, args.defaultepoch, args.digest, elastic
+                )
+                profiler.label(lid=lid, mid=mid)
                 if args.digest:
                     print(mid)
                 else:
@@ -1099,7 +1371,21 @@ def main():
             )
         else:
             print("Could not parse email: %s (@ %s)" % (err, line))
-            sys.exit(-1)
+            return -1
+    return 0
+
+
+def main():
+    args = get_parser().parse_args()
+
+    if args.verbose:
+        logging.basicConfig(stream=sys.stdout, level=logging.INFO)
+
+    # use binary input so parser can use appropriate charset
+    raw_message = sys.stdin.buffer.read()
+    status = archive_input(args, sys.argv, raw_message)
+    if status:
+        sys.exit(status)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Indexes the messages the archiver has written to its spool (spool.path in archiver.yaml).
+
+Runs until stopped, checking the spool every --interval seconds. If the database cannot be
+reached or refuses documents, it tries again after 1, 2, 4... seconds, up to --max-backoff.
+The backlog and any error are kept in status.json in the spool directory; --status prints it.
+"""
+
+import argparse
+import fcntl
+import json
+import os
+import signal
+import sys
+import threading
+import time
+
+if not __package__:
+    import archiver
+    from plugins.elastic import Elastic # pylint: disable=no-name-in-module
+else:
+    from . import archiver
+    from .plugins.elastic import Elastic
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Indexes the messages in the archiver's spool.")
+    parser.add_argument("--once", action="store_true", help="Index what is in the spool now, then exit")
+    parser.add_argument("--status", action="store_true", help="Show the backlog and the flusher's state, then exit")
+    parser.add_argument("--batch", type=int, default=100, help="Messages per bulk request (default 100)")
+    parser.add_argument("--interval", type=float, default=1, help="Seconds between checks of the spool (default 1)")
+    parser.add_argument("--max-backoff", type=float, default=300, help="Longest wait between retries (default 300)")
+    args = parser.parse_args()
+
+    archie = archiver.Archiver()
+    spool = archie.spool
+    if spool is None:
+        print("No spool is configured: set spool.path in archiver.yaml")
+        sys.exit(-1)
+
+    if args.status:
+        try:
+            with open(os.path.join(spool.path, "status.json")) as f:
+                status = json.load(f)
+        except FileNotFoundError:
+            status = {}
+        records, size = spool.backlog()
+        status.update(records=records, bytes=size)
+        print(json.dumps(status, indent=2))
+        return
+
+    # Only one flusher at a time
+    lockfile = open(os.path.join(spool.path, "flusher.lock"), "ab")
+    try:
+        fcntl.flock(lockfile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        print("Another flush-spool.py is already running for %s" % spool.path)
+        sys.exit(-1)
+
+    stop = threading.Event()
+    signal.signal(signal.SIGTERM, lambda _signum, _frame: stop.set())
+    elastic = None
+    backoff = 0.0
+    while not stop.is_set():
+        try:
+            if elastic is None:
+                elastic = Elastic()
+            flushed = archiver.flush_spool(archie, elastic, args.batch)
+            if flushed:
+                print("Indexed %u messages from the spool" % flushed)
+            spool.write_status(last_flush=int(time.time()), error=None, retry_in=0)
+            backoff = 0
+            if args.once:
+                break
+            stop.wait(args.interval)
+        except Exception as err:
+            backoff = min(max(2 * backoff, 1), args.max_backoff)
+            print("Could not index the spool, trying again in %u seconds: %s" % (backoff, err))
+            spool.write_status(error=str(err), retry_in=backoff)
+            if args.once:
+                sys.exit(-1)
+            stop.wait(backoff)
+
+
+if __name__ == "__main__":
+    main()
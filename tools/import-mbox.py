@@ -24,6 +24,7 @@ import logging
 import mailbox
 import multiprocessing
 import os
+import queue
 import random
 import re
 import sys
@@ -32,7 +33,7 @@ import time
 import urllib.parse
 from os import listdir
 from os.path import isdir, isfile, join
-from threading import Lock, Thread
+from threading import Event, Lock, Thread
 from urllib.request import urlopen
 import typing
 
@@ -41,20 +42,25 @@ import typing
 
 if not __package__:
     import archiver
-    from plugins import textlib # pylint: disable=no-name-in-module
+    from plugins import mboxsplit, profiler, textlib # pylint: disable=no-name-in-module
+    from plugins.dedup import DEFAULT_MAX_IDS, ArchivedIds # pylint: disable=no-name-in-module
     from plugins.elastic import Elastic # pylint: disable=no-name-in-module
 else:
     from . import archiver
     from .plugins.elastic import Elastic
-    from .plugins import textlib
+    from .plugins import mboxsplit, profiler, textlib
+    from .plugins.dedup import DEFAULT_MAX_IDS, ArchivedIds
 
 TIMEOUT_DEFAULT = 600
+MAX_BATCH_ATTACHMENT_BYTES = 64 * 1024 * 1024  # Index a batch early rather than hold more attachments in memory
+DEDUP_BATCH_SIZE = 100  # Messages checked against the archive at once with --dedup
 goodies = 0
 baddies = 0
 dupes = 0 # number of duplicates dropped
 replacements = 0 # number of entries replaced
 duplicates: dict = {}  # detect if mid is re-used this run
 block = Lock()
+stopping = Event()  # Set if the import cannot go on, so the readers stop waiting for the parsers
 lists: list = []  # N.B. the entries in this list depend on the import type:
 # globDir: [filename, list-id]
 # modMbox: [list-id, mbox]
@@ -87,8 +93,12 @@ noMboxo = False  # Don't skip MBoxo patch
 rootURL = ""
 
 dumpfile = None # for args.dump
+prof = None # for args.profile
 
-def bulk_insert(name, json, xes, dbindex, wc="quorum"):
+def bulk_insert(name, json, xes, dbindex, wc="quorum", existing_ok=False):
+    """Creates (or with --overwrite, indexes) the documents, whose id is in their "mid" field.
+    Returns the positions of those that were stored, including those that already exist if existing_ok is set,
+    and the number of documents that replaced existing ones"""
 
     sys.stderr.flush()
 
@@ -96,7 +106,7 @@ def bulk_insert(name, json, xes, dbindex, wc="quorum"):
     js_arr = []
     for js in json:
         document_id = js["mid"]
-        if dbindex == xes.db_source:
+        if dbindex in (xes.db_source, xes.db_attachment):
             del js["mid"]
         js_arr.append(
             {
@@ -121,6 +131,8 @@ def bulk_insert(name, json, xes, dbindex, wc="quorum"):
                 successes.append(findex) # record successful entries
                 if d['result'] == 'updated':
                     repl += 1
+            elif existing_ok and d.get('status') == 409:
+                successes.append(findex)
             else:
                 msgid = js_arr[findex]['doc'].get('message-id', 'Unknown')
                 print(f"{name}: Warning: Failed to create {d['_index']} with mid: {d['_id']} from msgid: {msgid}")
@@ -129,21 +141,49 @@ def bulk_insert(name, json, xes, dbindex, wc="quorum"):
         print("%s: Warning: Could not bulk insert: %s into %s" % (name, err, dbindex))
     return successes, repl
 
-def bulk_insert_both(name, mbox, source, xes):
-    """Create mbox entries; if any fail, don't create the corresponding source entries"""
+def bulk_insert_attachments(name, attachments, xes):
+    """Stores the attachments of the messages (dicts of base64 contents by hash), returns the hashes stored"""
+    contents = {}
+    for message_contents in attachments:
+        contents.update(message_contents)
+    digests = list(contents)
+    # Attachments are stored by hash, so one that already exists is the same attachment
+    successes, _repl = bulk_insert(
+        name, [{"mid": digest, "source": contents[digest]} for digest in digests], xes, xes.db_attachment,
+        existing_ok=True,
+    )
+    return {digests[i] for i in successes}
+
+
+def bulk_insert_both(name, mbox, source, xes, attachments=None):
+    """Create mbox entries; if any fail, don't create the corresponding source entries.
+    The attachments of each message, if given, are stored first; if any of them fail,
+    neither entry is created for that message. Returns the positions of those messages."""
     global replacements, dupes, goodies # pylint: disable=global-statement # TODO:FIX
-    successes, repl = bulk_insert(name, mbox, xes, xes.db_mbox)
-    failures = len(mbox) - len(successes)
-    # if there are failures, keep only successes
-    if failures:
-        source = [source[i] for i in successes]
-    # anything left?
-    if source:
-        # not interested in replacements here
-        bulk_insert(name, source, xes, xes.db_source)
+    dropped = []
+    with prof.stage("es_bulk") if prof else profiler.NOT_PROFILING:
+        if attachments and any(attachments):
+            stored = bulk_insert_attachments(name, attachments, xes)
+            keep = [i for i, contents in enumerate(attachments) if all(digest in stored for digest in contents)]
+            if len(keep) < len(mbox):
+                print("%s: Warning: Not importing %u messages whose attachments could not be stored"
+                      % (name, len(mbox) - len(keep)))
+                dropped = sorted(set(range(len(mbox))) - set(keep))
+                mbox = [mbox[i] for i in keep]
+                source = [source[i] for i in keep]
+        successes, repl = bulk_insert(name, mbox, xes, xes.db_mbox)
+        failures = len(mbox) - len(successes)
+        # if there are failures, keep only successes
+        if failures:
+            source = [source[i] for i in successes]
+        # anything left?
+        if source:
+            # not interested in replacements here
+            bulk_insert(name, source, xes, xes.db_source)
     replacements += repl
     goodies -= failures
     dupes += failures
+    return dropped
 
 class DownloadThread(Thread): # handles Pipermail
     def assign(self, url):
@@ -164,21 +204,27 @@ class DownloadThread(Thread): # handles Pipermail
         print("Adding %s to slurp list as %s" % (self.url, tmpfile.name))
 
 class SlurpThread(Thread):
+    """Reader stage: reads the raw messages of the lists to import, and queues them for the parsers"""
+
     def printid(self, message):
         print("%s: %s" % (self.name, message))
 
+    def queue_message(self, task):
+        """Passes a message on to the parsers, waiting while they are busy; False if the import is stopping"""
+        while not stopping.is_set():
+            try:
+                read_queue.put(task, timeout=1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
     def run(self):
-        global goodies, baddies, dedupped  # pylint: disable=global-statement # TODO:FIX
-        ja = []
-        jas = []
         self.printid("Thread started")
         mla = None
         ml = ""
         mboxfile = ""
         filename = ""
-        archie = archiver.Archiver(
-            generator=args.generator, parse_html=args.html2text, ignore_body=args.ibody, verbose=args.verbose
-        )
 
         while len(lists) > 0:
             self.printid("%u elements left to slurp" % len(lists))
@@ -197,53 +243,32 @@ class SlurpThread(Thread):
 
             stime = time.time()
             tmpname = ""
-            delete_file = False
-            useMboxo = False
             if imap:
                 imap4 = mla[2]
                 tmpname = "IMAP"
+                source_name = "imap"
 
                 def mailgen(_list):
                     for uid in _list:
-                        msgbytes = imap4.uid("fetch", uid, "(RFC822)")[1][0][1]
-                        yield archiver.parse_message(msgbytes)
+                        yield uid, imap4.uid("fetch", uid, "(RFC822)")[1][0][1]
 
                 messages = mailgen(mla[0])
             elif filebased:
 
                 tmpname = mla[0]
                 filename = mla[0]
-                if filename.find(".gz") != -1:
-                    self.printid("Decompressing %s..." % filename)
-                    try:
-                        with open(filename, "rb") as bf:
-                            bmd = bf.read()
-                            bf.close()  # explicit early close
-                            bmd = gzip.decompress(bmd)
-                            tmpfile = tempfile.NamedTemporaryFile(
-                                mode="w+b", delete=False
-                            )
-                            tmpfile.write(bmd)
-                            tmpfile.flush()
-                            tmpfile.close()
-                            tmpname = tmpfile.name
-                            delete_file = True  # Slated for deletion upon having been read
-                            self.printid("%s -> %u bytes" % (tmpname, len(bmd)))
-                    except Exception as err:
-                        self.printid("This wasn't a gzip file: %s" % err)
+                source_name = filename
                 self.printid("Slurping %s" % filename)
                 if maildir:
-                    messages = mailbox.Maildir(tmpname, create=False)
+                    messages = maildir_messages(tmpname)
                 else:
-                    useMboxo = (not noMboxo)
-                    messages = mailbox.mbox(
-                        # pylint: disable-next=possibly-used-before-assignment
-                        tmpname, None if noMboxo else MboxoFactory, create=False
-                    )
+                    # Compressed files are decompressed as they are read
+                    messages = enumerate(mboxsplit.read_messages(tmpname, mboxo=not noMboxo))
 
             else:
                 ml = mla[0]
                 mboxfile = mla[1]
+                source_name = "%s/%s" % (ml, mboxfile)
                 self.printid("Slurping %s/%s" % (ml, mboxfile))
                 ctx = urlopen("%s%s/%s" % (source, ml, mboxfile))
                 inp = ctx.read().decode(
@@ -259,39 +284,27 @@ class SlurpThread(Thread):
                 with open(tmpname, "w") as f:
                     f.write(inp)
                 if maildir:
-                    messages = mailbox.Maildir(tmpname, create=False)
+                    messages = maildir_messages(tmpname)
                 else:
-                    messages = mailbox.mbox(
-                        tmpname, None if noMboxo else MboxoFactory, create=False
-                    )
+                    messages = enumerate(mboxsplit.read_messages(tmpname, mboxo=False))
 
             count = 0
-            bad = 0
 
-            for key in messages.iterkeys():
-                if maildir:
-                    file = messages.get_file(key)
-                else: # must be mbox, which has an extra from_ parameter
-                    file = messages.get_file(key, True) # pylint: disable=too-many-function-args
-                # If the parsed data is filtered, also need to filter the raw input
-                # so the source agrees with the summary info
-                if useMboxo:
-                    file = MboxoReader(file) # pylint: disable=possibly-used-before-assignment
-                message_raw = file.read()
-                file.close()
-                message = archiver.parse_message(message_raw)
-                if not message:
-                    self.printid("Message %u could not be extracted from %s, ignoring it" % (key, tmpname))
-                    continue
+            while True:
+                if prof:
+                    profiler.begin(file=source_name)
+                with profiler.stage("read"):
+                    key, message_raw = next(messages, (None, None))
+                if message_raw is None:
+                    profiler.detach()
+                    break
+                profiler.label(key=str(key))
 
-                # If --filter is set, discard any messages not matching by continuing to next email
-                if (
-                    fromFilter
-                    and "from" in message
-                    and message["from"].find(fromFilter) == -1
-                ):
-                    continue
                 if resendTo:
+                    profiler.detach()
+                    message = archiver.parse_message(message_raw)
+                    if filtered_out(message):
+                        continue
                     self.printid(
                         "Delivering message %s via MTA" % message["message-id"]
                         if "message-id" in message
@@ -315,157 +328,262 @@ class SlurpThread(Thread):
                         "Whoa, this is taking way too long, ignoring %s for now"
                         % tmpname
                     )
+                    profiler.detach()
                     break
 
-                # Don't pass message to archiver unless we have a list id
-                if not (list_override or message["list-id"]):
-                    self.printid("No list id found for %s " % message["message-id"])
-                    bad += 1
-                    continue
-                
-                # If fetched from Pipermail, we have to revert/reconstruct From: headers sometimes,
-                # before we can pass it off to final archiving.
-                if args.pipermail and " at " in str(message.get("from")):
-                    m = re.match(r"^(\S+) at (\S+) \((.+)\)$", str(message["from"]))
-                    if m:
-                        message.replace_header("from", "%s <%s@%s>" % (m.group(3), m.group(1), m.group(2)))
+                # Waits here while the parsers are busy, so that memory use stays bounded
+                if not self.queue_message((self.name, source_name, message_raw, profiler.detach())):
+                    break
+                count += 1
 
+            self.printid("Read %u messages from %s" % (count, source_name))
+            if not filebased and not imap:
+                os.unlink(tmpname)
+            if stopping.is_set():
+                self.printid("Stopped")
+                return
+        self.printid("Done, %u elements left to slurp" % len(lists))
 
-                json, contents, _msgdata, _irt, skipit = archie.compute_updates(
-                    list_override, private, message, message_raw
-                )
-                if skipit:
-                    continue
 
-                # Not sure this can ever happen
-                if json and not (json["list"] and json["list_raw"]):
-                    self.printid("No list id found for %s " % json["message-id"])
-                    bad += 1
-                    continue
+def maildir_messages(path):
+    """The keys and raw messages of a maildir"""
+    messages = mailbox.Maildir(path, create=False)
+    for key in messages.iterkeys():
+        with messages.get_file(key) as file:
+            yield key, file.read()
 
-                # If --dedup is active, try to filter out any messages that already exist on the list
-                if json and dedup and message.get("message-id", None):
-                    res = es.search( # pylint: disable=possibly-used-before-assignment
-                        index=es.db_mbox,
-                        doc_type="_doc",
-                        size=1,
-                        _source=["mid"],  # so can report the match source
-                        body={
-                            "query": {
-                                "bool": {
-                                    "must": [
-                                        {
-                                            "term": {
-                                                "message-id": message.get(
-                                                    "message-id", None
-                                                )
-                                            }
-                                        },
-                                        {"term": {"list_raw": json["list"]}},
-                                    ]
-                                }
-                            }
-                        },
-                    )
-                    if res and res["hits"]["total"]["value"] > 0:
-                        self.printid(
-                            "Dedupping %s - matched in %s"
-                            % (
-                                json["message-id"],
-                                res["hits"]["hits"][0]["_source"]["mid"],
-                            )
-                        )
-                        dedupped += 1
-                        continue
 
-                if json:
-                    if args.dups:
-                        try:
-                            duplicates[json["mid"]].append(
-                                json["message-id"] + " in " + filename
-                            )
-                        except Exception: # TODO: narrow exception
-                            duplicates[json["mid"]] = [
-                                json["message-id"] + " in " + filename
-                            ]
-
-                    # Mark that we imported this email
-                    json["_notes"] = [x for x in json["_notes"] if "ARCHIVE:" not in x]  # Pop archiver.py note
-                    json["_notes"].append(["IMPORT: Email imported as %s at %u" % (json["mid"], time.time())])
-
-                    try:  # temporary hack to try and find an encoding issue
-                        # needs to be replaced by proper exception handling
-                        json_source = {
-                            "mid": json["dbid"], # this is only needed for bulk_insert to set up the _id
-                            "message-id": json["message-id"],
-                            "source": archiver.mbox_source(message_raw),
-                        }
-                    except Exception as e:
-                        self.printid(
-                            "Error '%s' processing id %s msg %s "
-                            % (e, json["mid"], json["message-id"])
-                        )
-                        bad += 1
-                        continue
+def filtered_out(message):
+    """If --filter is set, whether the message is to be discarded"""
+    return bool(
+        fromFilter
+        and "from" in message
+        and message["from"].find(fromFilter) == -1
+    )
 
-                    count += 1
-                    if args.verbose and verbose_logger:
-                        # TODO optionally show other fields (e.g. From_ line)
-                        verbose_logger.info("MID:%(mid)s DBID: %(dbid)s MSGID:%(message-id)s", json)
-
-                    # Nothing more to do if dry run
-                    if args.dry:
-                        if dumpfile:
-                            import json as JSON
-                            # drop fields with timestamps
-                            del(json['_notes'])
-                            del(json['_archived_at'])
-                            JSON.dump(json, dumpfile, indent=2, sort_keys=True, ensure_ascii=False)
-                            dumpfile.write(",\n")
-                        continue
-                    ja.append(json)
-                    jas.append(json_source)
-                    if contents:
-                        for key in contents:
-                            es.index(
-                                index=es.db_attachment,
-                                doc_type="_doc",
-                                id=key,
-                                body={"source": contents[key]},
-                            )
-                    if len(ja) >= 40:
-                        bulk_insert_both(self.name, ja, jas, es)
-                        ja = []
-                        jas = []
-                else:
-                    self.printid(
-                        "Failed to parse: Return=%s Message-Id=%s"
-                        % (message.get("Return-Path"), message.get("Message-Id"))
-                    )
-                    bad += 1
 
-            if filebased:
-                self.printid(
-                    "Parsed %u records (failed: %u) from %s" % (count, bad, filename)
-                )
-                if delete_file:
-                    os.unlink(tmpname)
-            elif imap:
-                self.printid("Parsed %u records (failed: %u) from imap" % (count, bad))
+def prepare_message(name, message_raw):
+    """Parser stage: works out the documents for a message.
+    Returns "ok" with the mbox document, attachments and source document,
+    "bad" if the message cannot be imported, or "skip" if it is left out on purpose"""
+    message = archiver.parse_message(message_raw)
+    if not message:
+        print("%s: Message could not be extracted, ignoring it" % name)
+        return "bad", None, None, None
+
+    if filtered_out(message):
+        return "skip", None, None, None
+
+    # Don't pass message to archiver unless we have a list id
+    if not (list_override or message["list-id"]):
+        print("%s: No list id found for %s " % (name, message["message-id"]))
+        return "bad", None, None, None
+
+    # If fetched from Pipermail, we have to revert/reconstruct From: headers sometimes,
+    # before we can pass it off to final archiving.
+    if args.pipermail and " at " in str(message.get("from")):
+        m = re.match(r"^(\S+) at (\S+) \((.+)\)$", str(message["from"]))
+        if m:
+            message.replace_header("from", "%s <%s@%s>" % (m.group(3), m.group(1), m.group(2)))
+
+    json, contents, _msgdata, _irt, skipit = archie.compute_updates(
+        list_override, private, message, message_raw
+    )
+    if skipit:
+        return "skip", None, None, None
+    if not json:
+        print(
+            "%s: Failed to parse: Return=%s Message-Id=%s"
+            % (name, message.get("Return-Path"), message.get("Message-Id"))
+        )
+        return "bad", None, None, None
+    profiler.label(mid=json["mid"], list=json["list"])
+
+    # Not sure this can ever happen
+    if not (json["list"] and json["list_raw"]):
+        print("%s: No list id found for %s " % (name, json["message-id"]))
+        return "bad", None, None, None
+
+    # Mark that we imported this email
+    json["_notes"] = [x for x in json["_notes"] if "ARCHIVE:" not in x]  # Pop archiver.py note
+    json["_notes"].append(["IMPORT: Email imported as %s at %u" % (json["mid"], time.time())])
+
+    try:  # temporary hack to try and find an encoding issue
+        # needs to be replaced by proper exception handling
+        json_source = {
+            "mid": json["dbid"], # this is only needed for bulk_insert to set up the _id
+            "message-id": json["message-id"],
+            "source": archiver.mbox_source(message_raw),
+        }
+    except Exception as e:
+        print(
+            "%s: Error '%s' processing id %s msg %s "
+            % (name, e, json["mid"], json["message-id"])
+        )
+        return "bad", None, None, None
+    return "ok", json, contents, json_source
+
+
+def parse_messages():
+    """A parser process: prepares the messages queued by the readers, until it gets None"""
+    while True:
+        task = read_queue.get()
+        if task is None:
+            break
+        name, source_name, message_raw, profile = task
+        profiler.attach(profile)
+        try:
+            outcome = prepare_message(name, message_raw)
+        except Exception as err:
+            print("%s: Could not parse a message from %s: %s" % (name, source_name, err))
+            outcome = "bad", None, None, None
+        parsed_queue.put((source_name, *outcome, profiler.detach()))
+    parsed_queue.put(None)
+
+
+class Writer:
+    """Writer stage: indexes the prepared messages in bulk"""
+
+    def __init__(self):
+        self.ja = []
+        self.jas = []
+        self.jat = []  # Attachments of each message, when they go to the database
+        self.jsources = []  # Where each message came from
+        self.attachment_bytes = 0
+        self.pending = []  # Messages to check against the archive, for --dedup
+        self.counts: dict = {}  # source -> [imported, failed]
+        self.archived = None
+        if dedup and not args.dry:
+            self.archived = ArchivedIds(es, args.dedup_max_ids or DEFAULT_MAX_IDS) # pylint: disable=possibly-used-before-assignment
+
+    def add(self, source_name, status, json, contents, json_source):
+        count = self.counts.setdefault(source_name, [0, 0])
+        if status == "bad":
+            count[1] += 1
+        if status != "ok":
+            return
+        # If --dedup is active, filter out any messages that already exist on the list
+        if self.archived is not None and json["message-id"]:
+            self.pending.append((source_name, json, contents, json_source))
+            if len(self.pending) >= DEDUP_BATCH_SIZE:
+                self.check_pending()
+        else:
+            self.keep(source_name, json, contents, json_source)
+
+    def check_pending(self):
+        global dedupped  # pylint: disable=global-statement # TODO:FIX
+        if not self.pending:
+            return
+        if prof:
+            prof.end()
+        with prof.stage("es_dedup") if prof else profiler.NOT_PROFILING:
+            matches = self.archived.find([(json["message-id"], json["list"]) for _, json, _, _ in self.pending])
+        pending = self.pending
+        self.pending = []
+        for message, match in zip(pending, matches):
+            json = message[1]
+            # An earlier message of the same batch may be a copy too
+            match = match or self.archived.added(json["message-id"], json["list"])
+            if match:
+                print("Dedupping %s - matched in %s" % (json["message-id"], match))
+                dedupped += 1
             else:
-                self.printid(
-                    "Parsed %s/%s: %u records (failed: %u) from %s"
-                    % (ml, mboxfile, count, bad, tmpname)
+                self.archived.add(json["message-id"], json["list"], json["mid"])
+                self.keep(*message)
+
+    def keep(self, source_name, json, contents, json_source):
+        if args.dups:
+            try:
+                duplicates[json["mid"]].append(
+                    json["message-id"] + " in " + source_name
                 )
-                os.unlink(tmpname)
+            except Exception: # TODO: narrow exception
+                duplicates[json["mid"]] = [
+                    json["message-id"] + " in " + source_name
+                ]
 
+        self.counts[source_name][0] += 1
+        if args.verbose and verbose_logger:
+            # TODO optionally show other fields (e.g. From_ line)
+            verbose_logger.info("MID:%(mid)s DBID: %(dbid)s MSGID:%(message-id)s", json)
+
+        # Nothing more to do if dry run
+        if args.dry:
+            if dumpfile:
+                import json as JSON
+                # drop fields with timestamps
+                del(json['_notes'])
+                del(json['_archived_at'])
+                JSON.dump(json, dumpfile, indent=2, sort_keys=True, ensure_ascii=False)
+                dumpfile.write(",\n")
+            return
+        self.ja.append(json)
+        self.jas.append(json_source)
+        self.jsources.append(source_name)
+        if contents and archie.attachments.on_disk:
+            with profiler.stage("attachments"):
+                for key in contents:
+                    archie.attachments.put(es, key, contents[key])
+            contents = {}
+        self.jat.append(contents or {})
+        self.attachment_bytes += sum(len(b64) for b64 in self.jat[-1].values())
+        if len(self.ja) >= 40 or self.attachment_bytes >= MAX_BATCH_ATTACHMENT_BYTES:
+            self.flush()
+
+    def flush(self):
+        if prof:
+            prof.end()
+        if self.ja:
+            # Messages whose attachments could not be stored are not imported after all
+            for position in bulk_insert_both("Writer", self.ja, self.jas, es, self.jat):
+                count = self.counts[self.jsources[position]]
+                count[0] -= 1
+                count[1] += 1
+                if self.archived is not None:
+                    self.archived.forget(self.ja[position]["message-id"], self.ja[position]["list"])
+        self.ja = []
+        self.jas = []
+        self.jat = []
+        self.jsources = []
+        self.attachment_bytes = 0
+
+    def finish(self):
+        global goodies, baddies  # pylint: disable=global-statement # TODO:FIX
+        self.check_pending()
+        self.flush()
+        for source_name, (count, bad) in self.counts.items():
+            print("Parsed %u records (failed: %u) from %s" % (count, bad, source_name))
             goodies += count
             baddies += bad
-            if len(ja) > 0 and not args.dry:
-                bulk_insert_both(self.name, ja, jas, es)
-            ja = []
-            jas = []
-        self.printid("Done, %u elements left to slurp" % len(lists))
+        if self.archived is not None and self.archived.lookups:
+            print("Looked up %u possible duplicates in the database" % self.archived.lookups)
+
+
+def write_messages(parsers):
+    """Passes the prepared messages to the writer, until every parser is done.
+    Returns False if a parser died, and the messages it had were lost."""
+    writer = Writer()
+    running = len(parsers)
+    ok = True
+    while running:
+        try:
+            result = parsed_queue.get(timeout=5)
+        except queue.Empty:
+            # Parsers only exit by themselves once done, having said so
+            if any(parser.exitcode for parser in parsers) or not any(parser.is_alive() for parser in parsers):
+                print("Error: a parser process has died (exit codes %s)" % [parser.exitcode for parser in parsers])
+                ok = False
+                break
+            continue
+        if result is None:
+            running -= 1
+            continue
+        if prof:
+            prof.end()  # The previous message
+        profiler.attach(result[-1])
+        writer.add(*result[:-1])
+    writer.finish()
+    return ok
 
 
 parser = argparse.ArgumentParser(description="Command line options.")
@@ -594,6 +712,13 @@ parser.add_argument(
     action="store_true",
     help="Don't import a message if its Message-Id already exists on the list",
 )
+parser.add_argument(
+    "--dedup-max-ids",
+    dest="dedup_max_ids",
+    type=int,
+    help="With --dedup, lists with more messages than this are checked with a Bloom filter "
+    "and database lookups, rather than holding all their Message-Ids (default %d)" % DEFAULT_MAX_IDS,
+)
 parser.add_argument(
     "--overwrite",
     dest="overwrite",
@@ -632,6 +757,24 @@ parser.add_argument(
     "--nomboxo", dest="nomboxo", action="store_true", help="Skip Mboxo processing"
 )
 parser.add_argument("--generator", dest="generator", help="Override the generator.")
+parser.add_argument(
+    "--processes",
+    dest="processes",
+    type=int,
+    help="Number of processes parsing messages (default: one per CPU)",
+)
+parser.add_argument(
+    "--profile",
+    dest="profile",
+    action="store_true",
+    help="Show how long each stage of importing took, once done",
+)
+parser.add_argument(
+    "--profile-log",
+    dest="profile_log",
+    type=str,
+    help="With --profile, also write the timings of each message to this file as JSON lines",
+)
 
 args = parser.parse_args()
 
@@ -639,6 +782,10 @@ if len(sys.argv) <= 2:
     parser.print_help()
     sys.exit(-1)
 
+if args.processes is not None and args.processes < 1:
+    print("--processes must be at least 1")
+    sys.exit(-1)
+
 
 if args.source:
     source = args.source[0]
@@ -666,14 +813,9 @@ if args.fromfilter:
     fromFilter = args.fromfilter[0]
 if args.nomboxo:
     noMboxo = args.nomboxo
-else:
-    # Temporary patch to fix Python email package limitation
-    # It must be removed when the Python package is fixed
-    if not __package__:
-        from plugins.mboxo_patch import MboxoFactory, MboxoReader  # pylint: disable=no-name-in-module
-    else:
-        from .plugins.mboxo_patch import MboxoFactory, MboxoReader
 
+if args.profile:
+    prof = profiler.Profiler(args.profile_log)
 if args.resend:
     resendTo = args.resend[0]
     from smtplib import SMTP
@@ -912,6 +1054,22 @@ else:
             glob_dir(source)
 
 
+archie = archiver.Archiver(
+    generator=args.generator, parse_html=args.html2text, ignore_body=args.ibody, verbose=args.verbose
+)
+
+# Reader threads -> read_queue -> parser processes -> parsed_queue -> writer (this thread).
+# The parsers are forked, so that they share the settings above, and before any
+# reader is started. The queues are bounded, so the readers wait for the parsers.
+workers = args.processes or multiprocessing.cpu_count()
+fork = multiprocessing.get_context("fork")
+read_queue = fork.Queue(maxsize=4 * workers)
+parsed_queue = fork.Queue(maxsize=4 * workers)
+parsers = [fork.Process(target=parse_messages, daemon=True) for _ in range(workers)]
+for p in parsers:
+    p.start()
+print("Started %u parser processes" % workers)
+
 threads = []
 # Don't start more threads than there are lists
 cc = min(len(lists), int(multiprocessing.cpu_count() / 2) + 1)
@@ -922,8 +1080,22 @@ for i in range(1, cc + 1):
     t.start()
     print("Started no. %u" % i)
 
-for t in threads:
-    t.join()
+
+def finish_reading():
+    for t in threads:
+        t.join()
+    for _ in parsers:
+        read_queue.put(None)  # No more messages
+
+
+Thread(target=finish_reading, daemon=True).start()
+parsed_all = write_messages(parsers)
+if not parsed_all:
+    stopping.set()  # The readers would otherwise wait for the parsers forever
+    for p in parsers:
+        p.terminate()
+for p in parsers:
+    p.join()
 
 if args.dups:
     print("Showing duplicate ids:")
@@ -937,6 +1109,10 @@ if dumpfile:
     dumpfile.write("]\n")
     dumpfile.close()
 
+if prof:
+    prof.close()
+    print(prof.summary())
+
 if args.overwrite:
     print(
         "All done! %u records processed (including %u replacements) after %u seconds. %u records were bad and ignored."
@@ -949,3 +1125,6 @@ else:
     )
 if dedupped > 0:
     print("%u records were not inserted due to deduplication" % dedupped)
+if not parsed_all:
+    print("The import did not finish, as a parser process died")
+    sys.exit(1)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+""" Utility for moving attachments between the -attachment index and the on-disk blob store.
+
+Typical use, after setting the attachments path in archiver.yaml:
+
+    python3 migrate-attachments.py --to disk
+    (switch the archiver and the server to the disk backend)
+    python3 migrate-attachments.py --to disk --delete
+
+"""
+
+import argparse
+import base64
+import hashlib
+import os
+import sys
+import time
+import typing
+
+from elasticsearch.helpers import scan
+
+if not __package__:
+    from plugins import ponymailconfig # pylint: disable=no-name-in-module
+    from plugins.blobstore import BlobStore, DIGEST_RE # pylint: disable=no-name-in-module
+    from plugins.elastic import Elastic # pylint: disable=no-name-in-module
+else:
+    from .plugins import ponymailconfig # pylint: disable=no-name-in-module
+    from .plugins.blobstore import BlobStore, DIGEST_RE # pylint: disable=no-name-in-module
+    from .plugins.elastic import Elastic # pylint: disable=no-name-in-module
+
+BULK_SIZE = 500  # Number of deletions/insertions to send per bulk request
+
+
+def to_disk(elastic: Elastic, blobs: BlobStore, delete: bool, dry: bool) -> None:
+    """Copies every attachment in the index to disk, optionally removing it from the index afterwards"""
+    copied = 0
+    present = 0
+    bad = 0
+    deletions = []
+    for hit in scan(client=elastic.es, index=elastic.db_attachment, query={"query": {"match_all": {}}}):
+        digest = hit["_id"]
+        if not DIGEST_RE.match(digest):
+            print("Skipping %s: not a SHA-256 digest" % digest)
+            bad += 1
+            continue
+        data = base64.standard_b64decode(hit["_source"].get("source", ""))
+        if hashlib.sha256(data).hexdigest() != digest:
+            print("Skipping %s: contents do not match the digest" % digest)
+            bad += 1
+            continue
+        if dry:
+            copied += 1
+            continue
+        if blobs.put(digest, data):
+            copied += 1
+        else:
+            present += 1
+        if delete:
+            deletions.append({"_op_type": "delete", "_index": elastic.db_attachment, "_id": digest})
+            if len(deletions) >= BULK_SIZE:
+                elastic.bulk(deletions)
+                deletions = []
+        if (copied + present) % 1000 == 0:
+            print("%u attachments processed..." % (copied + present))
+    if deletions:
+        elastic.bulk(deletions)
+    print("Copied %u attachments to disk, %u were already present, %u were skipped." % (copied, present, bad))
+
+
+def to_elastic(elastic: Elastic, blobs: BlobStore, delete: bool, dry: bool) -> None:
+    """Copies every attachment on disk into the index, optionally removing it from disk afterwards"""
+    copied = 0
+    actions: typing.List[dict] = []
+    digests: typing.List[str] = []
+
+    def flush():
+        if actions and not dry:
+            elastic.bulk(actions)
+            if delete:
+                for digest in digests:
+                    blobs.delete(digest)
+        actions.clear()
+        digests.clear()
+
+    for dirpath, _dirnames, filenames in os.walk(blobs.root):
+        for filename in filenames:
+            if not DIGEST_RE.match(filename):
+                continue  # Ignore temporary and unrelated files
+            data = blobs.get(filename)
+            if data is None:
+                continue
+            actions.append(
+                {
+                    "_op_type": "index",
+                    "_index": elastic.db_attachment,
+                    "_id": filename,
+                    "_source": {"source": base64.standard_b64encode(data).decode("ascii")},
+                }
+            )
+            digests.append(filename)
+            copied += 1
+            if len(actions) >= BULK_SIZE:
+                flush()
+                print("%u attachments processed (%s)..." % (copied, dirpath))
+    flush()
+    print("Copied %u attachments to %s." % (copied, elastic.db_attachment))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Command line options.")
+    parser.add_argument(
+        "--to", dest="to", choices=("disk", "elastic"), default="disk",
+        help="Where to move attachments to (default: disk)",
+    )
+    parser.add_argument(
+        "--path", dest="path", help="Blob store directory (default: attachments/path in archiver.yaml)",
+    )
+    parser.add_argument(
+        "--delete", dest="delete", action="store_true",
+        help="Remove attachments from the old location once copied",
+    )
+    parser.add_argument(
+        "--dry", dest="dry", action="store_true", help="Only check the attachments, do not copy anything",
+    )
+    args = parser.parse_args()
+
+    config = ponymailconfig.PonymailConfig()
+    path = args.path or config.get("attachments", "path")
+    if not path:
+        print("No blob store path given; use --path or set attachments/path in archiver.yaml")
+        sys.exit(-1)
+
+    start = time.time()
+    elastic = Elastic()
+    blobs = BlobStore(path)
+    if args.to == "disk":
+        to_disk(elastic, blobs, args.delete, args.dry)
+    else:
+        to_elastic(elastic, blobs, args.delete, args.dry)
+    print("All done in %u seconds." % (time.time() - start))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Content-addressed attachment storage
+
+    Attachments are keyed by the SHA-256 digest of their contents. By default they
+    are stored base64-encoded in the -attachment index; with the disk backend the
+    raw bytes are written to a sharded directory tree instead:
+
+        <path>/ab/cd/abcdef0123...
+
+    The layout must be the same as server/plugins/attachments.py; test/test_blobstore.py checks it is
+
+    How to use:
+
+    from plugins.blobstore import AttachmentStore
+    store = AttachmentStore()
+    store.put(elastic, digest, b64_contents)
+"""
+
+import base64
+import os
+import re
+import tempfile
+import typing
+
+from . import ponymailconfig
+
+BACKEND_ELASTIC = "elastic"
+BACKEND_DISK = "disk"
+DIGEST_RE = re.compile(r"^[a-f0-9]{64}$")  # SHA-256 hex digest; anything else must not touch the file system
+
+
+def blob_mode() -> int:
+    """The mode open() would give a new file: the API server usually runs as another user, and must read blobs"""
+    umask = os.umask(0)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+
+BLOB_MODE = blob_mode()  # Read once, as changing the umask to read it is not thread-safe
+
+
+class BlobStore:
+    """A sharded directory of blobs keyed by their SHA-256 digest"""
+
+    def __init__(self, root: str):
+        self.root = root
+
+    def path(self, digest: str) -> str:
+        """Returns the on-disk path of a blob, refusing anything that is not a hex digest"""
+        if not DIGEST_RE.match(digest):
+            raise ValueError("Invalid attachment digest: %r" % digest)
+        return os.path.join(self.root, digest[0:2], digest[2:4], digest)
+
+    def exists(self, digest: str) -> bool:
+        return os.path.isfile(self.path(digest))
+
+    def put(self, digest: str, data: bytes) -> bool:
+        """Stores a blob, returns False if it was already present"""
+        filepath = self.path(digest)
+        if os.path.isfile(filepath):
+            return False  # Content-addressed, so identical contents are already stored
+        dirname = os.path.dirname(filepath)
+        os.makedirs(dirname, exist_ok=True)
+        # Write to a temporary file and rename it into place, so readers never see a partial blob
+        fd, tmpname = tempfile.mkstemp(dir=dirname, prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+                os.fchmod(f.fileno(), BLOB_MODE)  # mkstemp makes files only their owner can read
+            os.replace(tmpname, filepath)
+        except BaseException:
+            os.unlink(tmpname)
+            raise
+        return True
+
+    def get(self, digest: str) -> typing.Optional[bytes]:
+        try:
+            with open(self.path(digest), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def delete(self, digest: str) -> bool:
+        try:
+            os.unlink(self.path(digest))
+            return True
+        except FileNotFoundError:
+            return False
+
+
+class AttachmentStore:
+    """Writes attachments to whichever backend is set in the attachments section of archiver.yaml"""
+
+    def __init__(self, config: typing.Optional[ponymailconfig.PonymailConfig] = None):
+        config = config or ponymailconfig.PonymailConfig()
+        self.backend = config.get("attachments", "backend", fallback=BACKEND_ELASTIC)
+        self.blobs: typing.Optional[BlobStore] = None
+        if self.backend == BACKEND_DISK:
+            path = config.get("attachments", "path")
+            if not path:
+                raise ValueError("attachments: the disk backend requires a path to be set")
+            self.blobs = BlobStore(path)
+        elif self.backend != BACKEND_ELASTIC:
+            raise ValueError("attachments: unknown backend %r" % self.backend)
+
+    @property
+    def on_disk(self) -> bool:
+        return self.blobs is not None
+
+    def put(self, elastic, digest: str, b64: str) -> None:
+        """Stores a base64 encoded attachment"""
+        if self.blobs is not None:
+            self.blobs.put(digest, base64.standard_b64decode(b64))
+        else:
+            elastic.index(
+                index=elastic.db_attachment,
+                id=digest,
+                body={"source": b64},
+            )
+
+    def bulk_action(self, elastic, digest: str, b64: str) -> typing.Optional[dict]:
+        """Like put, but returns the bulk action that stores the attachment in the database, if it goes there"""
+        if self.blobs is not None:
+            self.blobs.put(digest, base64.standard_b64decode(b64))
+            return None
+        return {"_index": elastic.db_attachment, "_id": digest, "_source": {"source": b64}}
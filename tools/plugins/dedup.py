@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Finds the messages that are already archived on a list, for import-mbox.py --dedup
+
+    The Message-Ids of a list are read from the database once, the first time the list is
+    seen, rather than searched for message by message. Up to max_ids of them are kept as
+    they are, which answers exactly with no further requests. The Message-Ids of a larger
+    list go into a Bloom filter instead, which takes about 2 bytes per Message-Id: messages
+    that it has not seen are new, and the few others are looked up in one _msearch request
+    per batch. Messages added during the run are remembered too, so that repeats of a message in
+    later files are found before they are searchable.
+
+    How to use:
+
+    from plugins.dedup import ArchivedIds
+    archived = ArchivedIds(elastic)
+    matches = archived.find([(message_id, list_id), ...])  # the mid of each match, or None
+    archived.add(message_id, list_id, mid)  # for each message that is archived after all
+"""
+
+import collections
+import hashlib
+import math
+import typing
+
+DEFAULT_MAX_IDS = 1000000
+PAGE_SIZE = 5000  # Message-Ids read per scroll request
+RECENT_IDS = 10000  # Message-Ids added to a Bloom filter that are also kept, until they are searchable
+
+
+class BloomFilter:
+    def __init__(self, capacity: int, error_rate: float = 0.001):
+        capacity = max(capacity, 1)
+        self.size = max(int(-capacity * math.log(error_rate) / math.log(2) ** 2), 8)
+        self.hashes = max(int(round(self.size / capacity * math.log(2))), 1)
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def positions(self, key: str) -> typing.Iterator[int]:
+        # Two hashes are enough to make any number of them (Kirsch and Mitzenmacher)
+        digest = hashlib.blake2b(key.encode("utf-8", "surrogateescape"), digest_size=16).digest()
+        first = int.from_bytes(digest[:8], "little")
+        second = int.from_bytes(digest[8:], "little")
+        for i in range(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, key: str) -> None:
+        for position in self.positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(key))
+
+
+class ArchivedIds:
+    """The Message-Ids archived on each list, read from the database as lists are first seen"""
+
+    def __init__(self, elastic, max_ids: int = DEFAULT_MAX_IDS):
+        self.elastic = elastic
+        self.max_ids = max_ids
+        # list -> {message-id: mid}, or a BloomFilter of the message-ids for a large list
+        self.lists: typing.Dict[str, typing.Union[typing.Dict[str, str], BloomFilter]] = {}
+        self.lookups = 0  # Messages that had to be looked up in the database
+        # (message-id, list) -> mid of the latest messages added to Bloom filters, which the database may not show yet
+        self.recent: typing.OrderedDict[typing.Tuple[str, str], str] = collections.OrderedDict()
+
+    def load(self, lid: str) -> typing.Union[typing.Dict[str, str], BloomFilter]:
+        query = {"term": {"list_raw": lid}}
+        count = self.elastic.count(index=self.elastic.db_mbox, body={"query": query})["count"]
+        known: typing.Union[typing.Dict[str, str], BloomFilter] = {}
+        if count > self.max_ids:
+            known = BloomFilter(count)
+            print("%s has %u messages, checking for duplicates with a Bloom filter" % (lid, count))
+        result = self.elastic.search(
+            index=self.elastic.db_mbox,
+            scroll="5m",
+            body={"size": PAGE_SIZE, "_source": ["message-id", "mid"], "query": query, "sort": ["_doc"]},
+        )
+        scroll_id = result.get("_scroll_id")
+        try:
+            while result["hits"]["hits"]:
+                for hit in result["hits"]["hits"]:
+                    message_id = hit["_source"].get("message-id")
+                    if not message_id:
+                        continue
+                    if isinstance(known, BloomFilter):
+                        known.add(message_id)
+                    else:
+                        known[message_id] = hit["_source"].get("mid", hit["_id"])
+                result = self.elastic.scroll(scroll="5m", scroll_id=scroll_id)
+                scroll_id = result.get("_scroll_id", scroll_id)
+        finally:
+            if scroll_id:
+                self.elastic.clear_scroll(scroll_id=scroll_id)
+        return known
+
+    def find(self, messages: typing.List[typing.Tuple[str, str]]) -> typing.List[typing.Optional[str]]:
+        """Given (message-id, list) pairs, returns the mid of the archived copy of each message, or None"""
+        found: typing.List[typing.Optional[str]] = [None] * len(messages)
+        maybe = []  # Positions of the messages that a Bloom filter has seen
+        for position, (message_id, lid) in enumerate(messages):
+            if lid not in self.lists:
+                self.lists[lid] = self.load(lid)
+            known = self.lists[lid]
+            if isinstance(known, BloomFilter):
+                if (message_id, lid) in self.recent:
+                    found[position] = self.recent[(message_id, lid)]
+                elif message_id in known:
+                    maybe.append(position)
+            else:
+                found[position] = known.get(message_id)
+        if maybe:
+            body: typing.List[dict] = []
+            for position in maybe:
+                message_id, lid = messages[position]
+                body.append({})
+                body.append({
+                    "size": 1,
+                    "_source": ["mid"],
+                    "query": {"bool": {"must": [
+                        {"term": {"message-id": message_id}},
+                        {"term": {"list_raw": lid}},
+                    ]}},
+                })
+            self.lookups += len(maybe)
+            responses = self.elastic.msearch(index=self.elastic.db_mbox, body=body)["responses"]
+            for position, response in zip(maybe, responses):
+                if "error" in response:
+                    raise RuntimeError("Could not look for duplicates: %s" % response["error"])
+                hits = response["hits"]["hits"]
+                if hits:
+                    found[position] = hits[0]["_source"]["mid"]
+        return found
+
+    def added(self, message_id: str, lid: str) -> typing.Optional[str]:
+        """The mid of a message remembered with add(), looking no further"""
+        known = self.lists.get(lid)
+        if isinstance(known, BloomFilter):
+            return self.recent.get((message_id, lid))
+        return known.get(message_id) if known is not None else None
+
+    def add(self, message_id: str, lid: str, mid: str) -> None:
+        """Remembers a message that is being archived, so that later copies of it are found"""
+        if lid not in self.lists:
+            self.lists[lid] = self.load(lid)
+        known = self.lists[lid]
+        if isinstance(known, BloomFilter):
+            known.add(message_id)
+            self.recent[(message_id, lid)] = mid
+            if len(self.recent) > RECENT_IDS:
+                self.recent.popitem(last=False)
+        else:
+            known.setdefault(message_id, mid)
+
+    def forget(self, message_id: str, lid: str) -> None:
+        """Undoes add() for a message that was not archived after all; the database has the last word on
+        what a Bloom filter has seen"""
+        known = self.lists.get(lid)
+        if isinstance(known, BloomFilter):
+            self.recent.pop((message_id, lid), None)
+        elif known is not None:
+            known.pop(message_id, None)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Message delivery protocols for archiver-daemon.py
+
+    Two ways of handing a message to the daemon are supported:
+
+    - The archiver socket protocol, spoken by archiver-client.py. The client sends a JSON line
+      {"args": [archiver.py options], "size": N} followed by N bytes of message, and gets back
+      a JSON line {"status": exit status, "output": what archiver.py would have printed}.
+      Several messages may be sent over one connection.
+    - LMTP (RFC 2033), so an MTA can deliver to the daemon directly.
+
+    Both only depend on the standard library, so that archiver-client.py starts quickly.
+    The server object must provide deliver(argv, raw_message) -> (status, output),
+    and lmtp_argv, the archiver.py options used for messages received over LMTP.
+"""
+
+import io
+import json
+import socket
+import socketserver
+import typing
+
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024  # Refuse anything bigger than this
+MAX_LINE_LENGTH = 65536  # For protocol lines, not message content
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def submit(path: str, argv: typing.List[str], raw_message: bytes) -> typing.Tuple[int, str]:
+    """Hands one message to the daemon listening on the Unix socket at path, returns (status, output)"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(path)
+        stream = sock.makefile("rwb")
+        return submit_over(stream, argv, raw_message)
+
+
+def submit_over(stream: io.BufferedIOBase, argv: typing.List[str], raw_message: bytes) -> typing.Tuple[int, str]:
+    """Sends one message over an open connection, which can then be used for the next one"""
+    header = {"args": argv, "size": len(raw_message)}
+    stream.write(json.dumps(header).encode("utf-8") + b"\n")
+    stream.write(raw_message)
+    stream.flush()
+    line = stream.readline(MAX_LINE_LENGTH)
+    if not line:
+        raise ProtocolError("The archiver daemon closed the connection without answering")
+    reply = json.loads(line)
+    return reply["status"], reply["output"]
+
+
+class SocketHandler(socketserver.StreamRequestHandler):
+    """Server side of the archiver socket protocol"""
+
+    def reply(self, status: int, output: str):
+        self.wfile.write(json.dumps({"status": status, "output": output}).encode("utf-8") + b"\n")
+        self.wfile.flush()
+
+    def handle(self):
+        while True:
+            line = self.rfile.readline(MAX_LINE_LENGTH)
+            if not line:
+                return
+            try:
+                header = json.loads(line)
+                size = int(header["size"])
+                args = header["args"]
+                if size < 0 or not isinstance(args, list):
+                    raise ValueError("size must not be negative, and args must be a list")
+            except (ValueError, KeyError, TypeError) as e:  # Not something archiver-client.py sends
+                self.reply(-1, "Bad request: %s: %s\n" % (type(e).__name__, e))
+                return
+            if size > MAX_MESSAGE_SIZE:
+                self.reply(-1, "Message too large, %u bytes (limit %u)\n" % (size, MAX_MESSAGE_SIZE))
+                return
+            raw_message = self.rfile.read(size)
+            if len(raw_message) < size:
+                return
+            status, output = self.server.deliver(args, raw_message)  # type: ignore [attr-defined]
+            self.reply(status, output)
+
+
+def read_data(rfile: io.BufferedIOBase) -> typing.Optional[bytes]:
+    """Reads a message sent after DATA up to the lone dot, undoing dot-stuffing.
+    Returns None if it is too large, after reading it all."""
+    lines = []
+    size = 0
+    while True:
+        line = rfile.readline(MAX_MESSAGE_SIZE)
+        if not line:
+            raise ProtocolError("Connection closed during DATA")
+        if line in (b".\r\n", b".\n"):
+            break
+        if line.startswith(b"."):
+            line = line[1:]
+        size += len(line)
+        if size <= MAX_MESSAGE_SIZE:
+            lines.append(line)
+    if size > MAX_MESSAGE_SIZE:
+        return None
+    return b"".join(lines)
+
+
+class LMTPHandler(socketserver.StreamRequestHandler):
+    """A minimal LMTP server: one delivery per message, whatever the number of recipients,
+    since the archive is chosen by the List-ID header and not by the envelope."""
+
+    def reply(self, text: str):
+        self.wfile.write(text.encode("utf-8") + b"\r\n")
+        self.wfile.flush()
+
+    def handle(self):
+        self.reply("220 %s LMTP Pony Mail archiver ready" % socket.getfqdn())
+        sender = None
+        recipients: typing.List[str] = []
+        while True:
+            line = self.rfile.readline(MAX_LINE_LENGTH)
+            if not line:
+                return
+            command, _, argument = line.decode("utf-8", "replace").strip().partition(" ")
+            command = command.upper()
+            if command == "LHLO":
+                self.reply("250-%s" % socket.getfqdn())
+                self.reply("250-PIPELINING")
+                self.reply("250-ENHANCEDSTATUSCODES")
+                self.reply("250-8BITMIME")
+                self.reply("250 SIZE %u" % MAX_MESSAGE_SIZE)
+            elif command == "MAIL":
+                sender = argument
+                recipients = []
+                self.reply("250 2.1.0 OK")
+            elif command == "RCPT":
+                if sender is None:
+                    self.reply("503 5.5.1 MAIL first")
+                    continue
+                recipients.append(argument)
+                self.reply("250 2.1.5 OK")
+            elif command == "DATA":
+                if not recipients:
+                    self.reply("503 5.5.1 RCPT first")
+                    continue
+                self.reply("354 Start mail input; end with <CRLF>.<CRLF>")
+                raw_message = read_data(self.rfile)
+                if raw_message is None:
+                    result = "552 5.3.4 Message too large"
+                else:
+                    status, _output = self.server.deliver(list(self.server.lmtp_argv), raw_message)  # type: ignore [attr-defined]
+                    # Failures are temporary, so the MTA keeps the message and tries again later
+                    result = "250 2.0.0 Archived" if status == 0 else "451 4.3.0 Archiving failed"
+                for _recipient in recipients:
+                    self.reply(result)
+                sender = None
+                recipients = []
+            elif command == "RSET":
+                sender = None
+                recipients = []
+                self.reply("250 2.0.0 OK")
+            elif command == "NOOP":
+                self.reply("250 2.0.0 OK")
+            elif command == "QUIT":
+                self.reply("221 2.0.0 Bye")
+                return
+            else:
+                self.reply("500 5.5.2 Command not recognized")
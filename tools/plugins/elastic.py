@@ -152,6 +152,12 @@ class Elastic:
     def search(self, **kwargs):
         return self.es.search(**kwargs)
 
+    def msearch(self, **kwargs):
+        return self.es.msearch(**kwargs)
+
+    def count(self, **kwargs):
+        return self.es.count(**kwargs)
+
     def index(self, **kwargs):
         kwargs["wait_for_active_shards"] = self.wait_for_active_shards
         kwargs["doc_type"] = "_doc"
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Splits mbox files into raw messages without loading them into memory.
+
+A plain file is mapped into memory (mmap) and searched in place; a gzip compressed file
+is decompressed as it is read, keeping no more than the message being read. Either way
+memory use depends on the largest message rather than the size of the file.
+
+Messages are split exactly as mailbox.mbox does: each starts at a "From " line, which is
+included, and ends before the blank line preceding the next one, if there is one. With
+mboxo set, ">From " at the start of a line is changed back to "From ", as MboxoReader does.
+
+To use:
+
+from mboxsplit import read_messages
+for raw in read_messages(filename):
+    ...
+"""
+
+import gzip
+import mmap
+import typing
+
+if not __package__:
+    from plugins.mboxo_patch import FROM_MANGLED, FROM_UNMANGLED # pylint: disable=no-name-in-module
+else:
+    from .mboxo_patch import FROM_MANGLED, FROM_UNMANGLED
+
+FROM_LINE = b"\nFrom "
+GZIP_MAGIC = b"\x1f\x8b"
+CHUNK_SIZE = 1024 * 1024
+
+
+def message_stop(buf, newline: int) -> int:
+    """Where a message ends, given the newline before the next "From " line"""
+    # A blank line before the "From " line is not part of the message
+    if buf[newline - 1:newline] == b"\n":
+        return newline
+    return newline + 1
+
+
+def final_stop(buf) -> int:
+    """Where the last message ends: a blank last line is not part of it"""
+    if buf[-2:] == b"\n\n":
+        return len(buf) - 1
+    return len(buf)
+
+
+def split_buffer(buf) -> typing.Iterator[typing.Tuple[int, int]]:
+    """Yields the (start, stop) offsets of the messages in a complete mbox held in buf"""
+    start = 0 if buf[:5] == b"From " else None
+    pos = 0
+    while True:
+        found = buf.find(FROM_LINE, pos)
+        if found == -1:
+            break
+        if start is not None:
+            yield start, message_stop(buf, found)
+        start = pos = found + 1
+    if start is not None:
+        yield start, final_stop(buf)
+
+
+def split_stream(f: typing.BinaryIO, chunk_size: int = CHUNK_SIZE) -> typing.Iterator[bytes]:
+    """Yields the messages of an mbox read from a stream, chunk by chunk"""
+    buf = bytearray()
+    start: typing.Optional[int] = None
+    pos = 0
+    checked_start = False
+    while True:
+        chunk = f.read(chunk_size)
+        buf += chunk
+        if not checked_start:
+            if len(buf) < 5 and chunk:
+                continue
+            checked_start = True
+            if buf[:5] == b"From ":
+                start = 0
+        while True:
+            found = buf.find(FROM_LINE, pos)
+            if found == -1:
+                break
+            if start is not None:
+                yield bytes(memoryview(buf)[start:message_stop(buf, found)])
+            start = pos = found + 1
+        if not chunk:
+            if start is not None:
+                yield bytes(memoryview(buf)[start:final_stop(buf)])
+            return
+        # Keep the message being read, or before the first one, enough to find a "From " line split between reads
+        keep = start if start is not None else max(len(buf) - len(FROM_LINE), 0)
+        pos = max(pos, len(buf) - len(FROM_LINE) + 1) - keep
+        del buf[:keep]
+        if start is not None:
+            start = 0
+
+
+def read_messages(path: str, mboxo: bool = True) -> typing.Iterator[bytes]:
+    """Yields the raw messages, including their "From " line, of an mbox file that may be gzip compressed"""
+    with open(path, "rb") as f:
+        if f.read(2) == GZIP_MAGIC:
+            f.seek(0)
+            with gzip.GzipFile(fileobj=f) as gz:
+                for raw in split_stream(typing.cast(typing.BinaryIO, gz)):
+                    yield raw.replace(FROM_MANGLED, FROM_UNMANGLED) if mboxo else raw
+            return
+        f.seek(0, 2)
+        if f.tell() == 0:
+            return  # mmap cannot map an empty file
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            if hasattr(mmap, "MADV_SEQUENTIAL"):
+                buf.madvise(mmap.MADV_SEQUENTIAL)
+            for start, stop in split_buffer(buf):
+                raw = buf[start:stop]
+                yield raw.replace(FROM_MANGLED, FROM_UNMANGLED) if mboxo else raw
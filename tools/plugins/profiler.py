@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Per-stage timings and counters for --profile in archiver.py and import-mbox.py
+
+    The archiver code marks its stages with profiler.stage("name") and counts things with
+    profiler.count("name", n). These do nothing unless a message is being profiled in the
+    current thread, which is started with Profiler.begin() (or the Profiler.message() context)
+    and ends with Profiler.end() or the next begin(). Work that is not done for one message,
+    such as a bulk request for a batch of them, is timed with Profiler.stage() instead.
+
+    A message handled by several threads or processes in turn is passed along with it: each
+    takes the profile with detach() when done, and the next one carries on with attach().
+
+    How to use:
+
+    from plugins import profiler
+    prof = profiler.Profiler("profile.jsonl")  # or Profiler() for the summary only
+    with prof.message(file="x.mbox"):
+        with profiler.stage("parse"): ...
+        profiler.count("attachments", 2)
+    print(prof.summary())
+"""
+
+import contextlib
+import json
+import threading
+import time
+import typing
+
+NOT_PROFILING = contextlib.nullcontext()
+
+local = threading.local()
+
+
+class Totals:
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.longest = 0.0
+
+    def add(self, calls: int, seconds: float) -> None:
+        self.calls += calls
+        self.seconds += seconds
+        self.longest = max(self.longest, seconds)
+
+
+class MessageProfile:
+    """The stages and counters of one message"""
+
+    def __init__(self, labels: dict):
+        self.labels = labels
+        self.elapsed = 0.0  # Before it was last attached
+        self.started = time.perf_counter()
+        self.stages: typing.Dict[str, typing.List] = {}  # name -> [calls, seconds]
+        self.counters: typing.Dict[str, int] = {}
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            entry = self.stages.setdefault(name, [0, 0.0])
+            entry[0] += 1
+            entry[1] += time.perf_counter() - started
+
+
+def begin(**labels) -> None:
+    """Starts profiling a message in this thread; Profiler.begin() also adds up the previous one"""
+    local.message = MessageProfile(labels)
+
+
+def detach() -> typing.Optional[MessageProfile]:
+    """Stops profiling the message of this thread, and returns its profile, if any"""
+    current = getattr(local, "message", None)
+    if current is not None:
+        local.message = None
+        current.elapsed += time.perf_counter() - current.started
+    return current
+
+
+def attach(profile: typing.Optional[MessageProfile]) -> None:
+    """Carries on profiling a message in this thread, from where detach() left off"""
+    if profile is not None:
+        profile.started = time.perf_counter()
+    local.message = profile
+
+
+def stage(name: str) -> typing.ContextManager:
+    """Times a stage of the message being profiled in this thread, if any"""
+    current = getattr(local, "message", None)
+    if current is None:
+        return NOT_PROFILING
+    return current.stage(name)
+
+
+def count(name: str, amount: int = 1) -> None:
+    """Adds to a counter of the message being profiled in this thread, if any"""
+    current = getattr(local, "message", None)
+    if current is not None:
+        current.counters[name] = current.counters.get(name, 0) + amount
+
+
+def label(**labels) -> None:
+    """Adds to the labels written to the log for the message being profiled in this thread, if any"""
+    current = getattr(local, "message", None)
+    if current is not None:
+        current.labels.update(labels)
+
+
+class Profiler:
+    """Collects the profiles of messages, from any number of threads"""
+
+    def __init__(self, log_path: typing.Optional[str] = None):
+        self.lock = threading.Lock()
+        self.messages = 0
+        self.seconds = 0.0  # Spent on messages, and on work for several of them
+        self.stages: typing.Dict[str, Totals] = {}
+        self.batch_stages: typing.Dict[str, Totals] = {}
+        self.counters: typing.Dict[str, int] = {}
+        self.log = open(log_path, "a") if log_path else None
+
+    def begin(self, **labels) -> None:
+        """Starts profiling a message in this thread, ending the previous one"""
+        self.end()
+        begin(**labels)
+
+    def end(self) -> None:
+        """Stops profiling the message of this thread, and adds it to the totals"""
+        current = detach()
+        if current is not None:
+            self.add(current)
+
+    def add(self, current: MessageProfile) -> None:
+        """Adds the profile of a message to the totals"""
+        elapsed = current.elapsed
+        with self.lock:
+            self.messages += 1
+            self.seconds += elapsed
+            for name, (calls, seconds) in current.stages.items():
+                self.stages.setdefault(name, Totals()).add(calls, seconds)
+            for name, amount in current.counters.items():
+                self.counters[name] = self.counters.get(name, 0) + amount
+            if self.log:
+                entry = {
+                    **current.labels,
+                    "total_ms": round(elapsed * 1000, 3),
+                    "stages_ms": {name: round(seconds * 1000, 3) for name, (_calls, seconds) in current.stages.items()},
+                    "counters": current.counters,
+                }
+                self.log.write(json.dumps(entry) + "\n")
+
+    @contextlib.contextmanager
+    def message(self, **labels):
+        self.begin(**labels)
+        try:
+            yield
+        finally:
+            self.end()
+
+    @contextlib.contextmanager
+    def stage(self, name: str):
+        """Times work done for several messages at once"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - started
+            with self.lock:
+                self.seconds += elapsed
+                self.batch_stages.setdefault(name, Totals()).add(1, elapsed)
+
+    def close(self) -> None:
+        self.end()
+        if self.log:
+            self.log.close()
+            self.log = None
+
+    def summary(self) -> str:
+        """A table of where the time went; the longest time of a stage is per message, or per call for batches"""
+        with self.lock:
+            lines = [
+                "Profile of %u messages, %.3f seconds in total" % (self.messages, self.seconds),
+                "%-16s %8s %10s %10s %10s %6s" % ("stage", "calls", "total s", "ms/msg", "max ms", "%"),
+            ]
+            total = self.seconds or 1.0
+            per_message = max(self.messages, 1)
+            accounted = 0.0
+            rows = sorted(self.stages.items(), key=lambda item: -item[1].seconds)
+            for name, stats in rows:
+                accounted += stats.seconds
+                lines.append(
+                    "%-16s %8u %10.3f %10.3f %10.3f %6.1f"
+                    % (name, stats.calls, stats.seconds, stats.seconds * 1000 / per_message,
+                       stats.longest * 1000, stats.seconds * 100 / total)
+                )
+            batch_seconds = sum(stats.seconds for stats in self.batch_stages.values())
+            other = self.seconds - batch_seconds - accounted
+            lines.append(
+                "%-16s %8s %10.3f %10.3f %10s %6.1f"
+                % ("(other)", "", other, other * 1000 / per_message, "", other * 100 / total)
+            )
+            for name, stats in sorted(self.batch_stages.items(), key=lambda item: -item[1].seconds):
+                lines.append(
+                    "%-16s %8u %10.3f %10.3f %10.3f %6.1f"
+                    % (name + " (batch)", stats.calls, stats.seconds, stats.seconds * 1000 / per_message,
+                       stats.longest * 1000, stats.seconds * 100 / total)
+                )
+            if self.counters:
+                lines.append("%-16s %12s %12s" % ("counter", "total", "per msg"))
+                for name, amount in sorted(self.counters.items()):
+                    lines.append("%-16s %12u %12.1f" % (name, amount, amount / per_message))
+            return "\n".join(lines)
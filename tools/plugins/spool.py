@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+# Licensed to the Apache Software Foundation (ASF) under one or more
+# contributor license agreements.  See the NOTICE file distributed with
+# this work for additional information regarding copyright ownership.
+# The ASF licenses this file to You under the Apache License, Version 2.0
+# (the "License"); you may not use this file except in compliance with
+# the License.  You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+    Durable append-only spool of archived messages
+
+    With a spool, the archiver only writes each message to local disk, and flush-spool.py indexes
+    them later, so delivery does not wait for (or fail with) the database. The spool is a directory
+    of segment files holding one JSON record per line:
+
+        <path>/segment-000000000001.jsonl
+        <path>/segment-000000000002.jsonl
+        <path>/checkpoint      how far the flusher got: {"segment": ..., "offset": ...}
+        <path>/status.json     backlog and flusher state, for monitoring
+        <path>/lock            serialises writers from several processes
+        <path>/failed/<id>.json  records the database refused, in the --dumponfail format
+
+    Writers append to the newest segment and start a new one once it is larger than
+    segment_size. A record is on disk (fsync) before append returns, and writers that
+    append at the same time share one fsync. The flusher reads records after the
+    checkpoint, moves the checkpoint once they are indexed, and deletes segments it has
+    finished with. A record cut short by a crash has no final newline, and is skipped;
+    the next append starts a new segment rather than write after it.
+
+    How to use:
+
+    from plugins.spool import Spool
+    spool = Spool("/var/spool/ponymail")
+    spool.append(record)
+    for batch in spool.batches(100): ...; spool.commit(batch.end)
+"""
+
+import fcntl
+import json
+import os
+import re
+import threading
+import time
+import typing
+
+SEGMENT_RE = re.compile(r"^segment-(\d{12})\.jsonl$")
+DEFAULT_SEGMENT_SIZE = 64 * 1024 * 1024
+
+
+class Position(typing.NamedTuple):
+    segment: int
+    offset: int
+
+
+class Batch(typing.NamedTuple):
+    records: typing.List[dict]
+    end: Position  # Where the next batch starts
+
+
+def write_atomically(path: str, data: dict) -> None:
+    tmpname = path + ".tmp"
+    with open(tmpname, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmpname, path)
+
+
+class Spool:
+    def __init__(self, path: str, segment_size: int = DEFAULT_SEGMENT_SIZE):
+        self.path = path
+        self.segment_size = segment_size
+        os.makedirs(path, exist_ok=True)
+        # Group commit: appends are numbered, and one fsync covers every append written before it
+        self.write_lock = threading.Lock()
+        self.sync_lock = threading.Lock()
+        self.written = 0
+        self.synced = 0
+        self.file: typing.Optional[typing.BinaryIO] = None
+        self.file_segment = 0
+
+    def segment_path(self, segment: int) -> str:
+        return os.path.join(self.path, "segment-%012u.jsonl" % segment)
+
+    def segments(self) -> typing.List[int]:
+        found = []
+        for name in os.listdir(self.path):
+            match = SEGMENT_RE.match(name)
+            if match:
+                found.append(int(match.group(1)))
+        return sorted(found)
+
+    def lock(self) -> typing.BinaryIO:
+        """Takes the spool lock, which is released when the returned file is closed"""
+        lockfile = open(os.path.join(self.path, "lock"), "ab")
+        fcntl.flock(lockfile, fcntl.LOCK_EX)
+        return lockfile
+
+    def append(self, record: dict, sync: bool = True) -> None:
+        """Adds a record to the spool. Unless sync is False, it is on disk when this returns"""
+        line = json.dumps(record).encode("utf-8") + b"\n"
+        with self.write_lock:
+            with self.lock():
+                segments = self.segments()
+                segment = segments[-1] if segments else 1
+                if self.full_or_damaged(segment):
+                    segment += 1
+                if self.file is None or self.file_segment != segment:
+                    self.sync_file()  # Everything written to the previous segment must be on disk too
+                    if self.file is not None:
+                        self.file.close()
+                    self.file = open(self.segment_path(segment), "a+b")
+                    self.file_segment = segment
+                self.file.write(line)
+                self.file.flush()
+            self.written += 1
+            ticket = self.written
+        if sync:
+            self.sync(ticket)
+
+    def full_or_damaged(self, segment: int) -> bool:
+        """Whether appends must go to a new segment: this one is full, or ends with a record cut short by a crash"""
+        path = self.segment_path(segment)
+        if not os.path.exists(path):
+            return False
+        size = os.path.getsize(path)
+        if size >= self.segment_size:
+            return True
+        if size == 0:
+            return False
+        # Appending after a partial record would glue the next one to it, and both would be skipped
+        if self.file is not None and self.file_segment == segment:
+            return os.pread(self.file.fileno(), 1, size - 1) != b"\n"
+        with open(path, "rb") as f:
+            f.seek(size - 1)
+            return f.read(1) != b"\n"
+
+    def sync_file(self) -> None:
+        if self.file is not None:
+            os.fsync(self.file.fileno())
+
+    def sync(self, ticket: typing.Optional[int] = None) -> None:
+        """Waits until the given append (or all of them) is on disk, doing the fsync if nobody else has"""
+        if ticket is None:
+            ticket = self.written
+        with self.sync_lock:
+            if self.synced >= ticket:
+                return  # Someone else's fsync covered it
+            with self.write_lock:
+                upto = self.written
+                if self.file is None:
+                    return
+                # Appends can carry on while we wait for the disk; rotation may close the file, but not this copy
+                fd = os.dup(self.file.fileno())
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+            self.synced = upto
+
+    def close(self) -> None:
+        self.sync()
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def checkpoint(self) -> Position:
+        try:
+            with open(os.path.join(self.path, "checkpoint")) as f:
+                data = json.load(f)
+            return Position(data["segment"], data["offset"])
+        except FileNotFoundError:
+            segments = self.segments()
+            return Position(segments[0] if segments else 1, 0)
+
+    def batches(self, size: int, max_bytes: int = 16 * 1024 * 1024) -> typing.Iterator[Batch]:
+        """Reads the complete records after the checkpoint, in batches of up to size records or about max_bytes"""
+        position = self.checkpoint()
+        for segment in self.segments():
+            if segment < position.segment:
+                continue
+            offset = position.offset if segment == position.segment else 0
+            with open(self.segment_path(segment), "rb") as f:
+                f.seek(offset)
+                records: typing.List[dict] = []
+                length = 0
+                for line in f:
+                    if not line.endswith(b"\n"):
+                        break  # Still being written, or cut short by a crash
+                    offset += len(line)
+                    length += len(line)
+                    try:
+                        records.append(json.loads(line))
+                    except ValueError:
+                        print("Skipping a damaged record in %s" % self.segment_path(segment))
+                    if len(records) >= size or length >= max_bytes:
+                        yield Batch(records, Position(segment, offset))
+                        records = []
+                        length = 0
+                if records:
+                    yield Batch(records, Position(segment, offset))
+            position = Position(segment, offset)
+
+    def commit(self, position: Position) -> None:
+        """Records that everything before position has been indexed, and deletes finished segments"""
+        write_atomically(os.path.join(self.path, "checkpoint"), position._asdict())
+        with self.lock():
+            segments = self.segments()
+            for segment in segments[:-1]:  # Writers may still append to the newest
+                if segment < position.segment or (
+                    segment == position.segment and position.offset >= os.path.getsize(self.segment_path(segment))
+                ):
+                    os.unlink(self.segment_path(segment))
+
+    def reject(self, record: dict) -> str:
+        """Sets aside a record the database will not take, so that the flusher can carry on past it"""
+        failed = os.path.join(self.path, "failed")
+        os.makedirs(failed, exist_ok=True)
+        path = os.path.join(failed, "%s.json" % re.sub(r"[^\w.-]", "_", str(record.get("id"))))
+        write_atomically(path, record)
+        return path
+
+    def backlog(self) -> typing.Tuple[int, int]:
+        """Returns the number of records, and bytes, waiting to be indexed"""
+        position = self.checkpoint()
+        records = 0
+        size = 0
+        for segment in self.segments():
+            if segment < position.segment:
+                continue
+            with open(self.segment_path(segment), "rb") as f:
+                if segment == position.segment:
+                    f.seek(position.offset)
+                while True:
+                    chunk = f.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    records += chunk.count(b"\n")
+                    size += len(chunk)
+        return records, size
+
+    def write_status(self, **state) -> dict:
+        """Writes the backlog and the flusher's state to status.json, for monitoring"""
+        records, size = self.backlog()
+        status = {"records": records, "bytes": size, "updated": int(time.time()), **state}
+        write_atomically(os.path.join(self.path, "status.json"), status)
+        return status
@@ -23,11 +23,14 @@ import json
 import os
 
 if not __package__:
+    from plugins.blobstore import AttachmentStore # pylint: disable=no-name-in-module
     from plugins.elastic import Elastic # pylint: disable=no-name-in-module
 else:
+    from .plugins.blobstore import AttachmentStore # pylint: disable=no-name-in-module
     from .plugins.elastic import Elastic # pylint: disable=no-name-in-module
 
 elastic = Elastic()
+attachments = AttachmentStore()
 
 parser = argparse.ArgumentParser(description="Command line options.")
 parser.add_argument(
@@ -58,7 +61,7 @@ for file in files:
 
             if "attachments" in ojson and ojson["attachments"]:
                 for k, v in ojson["attachments"].items():
-                    elastic.index(index=elastic.db_attachment, id=k, body={"source": v})
+                    attachments.put(elastic, k, v)
         f.close()
     os.unlink(fpath)
 print("All done! Pushed %u documents to ES." % len(files))
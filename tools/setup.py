@@ -425,7 +425,7 @@ database:
   dburl: %s      # The URL of the ElasticSearch database
   db_prefix: %s    # DB prefix, usually 'ponymail'
   max_hits: 15000        # Maximum number of emails to process in a search
-  pool_size: 15          # number of connections for async queries
+  pool_size: 15          # max number of concurrent async queries
   max_lists: 8192        # max number of lists to allow for
 
 ui: